@@ -0,0 +1,75 @@
+"""
+Micro-benchmark of the encoding of geometries as EWKB.
+
+GeoJSON geometries of each type are encoded with geofdw.ewkb, writing into a
+reused buffer, and with plpygis, building a geometry object for each one, and
+the cost per geometry is reported. Points given as coordinates are also
+encoded in bulk with ewkb.points_hex.
+
+    python bench/ewkb_encoding.py --count 100000 --vertices 20
+"""
+
+import argparse
+import math
+import random
+import time
+
+from plpygis import Geometry, Point
+
+from geofdw import ewkb
+
+
+def synthetic_geometries(count, vertices, seed=0):
+    rng = random.Random(seed)
+    points, lines, polygons, multipolygons = [], [], [], []
+    for i in range(count):
+        x, y = rng.uniform(-180, 180), rng.uniform(-90, 90)
+        points.append({"type": "Point", "coordinates": [x, y]})
+        lines.append({"type": "LineString", "coordinates": [
+            [x + 0.01 * j, y + 0.01 * j] for j in range(vertices)]})
+        ring = [[x + math.cos(2 * math.pi * j / vertices),
+                 y + math.sin(2 * math.pi * j / vertices)] for j in range(vertices)]
+        ring.append(ring[0])
+        polygons.append({"type": "Polygon", "coordinates": [ring]})
+        multipolygons.append({"type": "MultiPolygon", "coordinates": [[ring], [ring]]})
+    return [("point", points), ("linestring", lines), ("polygon", polygons),
+            ("multipolygon", multipolygons)]
+
+
+def measure(encode, geometries):
+    start = time.perf_counter()
+    for geometry in geometries:
+        encode(geometry)
+    return (time.perf_counter() - start) / len(geometries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--vertices", type=int, default=20)
+    parser.add_argument("--srid", type=int, default=4326)
+    args = parser.parse_args()
+
+    writer = ewkb.Writer(args.srid)
+    print("%-14s %14s %14s %8s" % ("geometry", "ewkb us/row", "plpygis us/row", "speedup"))
+    for name, geometries in synthetic_geometries(args.count, args.vertices):
+        fast = measure(writer.geojson, geometries)
+        slow = measure(lambda g: Geometry.from_geojson(g, srid=args.srid).ewkb,
+                       geometries)
+        print("%-14s %14.2f %14.2f %7.1fx" % (name, fast * 1e6, slow * 1e6, slow / fast))
+
+    rng = random.Random(1)
+    x = [rng.uniform(-180, 180) for i in range(args.count)]
+    y = [rng.uniform(-90, 90) for i in range(args.count)]
+    start = time.perf_counter()
+    ewkb.points_hex(x, y, srid=args.srid)
+    fast = (time.perf_counter() - start) / args.count
+    start = time.perf_counter()
+    for i in range(args.count):
+        str(Point((x[i], y[i]), srid=args.srid))
+    slow = (time.perf_counter() - start) / args.count
+    print("%-14s %14.2f %14.2f %7.1fx" % ("hex points", fast * 1e6, slow * 1e6, slow / fast))
+
+
+if __name__ == "__main__":
+    main()
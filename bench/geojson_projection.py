@@ -0,0 +1,70 @@
+"""
+Micro-benchmark of the mapping of GeoJSON properties onto table columns.
+
+Features with many properties are generated in memory and passed through
+GeoJSON._execute with only attribute columns selected, so that the time
+measured is the time spent building rows. The previous implementation, which
+compared every property with every column for every feature, is timed on the
+same input for comparison.
+
+    python bench/geojson_projection.py --features 1000000 --properties 100
+"""
+
+import argparse
+import itertools
+import time
+
+from geofdw.fdw.geojson import GeoJSON
+
+
+def legacy_execute(features, columns):
+    for feat in features:
+        row = {}
+        properties = feat["properties"]
+        for p in properties.keys():
+            for col in columns:
+                if col == p or col == p.lower():
+                    row[col] = properties.get(p)
+                    break
+        yield row
+
+
+def synthetic_features(count, properties, distinct=1000):
+    names = ["Property_%03d" % i for i in range(properties)]
+    pool = []
+    for i in range(distinct):
+        pool.append({
+            "type": "Feature",
+            "geometry": None,
+            "properties": dict((name, i * j) for j, name in enumerate(names)),
+        })
+    return itertools.islice(itertools.cycle(pool), count), names
+
+
+def measure(name, rows, count):
+    start = time.perf_counter()
+    for row in rows:
+        pass
+    elapsed = time.perf_counter() - start
+    print("%-10s %10.0f rows/s  (%.2f s)" % (name, count / elapsed, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--features", type=int, default=1000000)
+    parser.add_argument("--properties", type=int, default=100)
+    parser.add_argument("--columns", type=int, default=10,
+                        help="number of attribute columns selected")
+    args = parser.parse_args()
+
+    fdw = GeoJSON({"url": "http://localhost/synthetic.geojson"}, ["geom"])
+    features, names = synthetic_features(args.features, args.properties)
+    columns = [name.lower() for name in names[:args.columns]]
+    measure("projection", fdw._execute(features, columns), args.features)
+
+    features, names = synthetic_features(args.features, args.properties)
+    measure("legacy", legacy_execute(features, columns), args.features)
+
+
+if __name__ == "__main__":
+    main()
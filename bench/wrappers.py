@@ -0,0 +1,248 @@
+"""
+Throughput benchmarks of the wrappers, run offline against geofdw.replay.
+
+Each case creates a wrapper pointed at a local stand-in server and drives its
+execute method directly, without PostgreSQL (Multicorn must still be
+importable). Every case runs in a fresh process, so that its peak RSS is its
+own, and is measured twice:
+
+- a timed scan, which reports rows per second and the time to the first row;
+- a scan under tracemalloc that keeps every row, which reports the memory and
+  the number of memory blocks allocated for each row kept. (CPython does not
+  count allocations, so the blocks still held per row stand in for the
+  allocations per row.)
+
+The results are written as JSON, together with the commit they were measured
+at, and can be compared with an earlier run:
+
+    python bench/wrappers.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from geofdw.replay import ReplayServer
+
+
+def geojson(url, args):
+    from geofdw.fdw.geojson import GeoJSON
+    fdw = GeoJSON({"url": "%s/geojson?features=%d&properties=%d" % (
+        url, args.features, args.properties)}, {"geom": None})
+    return fdw, [], ["geom", "name"]
+
+
+def geojson_stream(url, args):
+    from geofdw.fdw.geojson import GeoJSON
+    fdw = GeoJSON({"url": "%s/geojson?features=%d&properties=%d" % (
+        url, args.features, args.properties), "stream": "true"}, {"geom": None})
+    return fdw, [], ["geom", "name"]
+
+
+def geojson_snapshot(url, args):
+    from geofdw.fdw.geojson import GeoJSON
+    options = {"url": "%s/geojson?features=%d&properties=%d" % (
+        url, args.features, args.properties), "cache_dir": args.cache_dir,
+        "snapshot": "true"}
+    # the first scan builds the snapshot, which the measured scans then read
+    fdw = GeoJSON(options, {"geom": None})
+    for row in fdw.execute([], ["geom"]):
+        pass
+    return fdw, [], ["geom", "name"]
+
+
+def geojson_paged(url, args):
+    from geofdw.fdw.geojson import GeoJSON
+    fdw = GeoJSON({"url": "%s/items?features=%d&properties=%d" % (
+        url, args.features, args.properties), "paging": "offset"}, {"geom": None})
+    return fdw, [], ["geom", "name"]
+
+
+def statevector(url, args):
+    from geofdw.fdw.opensky import StateVector
+    fdw = StateVector({"url": url + "/api"}, {})
+    return fdw, [], ["geom", "icao24", "callsign", "velocity", "time"]
+
+
+def statevector_snapshot(url, args):
+    from geofdw.fdw.opensky import StateVector
+    fdw = StateVector({"url": url + "/api", "snapshot": "true",
+                       "resolution": "3600"}, {})
+    for row in fdw.execute([], ["icao24"]):
+        pass
+    return fdw, [], ["geom", "icao24", "callsign", "velocity", "time"]
+
+
+def flights(url, args):
+    from multicorn import Qual
+    from datetime import datetime
+    from geofdw.fdw.opensky import Flights
+    fdw = Flights({"url": url + "/api"}, {})
+    quals = [Qual("first_seen", ">=", datetime(2024, 1, 1)),
+             Qual("first_seen", "<=", datetime(2024, 1, 2))]
+    return fdw, quals, ["icao24", "callsign", "first_seen", "departure", "arrival"]
+
+
+def geocode(url, args):
+    from multicorn import Qual
+    from geofdw.fdw.geocode import FGeocode
+    fdw = FGeocode({"service": "nominatim", "domain": url.split("://")[1],
+                    "scheme": "http", "rate_limit": "10000",
+                    "cache_entries": "0"}, {})
+    queries = ["place %d" % i for i in range(args.queries)]
+    return fdw, [Qual("query", ("=", True), queries)], ["geom", "address", "query"]
+
+
+def randompoint(url, args):
+    from geofdw.fdw.randompoint import RandomPoint
+    fdw = RandomPoint({"min_x": "-180", "min_y": "-90", "max_x": "180",
+                       "max_y": "90", "num": str(args.features), "seed": "1"},
+                      {"geom": None})
+    return fdw, [], ["geom"]
+
+
+CASES = {
+    "geojson": geojson,
+    "geojson_stream": geojson_stream,
+    "geojson_snapshot": geojson_snapshot,
+    "geojson_paged": geojson_paged,
+    "statevector": statevector,
+    "statevector_snapshot": statevector_snapshot,
+    "flights": flights,
+    "geocode": geocode,
+    "randompoint": randompoint,
+}
+
+
+def run_case(name, url, args, results):
+    """
+    Measure one case; runs in its own process.
+    """
+    try:
+        results.put(measure(name, url, args))
+    except Exception as e:
+        results.put({"case": name, "error": "%s: %s" % (type(e).__name__, e)})
+
+
+def measure(name, url, args):
+    fdw, quals, columns = CASES[name](url, args)
+
+    start = time.perf_counter()
+    first = None
+    rows = 0
+    for row in fdw.execute(quals, columns):
+        if first is None:
+            first = time.perf_counter() - start
+        rows += 1
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    kept = [dict(row) for row in fdw.execute(quals, columns)]
+    blocks = sys.getallocatedblocks() - blocks
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "case": name,
+        "rows": rows,
+        "seconds": elapsed,
+        "rows_per_second": rows / elapsed if elapsed else None,
+        "first_row_seconds": first,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "bytes_per_row": current / len(kept) if kept else None,
+        "peak_bytes": peak,
+        "blocks_per_row": blocks / float(len(kept)) if kept else None,
+    }
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    with open(path) as f:
+        before = dict((r["case"], r) for r in json.load(f)["results"])
+    print("\n%-22s %12s %12s" % ("change", "rows/s", "first row"))
+    for result in results:
+        old = before.get(result["case"])
+        if not old or not old["rows_per_second"] or not old["first_row_seconds"]:
+            continue
+        print("%-22s %+11.1f%% %+11.1f%%" % (
+            result["case"],
+            100.0 * (result["rows_per_second"] / old["rows_per_second"] - 1),
+            100.0 * ((result["first_row_seconds"] or 0) / old["first_row_seconds"] - 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("cases", nargs="*", default=sorted(CASES),
+                        help="cases to run (default all): %s" % ", ".join(sorted(CASES)))
+    parser.add_argument("--features", type=int, default=100000)
+    parser.add_argument("--properties", type=int, default=10)
+    parser.add_argument("--aircraft", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds the server waits before each response")
+    parser.add_argument("--output", help="file in which to save the results")
+    parser.add_argument("--compare", help="results of an earlier run")
+    args = parser.parse_args()
+
+    args.cache_dir = tempfile.mkdtemp()
+    context = multiprocessing.get_context("spawn")
+    results = []
+    try:
+        with ReplayServer(latency=args.latency, aircraft=args.aircraft) as server:
+            print("%-22s %10s %12s %10s %10s %10s %8s" % (
+                "case", "rows", "rows/s", "first row", "RSS MB", "bytes/row",
+                "blocks"))
+            for name in args.cases:
+                queue = context.Queue()
+                process = context.Process(target=run_case,
+                                          args=(name, server.url, args, queue))
+                process.start()
+                result = queue.get()
+                process.join()
+                if "error" in result:
+                    print("%-22s %s" % (name, result["error"]))
+                    continue
+                results.append(result)
+                print("%-22s %10d %12.0f %9.4fs %10.1f %10.0f %8.1f" % (
+                    name, result["rows"], result["rows_per_second"] or 0,
+                    result["first_row_seconds"] or 0,
+                    result["peak_rss_kb"] / 1024.0, result["bytes_per_row"] or 0,
+                    result["blocks_per_row"] or 0))
+    finally:
+        shutil.rmtree(args.cache_dir)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "commit": commit(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "arguments": dict((k, v) for k, v in vars(args).items()
+                                  if k not in ["output", "compare", "cache_dir"]),
+                "results": results,
+            }, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,154 @@
 from multicorn import ForeignDataWrapper, Qual
 from multicorn.utils import log_to_postgres
 from logging import ERROR, INFO, DEBUG, WARNING, CRITICAL
-from geofdw.exception import MissingColumnError, MissingOptionError, OptionTypeError
+from geofdw.exception import MissingColumnError, MissingOptionError, OptionTypeError, OptionValueError
+from geofdw.utils import allowed_path, to_bool
+from http.cookiejar import DefaultCookiePolicy
+from itertools import islice
+from plpygis import Geometry
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import os
+import requests
+import threading
+import time
+
+POOL_SIZE = 10
+TIMEOUT = 30.0
+# environment variable of the server listing the directories (separated by
+# os.pathsep) whose files may be read or written; table options cannot be
+# restricted to superusers, so this is left to whoever runs the server
+ALLOWED_DIRS = "GEOFDW_ALLOWED_DIRS"
+
+
+class PoolStats(object):
+    """
+    Counts the requests made to a host and the connections opened to it, so
+    that the proportion of requests that reused a connection (rather than
+    paying for a TCP and TLS handshake) can be reported.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.requests = 0
+        self.connections = 0
+        self.connect_time = 0.0
+        self.lock = threading.Lock()
+
+    def connected(self, seconds):
+        with self.lock:
+            self.connections += 1
+            self.connect_time += seconds
+
+    def requested(self):
+        with self.lock:
+            self.requests += 1
+
+    def __str__(self):
+        reused = 0
+        if self.requests:
+            reused = max(0, self.requests - self.connections) * 100.0 / self.requests
+        connect = 0
+        if self.connections:
+            connect = self.connect_time * 1000 / self.connections
+        return ("%s: %d requests, %d connections (%.0f%% reused), "
+                "%.1f ms average connect time" %
+                (self.host, self.requests, self.connections, reused, connect))
+
+
+_stats = {}
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_pool_stats(host):
+    """
+    Return the statistics of the connections to host (host[:port]).
+    """
+    with _sessions_lock:
+        stats = _stats.get(host)
+        if stats is None:
+            stats = _stats[host] = PoolStats(host)
+        return stats
+
+
+def _timed_pool(pool_class):
+    """
+    Make a connection pool class that times the connections it opens.
+    """
+    class TimedPool(pool_class):
+        def _new_conn(self):
+            conn = super(TimedPool, self)._new_conn()
+            host = self.host if self.port in (None, 80, 443) else "%s:%s" % (self.host, self.port)
+            stats = get_pool_stats(host)
+            connect = conn.connect
+
+            def timed_connect():
+                start = time.monotonic()
+                connect()
+                stats.connected(time.monotonic() - start)
+
+            conn.connect = timed_connect
+            return conn
+    return TimedPool
+
+
+class _PoolAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super(_PoolAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _timed_pool(HTTPConnectionPool),
+            "https": _timed_pool(HTTPSConnectionPool),
+        }
+
+
+class PooledSession(requests.Session):
+    """
+    A requests session that keeps up to pool_size connections to each host
+    alive between requests, applies a default timeout and records the
+    statistics of its connections. It keeps no cookies, since it is shared by
+    tables with different credentials.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, timeout=TIMEOUT, compress=True):
+        super(PooledSession, self).__init__()
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = _PoolAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+        self.timeout = timeout
+        if not compress:
+            self.headers["Accept-Encoding"] = "identity"
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        response = super(PooledSession, self).request(method, url, **kwargs)
+        # requests may be sent from worker threads, so the statistics are only
+        # recorded here and reported by GeoFDW.end_scan
+        get_pool_stats(urlsplit(response.url or url).netloc).requested()
+        return response
+
+    def close(self):
+        # the session is shared by every table in the process
+        pass
+
+
+def get_session(url, pool_size=POOL_SIZE, timeout=TIMEOUT, compress=True):
+    """
+    Return the session shared by every wrapper in this process for requests
+    to the host of url with the same pool size, timeout and compression.
+    Authentication and other settings that differ between tables must be
+    passed with each request rather than set on the session.
+    """
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc, pool_size, timeout, compress)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = PooledSession(pool_size, timeout, compress)
+        return session
 
 
 class GeoFDW(ForeignDataWrapper):
@@ -10,6 +157,45 @@ class GeoFDW(ForeignDataWrapper):
         self.options = options
         self.columns = columns
         self.srid = srid
+        self.pool_hosts = set()
+        self.pool_options = None
+
+    def can_limit(self, limit, offset):
+        """
+        Query planner helper. A LIMIT and OFFSET are only pushed down to the
+        wrappers that can check some predicates themselves (see enforces),
+        since PostgreSQL checks the rows again after they have been cut.
+        """
+        return False
+
+    def enforces(self, quals):
+        """
+        Return whether every row of a scan satisfies all of quals, so that
+        PostgreSQL rejects none of them and a LIMIT can be applied here. The
+        wrappers that check some predicates exactly extend this.
+        """
+        return not quals
+
+    def get_limit(self, quals, limit=None, offset=None):
+        """
+        Return the LIMIT and OFFSET pushed down to a scan, or (None, None) if
+        not every qual is enforced; the rows are then returned from a
+        generator, which PostgreSQL only reads as far as it needs.
+        """
+        if self.enforces(quals):
+            return limit, offset
+        return None, None
+
+    def limit_rows(self, rows, limit=None, offset=None):
+        """
+        Return the rows of a scan within a pushed-down LIMIT and OFFSET. The
+        rows are taken lazily, so the scan goes no further than the last of
+        them.
+        """
+        if limit is None and not offset:
+            return rows
+        offset = offset or 0
+        return islice(rows, offset, None if limit is None else offset + limit)
 
     def check_columns(self, columns):
         for column in columns:
@@ -27,6 +213,19 @@ class GeoFDW(ForeignDataWrapper):
         except ValueError as e:
             raise OptionTypeError(option, option_type)
 
+    def get_local_path(self, path):
+        """
+        Return the real path of a file on the database server, or raise
+        OptionValueError if it is not inside one of the directories listed in
+        the GEOFDW_ALLOWED_DIRS environment variable.
+        """
+        allowed = os.environ.get(ALLOWED_DIRS, "").split(os.pathsep)
+        real = allowed_path(path, [d for d in allowed if d])
+        if real is None:
+            raise OptionValueError("%s is not inside a directory listed in %s" %
+                                   (path, ALLOWED_DIRS))
+        return real
+
     def get_request_options(self):
         if "verify" in self.options:
             self.verify = self.options.get("verify").lower() in ["1", "t", "true"]
@@ -38,5 +237,78 @@ class GeoFDW(ForeignDataWrapper):
         else:
             self.auth = None
 
+    def get_pool_options(self):
+        """
+        Read and check the options of the pooled sessions (see get_session)
+        the first time they are needed. Wrappers that get sessions from
+        worker threads call this in __init__, since an invalid option can
+        only be reported from the main thread.
+
+        :return: (pool_size, timeout, compress)
+        """
+        if self.pool_options is None:
+            pool_size = self.get_option("pool_size", required=False,
+                                        default=POOL_SIZE, option_type=int)
+            timeout = self.get_option("timeout", required=False,
+                                      default=TIMEOUT, option_type=float)
+            compress = self.get_option("compress", required=False,
+                                       default=True, option_type=to_bool)
+            if pool_size < 1 or timeout <= 0:
+                raise OptionValueError("pool_size and timeout must be positive")
+            self.pool_options = (pool_size, timeout, compress)
+        return self.pool_options
+
+    def get_session(self, url):
+        """
+        Return the pooled session for requests to url, configured by the
+        options:
+            pool_size: connections kept alive to the host (default 10)
+            timeout: seconds to wait for the server (default 30)
+            compress: set to false to ask for uncompressed responses
+        """
+        pool_size, timeout, compress = self.get_pool_options()
+        self.pool_hosts.add(urlsplit(url).netloc)
+        return get_session(url, pool_size, timeout, compress)
+
+    def end_scan(self):
+        """
+        Report the statistics of the connections to the hosts that the table
+        sends requests to, once the scan is over.
+        """
+        for host in sorted(self.pool_hosts):
+            log_to_postgres("HTTP pool %s" % get_pool_stats(host), DEBUG)
+
+    def get_bounds(self, quals, column="geom"):
+        """
+        Find the bounding box that a geometry column must intersect according
+        to the quals. The following formats are recognised (and treated
+        equivalently):
+
+                geom && ST_GeomFromText('POLYGON(...)')
+                ST_GeomFromText('POLYGON(...)') && geom
+                geom @ ST_GeomFromText('POLYGON(...)')
+                ST_GeomFromText('POLYGON(...)') ~ geom
+
+        If there are several such predicates, the intersection of their
+        bounding boxes is returned.
+
+        :return: (minx, miny, maxx, maxy) or None.
+        """
+        bounds = None
+        for qual in quals:
+            # note A ~ B is transformed into B @ A
+            if qual.field_name == column and qual.operator in ["&&", "@"]:
+                box = Geometry(qual.value).bounds
+            elif qual.value == column and qual.operator == "&&":
+                box = Geometry(qual.field_name).bounds
+            else:
+                continue
+            if bounds is None:
+                bounds = tuple(box)
+            else:
+                bounds = (max(bounds[0], box[0]), max(bounds[1], box[1]),
+                          min(bounds[2], box[2]), min(bounds[3], box[3]))
+        return bounds
+
     def log(self, message, level=WARNING):
         log_to_postgres(message, level)
@@ -0,0 +1,378 @@
+"""
+Persistent on-disk cache for HTTP resources shared between PostgreSQL
+backends.
+
+Each cached URL is stored as two files in the cache directory: a JSON
+metadata file holding the validators (ETag and Last-Modified) and the name of
+a body file containing the raw response. Both are written to temporary files
+and moved into place with an atomic rename, so readers never see a partial
+file and never need to take a lock. Writers take an exclusive lock per URL so
+that concurrent backends that find the same stale entry only download it
+once.
+"""
+
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+import requests
+
+from geofdw.stream import CHUNK_SIZE
+
+
+class CachedResponse(object):
+    """
+    A cached response body. It implements the subset of requests.Response that
+    the wrappers use to read a body so that either can be passed around.
+    """
+
+    status_code = 200
+
+    def __init__(self, url, key, path, version, from_cache, content_type=None):
+        self.url = url
+        self.key = key
+        self.path = path
+        self.version = version
+        self.from_cache = from_cache
+        self.headers = {}
+        if content_type:
+            self.headers["Content-Type"] = content_type
+        # hold the file open so that it can still be read if it is evicted
+        self.file = open(path, "rb")
+
+    def iter_content(self, chunk_size=CHUNK_SIZE):
+        try:
+            while True:
+                chunk = self.file.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    @property
+    def content(self):
+        try:
+            return self.file.read()
+        finally:
+            self.close()
+
+    def json(self):
+        return json.loads(self.content.decode("utf-8"))
+
+    def close(self):
+        self.file.close()
+
+
+class FileResponse(CachedResponse):
+    """
+    A local file read through a memory map, so that it is never copied into
+    a single bytes object: iter_content yields views of the mapped pages.
+    Its version is made from the inode, size and modification time of the
+    file, so anything derived from an earlier version is not reused once the
+    file changes.
+    """
+
+    def __init__(self, path, key=None):
+        self.url = path
+        self.path = path
+        self.key = key
+        self.from_cache = False
+        self.headers = {}
+        self.file = open(path, "rb")
+        stat = os.fstat(self.file.fileno())
+        self.version = "%x-%x-%x" % (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        self.map = None
+        if stat.st_size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def iter_content(self, chunk_size=CHUNK_SIZE):
+        try:
+            if self.map is None:
+                return
+            view = memoryview(self.map)
+            try:
+                for offset in range(0, len(view), chunk_size):
+                    yield view[offset:offset + chunk_size]
+            finally:
+                view.release()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # a chunk is still being read; the map is unmapped once the
+                # last view of it is released
+                pass
+            self.map = None
+        self.file.close()
+
+
+class HTTPCache(object):
+    """
+    A directory of cached HTTP responses with a freshness lifetime and a
+    maximum total size. Entries that are older than the lifetime are
+    revalidated with a conditional request, and the least recently used
+    entries are evicted once the directory grows beyond its maximum size.
+    """
+
+    def __init__(self, directory, ttl=60, max_size=None):
+        """
+        :param str directory: Directory in which to store the cache (created
+        if it does not exist).
+        :param int ttl: Number of seconds for which a response is used without
+        revalidating it.
+        :param int max_size: Maximum size of all cached bodies in bytes, or
+        None for no limit.
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, url, fetch, variant=None):
+        """
+        Return the body of url, using the cache where possible.
+
+        :param str url: The URL of the resource.
+        :param callable fetch: Function that takes a dict of extra request
+        headers and returns a streaming requests.Response for url.
+        :param str variant: Anything else that affects the response (e.g. the
+        user name used for authentication).
+
+        :return: A CachedResponse, or the requests.Response itself if the
+        server responded with something that cannot be cached.
+        """
+        key = self._key(url, variant)
+        response = self._fresh(url, key)
+        if response:
+            return response
+
+        with self._lock(key):
+            # another backend may have refreshed the entry while we waited
+            response = self._fresh(url, key)
+            if response:
+                return response
+            meta = self._read_meta(key)
+            headers = self._validators(meta)
+            try:
+                response = fetch(headers)
+            except requests.exceptions.RequestException:
+                stale = self._open(url, key, meta)
+                if stale:
+                    return stale
+                raise
+
+            if response.status_code == 304 and meta:
+                response.close()
+                meta["fetched"] = time.time()
+                self._write_meta(key, meta)
+                cached = self._open(url, key, meta)
+                if cached:
+                    return cached
+                response = fetch({})
+
+            if response.status_code != 200 or self._no_store(response):
+                return response
+
+            meta = self._store(key, url, response)
+
+        self._evict(keep=key)
+        return self._open(url, key, meta, from_cache=False)
+
+    def derived(self, response, suffix):
+        """
+        Return the path for a file derived from a cached response (e.g. an
+        index built from its contents). Derived files are removed along with
+        the response body when it is replaced or evicted.
+
+        :param CachedResponse response: The response the file is built from.
+        :param str suffix: Name that distinguishes this kind of derived file.
+        """
+        return self._path("%s.%s.%s" % (response.key, response.version, suffix))
+
+    def local(self, path):
+        """
+        Open a local file as a FileResponse whose derived files are kept in
+        the cache directory. Files derived from other versions of the file
+        (from before it was last modified or replaced) are removed.
+
+        :param str path: Location of the file.
+        """
+        key = self._key(os.path.abspath(path), "file")
+        response = FileResponse(path, key)
+        current = "%s.%s." % (key, response.version)
+        for name in os.listdir(self.directory):
+            if name.startswith(key + ".") and not name.startswith(current):
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+        return response
+
+    def _key(self, url, variant):
+        value = url if variant is None else "%s\0%s" % (url, variant)
+        return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _fresh(self, url, key):
+        meta = self._read_meta(key)
+        if meta and time.time() - meta.get("fetched", 0) < self.ttl:
+            return self._open(url, key, meta)
+        return None
+
+    def _open(self, url, key, meta, from_cache=True):
+        if not meta:
+            return None
+        path = self._path(meta["body"])
+        try:
+            response = CachedResponse(url, key, path, meta["version"],
+                                      from_cache, meta.get("content_type"))
+        except (IOError, OSError):
+            return None
+        if from_cache:
+            self._touch(path)
+        return response
+
+    def _touch(self, path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def _validators(self, meta):
+        headers = {}
+        if meta:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def _no_store(self, response):
+        cache_control = response.headers.get("Cache-Control", "")
+        return "no-store" in cache_control.lower()
+
+    def _read_meta(self, key):
+        try:
+            with open(self._path(key + ".json")) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _read_body_name(self, key, exclude):
+        meta = self._read_meta(key)
+        if meta and meta["body"] != exclude:
+            return meta["body"]
+        return None
+
+    def _write_meta(self, key, meta):
+        self._atomic_write(key + ".json", [json.dumps(meta).encode("utf-8")])
+
+    def _store(self, key, url, response):
+        version = uuid.uuid4().hex
+        body = "%s.%s.body" % (key, version)
+        old = self._read_body_name(key, exclude=body)
+        try:
+            self._atomic_write(body, response.iter_content(CHUNK_SIZE))
+        finally:
+            response.close()
+        meta = {
+            "url": url,
+            "body": body,
+            "version": version,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content_type": response.headers.get("Content-Type"),
+            "fetched": time.time(),
+        }
+        self._write_meta(key, meta)
+        self._remove_version(old)
+        return meta
+
+    def _remove_version(self, body):
+        """
+        Remove a body file and everything derived from it.
+        """
+        if body is None:
+            return
+        prefix = body[:-len("body")]
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix):
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+
+    def _atomic_write(self, name, chunks):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp, self._path(name))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    @contextmanager
+    def _lock(self, name):
+        with open(self._path(name + ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _evict(self, keep):
+        """
+        Delete the least recently used entries until the bodies and the
+        files derived from them fit within max_size. Bodies are touched
+        whenever they are served, so their modification times give the order
+        of use.
+        """
+        if self.max_size is None:
+            return
+        entries = {}
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.startswith(".") or name.endswith((".json", ".lock")):
+                continue
+            try:
+                stat = os.stat(self._path(name))
+            except OSError:
+                continue
+            key = name.split(".", 1)[0]
+            entry = entries.setdefault(key, {"mtime": 0, "size": 0, "files": []})
+            if name.endswith(".body"):
+                entry["mtime"] = stat.st_mtime
+            entry["size"] += stat.st_size
+            entry["files"].append(name)
+            total += stat.st_size
+        if total <= self.max_size:
+            return
+
+        with self._lock("evict"):
+            lru = sorted(entries.items(), key=lambda item: item[1]["mtime"])
+            for key, entry in lru:
+                if total <= self.max_size:
+                    break
+                if key == keep:
+                    continue
+                for name in [key + ".json"] + entry["files"]:
+                    try:
+                        os.remove(self._path(name))
+                    except OSError:
+                        pass
+                total -= entry["size"]
@@ -0,0 +1,270 @@
+"""
+Encoding of geometries as (little-endian) EWKB without geometry objects.
+
+The wrappers only need the bytes of a geometry, so rather than building a
+plpygis object for each row, its coordinates (or its GeoJSON) are written
+straight into a buffer with struct.pack_into. A Writer reuses its buffer
+from one geometry to the next, and the coordinates of a line or ring are
+packed with a single call.
+
+EWKB is WKB with flags in the geometry type for a Z coordinate and for an
+SRID, which follows the type. Only the outermost geometry carries the SRID;
+the parts of a multi-geometry or collection repeat the Z flag.
+"""
+
+import struct
+from itertools import chain
+
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+MULTIPOINT = 4
+MULTILINESTRING = 5
+MULTIPOLYGON = 6
+GEOMETRYCOLLECTION = 7
+
+Z_FLAG = 0x80000000
+SRID_FLAG = 0x20000000
+
+GEOJSON_TYPES = {
+    "Point": POINT,
+    "LineString": LINESTRING,
+    "Polygon": POLYGON,
+    "MultiPoint": MULTIPOINT,
+    "MultiLineString": MULTILINESTRING,
+    "MultiPolygon": MULTIPOLYGON,
+    "GeometryCollection": GEOMETRYCOLLECTION,
+}
+
+_NAN = float("nan")
+_HEADER = struct.Struct("<BI")
+_SRID_HEADER = struct.Struct("<BII")
+_COUNT = struct.Struct("<I")
+_XY = struct.Struct("<dd")
+_XYZ = struct.Struct("<ddd")
+
+
+def header(geometry_type, srid=None, z=False):
+    """
+    The EWKB of a geometry up to its contents.
+    """
+    if z:
+        geometry_type |= Z_FLAG
+    if srid is None:
+        return _HEADER.pack(1, geometry_type)
+    return _SRID_HEADER.pack(1, geometry_type | SRID_FLAG, srid)
+
+
+def has_z(geometry):
+    """
+    Whether a GeoJSON geometry has a third coordinate, judging by its first
+    position.
+    """
+    if geometry["type"] == "GeometryCollection":
+        return any(has_z(g) for g in geometry["geometries"][:1])
+    coordinates = geometry["coordinates"]
+    while coordinates and isinstance(coordinates[0], (list, tuple)):
+        coordinates = coordinates[0]
+    return len(coordinates) > 2
+
+
+class Writer(object):
+    """
+    Writes EWKB into a buffer that is reused for every geometry. Each method
+    returns the EWKB of one geometry as bytes.
+    """
+
+    def __init__(self, srid=None, size=4096):
+        """
+        :param int srid: SRID of the geometries, or None.
+        :param int size: Initial size of the buffer in bytes; it grows as
+        needed.
+        """
+        self.srid = srid
+        self.buffer = bytearray(size)
+        self.offset = 0
+
+    def _reserve(self, size):
+        needed = self.offset + size
+        if needed > len(self.buffer):
+            self.buffer.extend(bytes(max(needed, 2 * len(self.buffer)) - len(self.buffer)))
+
+    def _result(self):
+        data = bytes(self.buffer[:self.offset])
+        self.offset = 0
+        return data
+
+    def _header(self, geometry_type, z, top):
+        if z:
+            geometry_type |= Z_FLAG
+        self._reserve(_SRID_HEADER.size)
+        if top and self.srid is not None:
+            _SRID_HEADER.pack_into(self.buffer, self.offset, 1,
+                                   geometry_type | SRID_FLAG, self.srid)
+            self.offset += _SRID_HEADER.size
+        else:
+            _HEADER.pack_into(self.buffer, self.offset, 1, geometry_type)
+            self.offset += _HEADER.size
+
+    def _count(self, count):
+        self._reserve(_COUNT.size)
+        _COUNT.pack_into(self.buffer, self.offset, count)
+        self.offset += _COUNT.size
+
+    def _position(self, position, z):
+        if z:
+            self._reserve(_XYZ.size)
+            _XYZ.pack_into(self.buffer, self.offset, position[0], position[1],
+                           position[2] if len(position) > 2 else _NAN)
+            self.offset += _XYZ.size
+        elif position:
+            self._reserve(_XY.size)
+            _XY.pack_into(self.buffer, self.offset, position[0], position[1])
+            self.offset += _XY.size
+        else:
+            # an empty point
+            self._reserve(_XY.size)
+            _XY.pack_into(self.buffer, self.offset, _NAN, _NAN)
+            self.offset += _XY.size
+
+    def _positions(self, positions, z):
+        """
+        Write the number of positions followed by all of them at once.
+        """
+        if z:
+            values = [v for p in positions
+                      for v in (p[0], p[1], p[2] if len(p) > 2 else _NAN)]
+        elif all(len(p) == 2 for p in positions):
+            values = list(chain.from_iterable(positions))
+        else:
+            values = [v for p in positions for v in (p[0], p[1])]
+        size = 8 * len(values)
+        self._reserve(_COUNT.size + size)
+        _COUNT.pack_into(self.buffer, self.offset, len(positions))
+        struct.pack_into("<%dd" % len(values), self.buffer,
+                         self.offset + _COUNT.size, *values)
+        self.offset += _COUNT.size + size
+
+    def _rings(self, rings, z):
+        self._count(len(rings))
+        for ring in rings:
+            self._positions(ring, z)
+
+    def _geojson(self, geometry, z, top):
+        geometry_type = GEOJSON_TYPES[geometry["type"]]
+        self._header(geometry_type, z, top)
+        if geometry_type == GEOMETRYCOLLECTION:
+            parts = geometry["geometries"]
+            self._count(len(parts))
+            for part in parts:
+                self._geojson(part, z, False)
+            return
+        coordinates = geometry["coordinates"]
+        if geometry_type == POINT:
+            self._position(coordinates, z)
+        elif geometry_type == LINESTRING:
+            self._positions(coordinates, z)
+        elif geometry_type == POLYGON:
+            self._rings(coordinates, z)
+        else:
+            self._parts(geometry_type, coordinates, z)
+
+    def _parts(self, geometry_type, parts, z):
+        self._count(len(parts))
+        for part in parts:
+            # each part is a geometry of the corresponding single type
+            self._header(geometry_type - 3, z, False)
+            if geometry_type == MULTIPOINT:
+                self._position(part, z)
+            elif geometry_type == MULTILINESTRING:
+                self._positions(part, z)
+            else:
+                self._rings(part, z)
+
+    def geojson(self, geometry):
+        """
+        Encode a GeoJSON geometry (a dict). It has a Z coordinate if its first
+        position does; positions without one then get NaN.
+        """
+        self._geojson(geometry, has_z(geometry), True)
+        return self._result()
+
+    def point(self, x, y, z=None):
+        self._header(POINT, z is not None, True)
+        self._position((x, y) if z is None else (x, y, z), z is not None)
+        return self._result()
+
+    def linestring(self, positions, z=False):
+        """
+        Encode a line through positions, sequences of (x, y) or (x, y, z).
+        """
+        self._header(LINESTRING, z, True)
+        self._positions(positions, z)
+        return self._result()
+
+    def polygon(self, rings, z=False):
+        """
+        Encode a polygon from its rings, the first of which is the exterior.
+        """
+        self._header(POLYGON, z, True)
+        self._rings(rings, z)
+        return self._result()
+
+    def multi(self, geometry_type, parts, z=False):
+        """
+        Encode a MULTIPOINT, MULTILINESTRING or MULTIPOLYGON from the
+        positions, lines or rings of its parts.
+        """
+        self._header(geometry_type, z, True)
+        self._parts(geometry_type, parts, z)
+        return self._result()
+
+
+def from_geojson(geometry, srid=None):
+    """
+    Encode a GeoJSON geometry as EWKB.
+    """
+    return Writer(srid, 256).geojson(geometry)
+
+
+def point(x, y, z=None, srid=None):
+    """
+    Encode a point as EWKB.
+    """
+    return Writer(srid, 64).point(x, y, z)
+
+
+def points_hex(x, y, z=None, srid=None):
+    """
+    Encode many points as hex EWKB, packing them into one buffer that is
+    hex-encoded at once. A point whose x or y is NaN is None, and a point has a
+    Z coordinate if z is given and its z is not None.
+
+    :param sequence x: X coordinates.
+    :param sequence y: Y coordinates.
+    :param sequence z: Z coordinates (or None for every point).
+    """
+    if srid is None:
+        point, pointz = struct.Struct("<BI2d"), struct.Struct("<BI3d")
+        prefix, prefixz = (1, POINT), (1, POINT | Z_FLAG)
+    else:
+        point, pointz = struct.Struct("<BII2d"), struct.Struct("<BII3d")
+        prefix = (1, POINT | SRID_FLAG, srid)
+        prefixz = (1, POINT | Z_FLAG | SRID_FLAG, srid)
+    count = len(x)
+    data = bytearray(pointz.size * count)
+    offsets = []
+    offset = 0
+    for i in range(count):
+        if x[i] != x[i] or y[i] != y[i]:
+            offsets.append(None)
+        elif z is None or z[i] is None:
+            point.pack_into(data, offset, *prefix, x[i], y[i])
+            offsets.append((offset, offset + point.size))
+            offset += point.size
+        else:
+            pointz.pack_into(data, offset, *prefixz, x[i], y[i], z[i])
+            offsets.append((offset, offset + pointz.size))
+            offset += pointz.size
+    text = memoryview(data)[:offset].hex()
+    return [None if o is None else text[2 * o[0]:2 * o[1]] for o in offsets]
@@ -4,24 +4,281 @@ geocoding module.
 """
 
 from geofdw.base import *
+from geofdw.exception import OptionValueError
+from geofdw.gazetteer import open_gazetteer
+from geofdw.geocache import GeocodeCache, forward_key, reverse_key, to_locations
+from geofdw.ratelimit import Scheduler, get_bucket
+from collections import OrderedDict
+from functools import partial
+import os
+import re
 import geopy
-from plpygis import Geometry, Point
+import geopy.exc
+from plpygis import Geometry
+from geofdw.ewkb import Writer
+from geofdw.utils import map_unordered
+
+try:
+    from geopy.adapters import BaseSyncAdapter, RequestsAdapter
+except ImportError:  #pragma: no cover
+    # geopy < 2.0 makes its own requests
+    RequestsAdapter = None
+
+
+# errors reported when a request exceeds the quota of the service (geopy
+# only has GeocoderRateLimited from version 2.2) or fails temporarily
+_RATE_LIMITED = tuple(getattr(geopy.exc, name) for name in
+                      ["GeocoderRateLimited", "GeocoderQuotaExceeded"]
+                      if hasattr(geopy.exc, name))
+_TEMPORARY = (geopy.exc.GeocoderUnavailable, geopy.exc.GeocoderTimedOut)
+_RETRY_STATUS = re.compile(r"\b(429|5\d\d)\b|OVER_QUERY_LIMIT")
+
+# services whose forward lookups can be restricted to a bounding box
+_BOUNDED_SERVICES = ["googlev3", "local"]
+
+
+class _SessionRouter(object):
+    """
+    Sends each request to the pooled session for its host.
+    """
+
+    def __init__(self, get_session):
+        self.get_session = get_session
+
+    def get(self, url, **kwargs):
+        return self.get_session(url).get(url, **kwargs)
+
+
+if RequestsAdapter is not None:
+    class _PooledAdapter(RequestsAdapter):
+        """
+        A geopy adapter that uses the sessions shared by every wrapper (see
+        GeoFDW.get_session) instead of a session of its own, so connections
+        to the geocoding service are kept alive between queries and tables.
+        """
+
+        def __init__(self, get_session, proxies=None, ssl_context=None):
+            BaseSyncAdapter.__init__(self, proxies=proxies,
+                                     ssl_context=ssl_context)
+            self.session = _SessionRouter(get_session)
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            pass
+
+        def __del__(self):
+            pass
 
 
 class _Geocode(GeoFDW):
     def __init__(self, options, columns):
         super(_Geocode, self).__init__(options, columns, srid=4326)
+        self.writer = Writer(self.srid)
         self.service = options.get("service", "googlev3")
+        if self.service == "local":
+            self.geocoder = self._get_gazetteer()
+        else:
+            # the sessions are got from the worker threads of _lookup_many,
+            # which must not raise for an invalid option
+            self.get_pool_options()
+            self.geocoder = self._get_geocoder(options)
+        self.cache = self._get_cache()
+        self.scheduler = self._get_scheduler()
+        self.max_workers = self.get_option("max_workers", required=False,
+                                           default=4, option_type=int)
+        if self.max_workers < 1:
+            raise OptionValueError("max_workers must be positive")
+
+    def _get_scheduler(self):
+        """
+        Create the scheduler that limits the rate of requests and retries
+        failed ones from the options.
+        """
+        rate = self.get_option("rate_limit", required=False, option_type=float)
+        burst = self.get_option("rate_burst", required=False, default=1,
+                                option_type=int)
+        rate_dir = self.get_option("rate_dir", required=False)
+        retries = self.get_option("retries", required=False, default=3,
+                                  option_type=int)
+        backoff = self.get_option("retry_backoff", required=False,
+                                  default=1.0, option_type=float)
+        if (rate is not None and rate <= 0) or burst < 1:
+            raise OptionValueError("rate_limit and rate_burst must be positive")
+        if retries < 0 or backoff < 0:
+            raise OptionValueError("retries and retry_backoff must not be negative")
+        bucket = get_bucket(self.service, rate, burst, rate_dir)
+        return Scheduler(bucket, retries, backoff, retry_after=self._retry_after)
+
+    def _retry_after(self, error):
+        """
+        Decide whether a failed request should be retried: return None if
+        not, or the number of seconds the service asked us to wait (0 if it
+        did not say). This is called from the worker threads, so the retries
+        are only logged later, by _result.
+        """
+        if isinstance(error, _RATE_LIMITED):
+            return getattr(error, "retry_after", None) or 0
+        if isinstance(error, _TEMPORARY):
+            return 0
+        if isinstance(error, geopy.exc.GeocoderServiceError) and _RETRY_STATUS.search(str(error)):
+            return 0
+        return None
+
+    def _get_geocoder(self, options):
         geocoder = geopy.get_geocoder_for_service(self.service)
-        if geocoder == geopy.geocoders.googlev3.GoogleV3:
+        kwargs = {}
+        if RequestsAdapter is not None:
+            kwargs["adapter_factory"] = partial(_PooledAdapter, self.get_session)
+        # e.g. a self-hosted Nominatim, or geofdw.replay for testing
+        for name in ["domain", "scheme"]:
+            if name in options:
+                kwargs[name] = options[name]
+        if geocoder == geopy.geocoders.GoogleV3:
             api_key = options.get("api_key")
-            self.geocoder = geocoder(api_key=api_key)
-        elif geocoder == geopy.geocoders.arcgis.ArcGIS:
+            return geocoder(api_key=api_key, **kwargs)
+        elif geocoder == geopy.geocoders.ArcGIS:
             username = options.get("username")
             password = options.get("password")
-            self.geocoder = geocoder(username=username, password=password)
+            return geocoder(username=username, password=password, **kwargs)
         else:
-            self.geocoder = geocoder()
+            return geocoder(**kwargs)
+
+    def _get_gazetteer(self):
+        """
+        Open the gazetteer of the local service from the options.
+        """
+        path = self.get_local_path(self.get_option("gazetteer"))
+        index = self.get_option("gazetteer_index", required=False)
+        if index is not None:
+            index = self.get_local_path(index)
+        try:
+            return open_gazetteer(
+                path,
+                index=index,
+                name_column=self.get_option("name_column", required=False,
+                                            default="name"),
+                x_column=self.get_option("x_column", required=False),
+                y_column=self.get_option("y_column", required=False),
+                limit=self.get_option("limit", required=False, default=10,
+                                      option_type=int))
+        except (IOError, OSError, ValueError, KeyError) as e:
+            raise OptionValueError("Cannot read gazetteer '%s': %s" % (path, e))
+
+    def _get_cache(self):
+        """
+        Create the cache of results from the options, or return None if
+        caching is disabled.
+        """
+        # the local service answers faster than the cache would
+        default = 0 if self.service == "local" else 1000
+        entries = self.get_option("cache_entries", required=False,
+                                  default=default, option_type=int)
+        cache_dir = self.get_option("cache_dir", required=False)
+        ttl = self.get_option("cache_ttl", required=False, default=86400,
+                              option_type=int)
+        negative_ttl = self.get_option("cache_negative_ttl", required=False,
+                                       default=3600, option_type=int)
+        self.precision = self.get_option("cache_precision", required=False,
+                                         default=0.00001, option_type=float)
+        if entries < 0 or ttl < 0 or negative_ttl < 0 or self.precision <= 0:
+            raise OptionValueError("Cache options must be positive")
+        if entries == 0 and cache_dir is None:
+            return None
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, "geocode.sqlite")
+        return GeocodeCache(entries, ttl, negative_ttl, path)
+
+    def _lookup(self, key, lookup, description):
+        """
+        Return the locations cached under key, or call lookup to get them from
+        the geocoder and cache the result.
+        """
+        if self.cache is None:
+            return self._result(description, self._request(lookup))
+        locations = self.cache.get(key)
+        if locations is None:
+            locations = self._result(description, self._request(lookup))
+            self.cache.set(key, locations)
+        log_to_postgres("Geocode (%s): cache %s" % (self.service,
+                                                    self.cache.stats()), DEBUG)
+        return locations
+
+    def _lookup_many(self, items):
+        """
+        Look up several queries at once. Cached results are returned first,
+        then the remaining queries are sent to the geocoder from a pool of
+        max_workers threads, subject to the rate limit of the service. Queries
+        are only sent as the results are consumed, so a scan that stops early
+        does not look up the rest.
+
+        :param list items: (query, key, lookup, description) for each query,
+        as for _lookup; queries with the same key are only looked up once.
+        :return: Generator of (query, locations) in the order in which the
+        results arrive.
+        """
+        queries = OrderedDict()
+        lookups = {}
+        for query, key, lookup, description in items:
+            queries.setdefault(key, []).append(query)
+            lookups[key] = (lookup, description)
+
+        misses = []
+        for key in queries:
+            locations = self.cache.get(key) if self.cache else None
+            if locations is None:
+                misses.append(key)
+            else:
+                for query in queries[key]:
+                    yield query, locations
+
+        if misses:
+            # only the requests are sent from the worker threads; everything
+            # that logs (or raises) is done here
+            results = map_unordered(lambda key: self._request(lookups[key][0]),
+                                    misses, min(self.max_workers, len(misses)))
+            for key, outcome in results:
+                locations = self._result(lookups[key][1], outcome)
+                if self.cache:
+                    self.cache.set(key, locations)
+                for query in queries[key]:
+                    yield query, locations
+
+        if self.cache:
+            log_to_postgres("Geocode (%s): cache %s" % (self.service,
+                                                        self.cache.stats()), DEBUG)
+
+    def _request(self, lookup):
+        """
+        Call lookup through the scheduler, which waits for the rate limit and
+        retries it as needed. This is all that is done in the worker threads
+        of _lookup_many, so it neither logs nor raises, since PostgreSQL may
+        only be called from the main thread of the backend.
+
+        :return: (result, error, retried): the result of the lookup, or the
+        exception that its last attempt raised, and the exceptions of the
+        attempts that were retried.
+        """
+        retried = []
+        try:
+            return self.scheduler.call(lookup, retried), None, retried
+        except Exception as e:
+            return None, e, retried
+
+    def _result(self, description, outcome):
+        """
+        Log a lookup made by _request and return its locations, or raise the
+        exception that it failed with.
+        """
+        result, error, retried = outcome
+        log_to_postgres(description, DEBUG)
+        for e in retried:
+            if isinstance(e, _RATE_LIMITED):
+                log_to_postgres("Geocode (%s): rate limited, retrying" % self.service, DEBUG)
+            else:
+                log_to_postgres("Geocode (%s): %s, retrying" % (self.service, e), DEBUG)
+        if error is not None:
+            raise error
+        return to_locations(result)
 
     def get_path_keys(self):
         """
@@ -29,6 +286,17 @@ class _Geocode(GeoFDW):
         """
         return [("rank", 1), ("geom", 1), ("address", 1)]
 
+    def can_limit(self, limit, offset):
+        return True
+
+    def enforces(self, quals):
+        """
+        Every row has the query it was looked up for, so a single predicate
+        "query = ..." or "query = ANY(...)" is the only one that is enforced.
+        """
+        return (len(quals) == 1 and quals[0].field_name == "query" and
+                quals[0].operator in ["=", ("=", True)])
+
 
 class FGeocode(_Geocode):
     """
@@ -44,25 +312,66 @@ class FGeocode(_Geocode):
     def __init__(self, options, columns):
         """
         Create the table that uses GoogleV3 by default or one of the following
-        named geocoders: ArcGIS; GoogleV3; Nominatim.
+        named geocoders: ArcGIS; GoogleV3; Nominatim; Local (an offline
+        gazetteer, see geofdw.gazetteer).
 
         :param dict options: Options passed to the table creation.
-            service: 'arcgis', 'googlev3', 'nominatim'
+            service: 'arcgis', 'googlev3', 'nominatim', 'local'
             api_key: API key for GoogleV3 (optional)
             username: user name for ArcGIS (optional)
             password: password for ArcGIS (optional)
+            domain: host (and port) of the service, to use another server
+                than the public one (optional)
+            scheme: 'https' (default) or 'http' (optional)
+            gazetteer: CSV or GeoJSON file of places for Local (required
+                for Local), which must be inside one of the directories
+                listed in the GEOFDW_ALLOWED_DIRS environment variable of the
+                server
+            gazetteer_index: file in which the index of the gazetteer is
+                kept, so that it is only built once, also inside one of those
+                directories (optional)
+            name_column: column (or GeoJSON property) holding the name of a
+                place (default 'name')
+            x_column, y_column: CSV columns holding the coordinates of a
+                place (by default longitude/lon/lng/x and latitude/lat/y)
+            limit: maximum number of results from Local (default 10)
+            cache_entries: number of results cached in memory (default
+                1000, or 0 for Local; 0 to disable)
+            cache_dir: directory of an SQLite database in which results are
+                shared between sessions (optional)
+            cache_ttl: seconds for which a result is cached (default 86400)
+            cache_negative_ttl: seconds for which a query without any
+                result is cached (default 3600)
+            pool_size, timeout, compress: settings of the connections to the
+                service, which are shared by every table (see
+                GeoFDW.get_session)
+            rate_limit: maximum requests per second sent to the service
+                (default 1 for Nominatim, otherwise unlimited)
+            rate_burst: number of requests that may be sent at once (default
+                1)
+            rate_dir: directory in which the rate limit is shared with other
+                sessions (by default it applies to each session separately)
+            retries: number of times a request that was rate limited or hit a
+                temporary error (HTTP 429 or 5xx) is retried (default 3)
+            retry_backoff: seconds to wait before the first retry, doubling
+                with each retry (default 1)
+            max_workers: maximum number of concurrent requests when
+                several queries are looked up at once (default 4)
 
         :param list columns: Columns the user has specified in PostGIS.
         """
         super(FGeocode, self).__init__(options, columns)
 
-    def execute(self, quals, columns):
+    def execute(self, quals, columns, sortkeys=None, limit=None, offset=None):
         """
         Execute the query on the geocoder.
 
         :param list quals: List of predicates from the WHERE clause of the SQL
         statement. The geocoder expects that one of these predicates will be of
-        the form "query = 'Helsinki, Finland". Optionally, a bounding polygon
+        the form "query = 'Helsinki, Finland" or "query = ANY(ARRAY[...])"
+        (which is also how PostgreSQL passes "query IN (...)"); the queries
+        in an array are looked up concurrently and the rows of each are
+        returned as soon as its result arrives. Optionally, a bounding polygon
         can be used to influence the geocoder if it is supported; the following
         formats are recognised (and treated equivalently):
 
@@ -75,29 +384,49 @@ class FGeocode(_Geocode):
             PostgreSQL and not here.
 
         :param list columns: List of columns requested in the SELECT statement.
+        :param int limit, offset: LIMIT and OFFSET of the query, if they have
+            been pushed down and the query is the only predicate; no more
+            queries are then looked up than they need.
         """
+        limit, offset = self.get_limit(quals, limit, offset)
         query, bounds = self._get_predicates(quals)
 
-        if query:
-            return self._execute(columns, query, bounds)
+        if isinstance(query, list):
+            rows = self._execute_batch(columns, query, bounds)
+        elif query:
+            rows = self._execute(columns, query, bounds)
         else:
             return []
+        return self.limit_rows(rows, limit, offset)
 
     def _execute(self, columns, query, bounds=None):
+        return self._rows(columns, query, self._get_locations(query, bounds))
+
+    def _execute_batch(self, columns, queries, bounds=None):
+        if self.service not in _BOUNDED_SERVICES:
+            bounds = None
+        items = [(query, forward_key(self.service, query, bounds),
+                  partial(self._geocode, query, bounds),
+                  self._describe(query, bounds))
+                 for query in queries]
+        for query, locations in self._lookup_many(items):
+            for row in self._rows(columns, query, locations):
+                yield row
+
+    def _rows(self, columns, query, locations):
         rank = 0
         col_geom = "geom" in columns
         col_addr = "address" in columns
         col_query = "query" in columns
-        locations = self._get_locations(query, bounds)
 
         if locations:
             for location in locations:
                 rank = rank + 1
                 row = {"rank": rank}
                 if col_geom:
-                    geom = Point((location.longitude, location.latitude,
-                                  location.altitude), srid=self.srid)
-                    row["geom"] = geom
+                    row["geom"] = self.writer.point(
+                        location.longitude, location.latitude,
+                        location.altitude).hex()
                 if col_addr:
                     row["address"] = location.address
                 if col_query:
@@ -106,26 +435,32 @@ class FGeocode(_Geocode):
 
     def _get_predicates(self, quals):
         query = None
-        bounds = None
         for qual in quals:
             if qual.field_name == "query" and qual.operator == "=":
                 query = qual.value
+            elif qual.field_name == "query" and qual.operator == ("=", True):
+                query = [value for value in qual.value if value]
 
-            # note A ~ B is transformed into B @ A
-            if qual.field_name == "geom" and qual.operator in ["&&", "@"]:
-                bounds = Geometry(qual.value).bounds
-            elif qual.value == "geom" and qual.operator == "&&":
-                bounds = Geometry(qual.field_name).bounds
-
-        return query, bounds
+        return query, self.get_bounds(quals)
 
     def _get_locations(self, query, bounds):
-        log_to_postgres("Geocode (%s): running query '%s' with bounds = %s" %
-                        (self.service, query, str(bounds)), DEBUG)
-        if bounds and self.service == "googlev3":
-            return self.geocoder.geocode(query, False, bounds=(bounds[1], bounds[0], bounds[3], bounds[2]))
+        if self.service not in _BOUNDED_SERVICES:
+            # the bounds only influence the results of some services
+            bounds = None
+        return self._lookup(forward_key(self.service, query, bounds),
+                            lambda: self._geocode(query, bounds),
+                            self._describe(query, bounds))
+
+    def _describe(self, query, bounds):
+        return ("Geocode (%s): running query '%s' with bounds = %s" %
+                (self.service, query, str(bounds)))
+
+    def _geocode(self, query, bounds):
+        if bounds:
+            return self.geocoder.geocode(query, exactly_one=False,
+                                         bounds=(bounds[1], bounds[0], bounds[3], bounds[2]))
         else:
-            return self.geocoder.geocode(query, False)
+            return self.geocoder.geocode(query, exactly_one=False)
 
 
 class RGeocode(_Geocode):
@@ -133,7 +468,11 @@ class RGeocode(_Geocode):
     The RGeocode foreign data wrapper can do reverse geocoding using a number
     of online services. The following columns may exist in the table: query
     GEOMETRY(POINT, 4326), rank INTEGER, geom GEOMETRY(POINTZ, 4326), address
-    TEXT.
+    TEXT, point GEOMETRY(POINT, 4326).
+
+    The query may also be a MULTIPOINT, in which case every point in it is
+    looked up and the point column holds the point that each row is the
+    result for.
 
     Note that the geometry will be a 3d point with SRID 4326. At present, no
     supported geocoder returns a useful elevation (the GoogleV3 geocoder, for
@@ -143,65 +482,129 @@ class RGeocode(_Geocode):
     def __init__(self, options, columns):
         """
         Create the table that uses GoogleV3 by default or one of the following
-        named geocoders: ArcGIS; GoogleV3; Nominatim.
+        named geocoders: ArcGIS; GoogleV3; Nominatim; Local.
 
         :param dict options: Options passed to the table creation.
-            service: 'arcgis', 'googlev3', 'nominatim'
+            service: 'arcgis', 'googlev3', 'nominatim', 'local'
             api_key: API key for GoogleV3 (optional)
             username: user name for ArcGIS (optional)
             password: password for ArcGIS (optional)
+            domain, scheme: as for FGeocode
+            gazetteer, gazetteer_index, name_column, x_column, y_column: as
+                for FGeocode
+            cache_entries, cache_dir, cache_ttl, cache_negative_ttl: as for
+                FGeocode
+            cache_precision: points closer than this share results, both in
+                the cache and when several points are looked up at once
+                (default 0.00001)
+            pool_size, timeout, compress, rate_limit, rate_burst, rate_dir,
+                retries, retry_backoff, max_workers: as for FGeocode
 
         :param list columns: Columns the user has specified in PostGIS.
         """
         super(RGeocode, self).__init__(options, columns)
 
-    def execute(self, quals, columns):
+    def execute(self, quals, columns, sortkeys=None, limit=None, offset=None):
         """
         Execute the query on the geocoder.
 
         :param list quals: List of predicates from the WHERE clause of the SQL
         statement. The geocoder expects that one of these predicates will be of
-        the form "query = ST_MakePoint(0, 52)"
+        the form "query = ST_MakePoint(0, 52)", "query = ANY(ARRAY[...])" or
+        "query = ST_GeomFromText('MULTIPOINT(...)')". Points that snap to the
+        same cell of a grid with a spacing of cache_precision are looked up
+        only once, and the distinct points are looked up concurrently.
 
             Other predicates may be added, but they will be evaluated in
             PostgreSQL and not here.
 
         :param list columns: List of columns requested in the SELECT statement.
+        :param int limit, offset: LIMIT and OFFSET of the query, if they have
+            been pushed down and the query is the only predicate; no more
+            points are then looked up than they need.
         """
 
+        limit, offset = self.get_limit(quals, limit, offset)
         query = self._get_predicates(quals)
-        if query:
-            return self._execute(columns, query)
-        else:
+        if query is None:
             return []
+        elif isinstance(query, list):
+            rows = self._execute_batch(columns, query)
+        elif query[1].type == "MultiPoint":
+            rows = self._execute_batch(columns, [query])
+        else:
+            rows = self._execute(columns, query)
+        return self.limit_rows(rows, limit, offset)
 
     def _execute(self, columns, query):
+        return self._rows(columns, query, query[1], self._get_locations(query[1]))
+
+    def _execute_batch(self, columns, queries):
+        items = []
+        for query in queries:
+            geometry = query[1]
+            if geometry.type == "MultiPoint":
+                points = geometry.geometries
+            elif geometry.type == "Point":
+                points = [geometry]
+            else:
+                continue
+            for point in points:
+                key = reverse_key(self.service, point.x, point.y, self.precision)
+                items.append(((query, point), key, partial(self._reverse, point),
+                              self._describe(point)))
+        for (query, point), locations in self._lookup_many(items):
+            for row in self._rows(columns, query, point, locations):
+                yield row
+
+    def _rows(self, columns, query, point, locations):
+        """
+        Build the rows of the locations found for a point of a query, given
+        as (value, geometry); the query column returns the value of the qual
+        so that PostgreSQL finds it equal.
+        """
+        value, query = query
         rank = 0
         col_geom = "geom" in columns
         col_addr = "address" in columns
         col_query = "query" in columns
-        locations = self._get_locations(query)
+        col_point = "point" in columns
+        if col_point:
+            # the points of a MULTIPOINT do not carry its SRID
+            srid = self.srid if query.srid is None else query.srid
+            point = Writer(srid, 64).point(point.x, point.y).hex()
 
         for location in locations:
             rank = rank + 1
             row = {"rank": rank}
             if col_geom:
-                geom = Point((location.longitude, location.latitude,
-                              location.altitude), srid=self.srid)
-                row["geom"] = geom
+                row["geom"] = self.writer.point(
+                    location.longitude, location.latitude,
+                    location.altitude).hex()
             if col_addr:
                 row["address"] = location.address
             if col_query:
-                row["query"] = query.wkb
+                row["query"] = value
+            if col_point:
+                row["point"] = point
             yield row
 
     def _get_predicates(self, quals):
         for qual in quals:
             if qual.field_name == "query" and qual.operator == "=":
-                return Geometry(qual.value)
+                return qual.value, Geometry(qual.value)
+            elif qual.field_name == "query" and qual.operator == ("=", True):
+                return [(value, Geometry(value)) for value in qual.value if value]
         return None
 
     def _get_locations(self, query):
-        log_to_postgres("GeocodeR (%s): running query '%s'" % (self.service,
-                                                               query), DEBUG)
-        return self.geocoder.reverse([query.x, query.y])
+        key = reverse_key(self.service, query.x, query.y, self.precision)
+        return self._lookup(key, lambda: self._reverse(query),
+                            self._describe(query))
+
+    def _describe(self, query):
+        return "GeocodeR (%s): running query '%s'" % (self.service, query)
+
+    def _reverse(self, query):
+        # geopy and the gazetteer both take (latitude, longitude)
+        return self.geocoder.reverse([query.y, query.x])
@@ -2,11 +2,25 @@
 :class:`GeoJSON` is a GeoJSON foreign data wrapper.
 """
 
-from geofdw.base import GeoFDW
-from geofdw.exception import MissingColumnError, MissingOptionError, OptionTypeError
-from plpygis import Geometry
+from geofdw.base import GeoFDW, DEBUG
+from geofdw.cache import CachedResponse, FileResponse, HTTPCache
+from geofdw.index import HashIndex, RTree, geojson_bounds, hash_key, intersects
+from geofdw.snapshot import Snapshot, write_snapshot
+from geofdw.exception import MissingColumnError, MissingOptionError, OptionTypeError, OptionValueError
+from geofdw.stream import CHUNK_SIZE, GZIP_MAGIC, decompress, detect_format, iter_features, iter_sequence
+from geofdw.utils import local_path, to_bool
+from geofdw.ewkb import Writer
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count, islice
+from urllib.parse import urljoin
 import json
+import os
 import requests
+import zlib
+
+FORMATS = ["geojson", "geojsonseq"]
+PAGING = ["next", "offset"]
 
 
 class GeoJSON(GeoFDW):
@@ -15,6 +29,26 @@ class GeoJSON(GeoFDW):
     file. The following column will exist in the table: geom GEOMETRY.
     Additional columns may be specified.
 
+    Besides a single GeoJSON document, the file may be a GeoJSON text
+    sequence (RFC 8142) or newline-delimited GeoJSON, which is read one line
+    at a time, and either may be compressed with gzip.
+
+    The file may also be on the database server itself, given as a file://
+    URL or an absolute path, if it is inside one of the directories listed in
+    the GEOFDW_ALLOWED_DIRS environment variable of the server (separated by
+    colons); no local file may be read without it. It is memory-mapped and
+    parsed as it is read rather than copied into memory, and a snapshot of
+    it (and its indexes) is rebuilt whenever the file's size or modification
+    time changes.
+
+    Feature APIs that return their features a page at a time (such as OGC API
+    Features or ArcGIS REST) can be read with the paging option. The pages
+    are either followed through their links to the next page or requested by
+    offset, in which case several pages are fetched at once while the rows of
+    the current one are returned. A bounding box predicate is passed on to
+    the API in the parameters of each request, and so is the LIMIT of the
+    query when every predicate is one that the wrapper checks itself.
+
     Since column names in PostgreSQL are usually lowercase, so the wrapper will
     attempt case-insensitive matching between the column names and the
     attribute names in the GeoJSON file.
@@ -31,11 +65,44 @@ class GeoJSON(GeoFDW):
         options.
 
         :param dict options: Options passed to the table creation.
-            url: location of the GeoJSON file (required)
+            url: location of the GeoJSON file, which may be a file:// URL or
+                an absolute path on the database server within
+                GEOFDW_ALLOWED_DIRS (required)
             srid: custom SRID that overrides the 4326 default
             verify: set to false to ignore invalid SSL certificates
             user: user name for authentication
             pass: password for authentication
+            stream: set to true to parse the features as they are downloaded
+                rather than reading the whole file into memory first
+            format: geojson for a GeoJSON document or geojsonseq for a GeoJSON
+                text sequence or newline-delimited GeoJSON, which is always
+                streamed; by default it is detected from the Content-Type of
+                the response or the extension of the url
+            cache_dir: directory in which to cache the file between queries
+            cache_ttl: seconds for which a cached file is used before checking
+                whether it has changed (default 60)
+            cache_size: maximum size of the cache directory in MB
+            pool_size, timeout, compress: settings of the connections to the
+                server, which are shared by every table (see
+                GeoFDW.get_session)
+            snapshot: set to true to store the parsed features (as WKB and
+                typed attribute columns) alongside the cached file so that
+                later queries do not need to parse it again; requires
+                cache_dir
+            paging: next to follow the next links of each page (in its links
+                member, as in OGC API Features, or its Link header), or offset
+                to request the pages by offset, until numberMatched or
+                totalFeatures is reached or a page comes back short; paged
+                responses are not cached
+            page_size: number of features to request per page (default 1000)
+            prefetch: number of pages to fetch ahead of the rows being
+                returned (default 4); only one page can be fetched ahead when
+                following links
+            limit_param, offset_param, bbox_param: names of the request
+                parameters for the page size, the offset and the bounding box
+                (default limit, offset and bbox; for ArcGIS REST use
+                resultRecordCount, resultOffset and geometry); set bbox_param
+                to an empty string if the API has no bounding box parameter
 
         :param list columns: Columns the user has specified in PostGIS.
             geom (required)
@@ -45,58 +112,590 @@ class GeoJSON(GeoFDW):
         self.url = self.get_option("url")
         self.srid = self.get_option("srid", required=False, default=4326,
                                     option_type=int)
+        self.stream = self.get_option("stream", required=False, default=False,
+                                      option_type=to_bool)
+        self.format = self.get_option("format", required=False)
+        if self.format is not None and self.format not in FORMATS:
+            raise OptionValueError("format must be one of %s" % ", ".join(FORMATS))
+        self.writer = Writer(self.srid)
         self.get_request_options()
+        self.path = local_path(self.url)
+        if self.path is not None:
+            self.path = self.get_local_path(self.path)
+        self.session = None if self.path else self.get_session(self.url)
+        self.cache = self.get_cache()
+        self.snapshot = self.get_option("snapshot", required=False,
+                                        default=False, option_type=to_bool)
+        if self.snapshot and not self.cache:
+            raise OptionValueError("snapshot requires cache_dir")
+        self.paging = self.get_option("paging", required=False)
+        if self.paging is not None:
+            if self.paging not in PAGING:
+                raise OptionValueError("paging must be one of %s" % ", ".join(PAGING))
+            if self.snapshot or self.path:
+                raise OptionValueError("paging requires a remote url and no snapshot")
+        self.page_size = self.get_option("page_size", required=False,
+                                         default=1000, option_type=int)
+        self.prefetch = self.get_option("prefetch", required=False, default=4,
+                                        option_type=int)
+        if self.page_size < 1 or self.prefetch < 1:
+            raise OptionValueError("page_size and prefetch must be positive")
+        self.limit_param = self.get_option("limit_param", required=False,
+                                           default="limit")
+        self.offset_param = self.get_option("offset_param", required=False,
+                                            default="offset")
+        self.bbox_param = self.get_option("bbox_param", required=False,
+                                          default="bbox")
+        self.indexes = {}
+        self.path_rows = {}
 
-    def execute(self, quals, columns):
+    def execute(self, quals, columns, sortkeys=None, limit=None, offset=None):
         """
         Execute the query by reading the GeoJSON file and returning the
         contents based on the selected columns.
 
         :param list quals: List of predicates from the WHERE clause of the SQL
-        statement. All filtering will happen in PostgreSQL rather than in the
-        foreign data wrapper.
+        statement. A bounding polygon will be used to skip features whose
+        bounding boxes fall outside of it; the following formats are
+        recognised (and treated equivalently):
+
+                geom && ST_GeomFromText('POLYGON(...)')
+                ST_GeomFromText('POLYGON(...)') && geom
+                geom @ ST_GeomFromText('POLYGON(...)')
+                ST_GeomFromText('POLYGON(...)') ~ geom
+
+            Predicates on the other columns of the form "name = 'value'",
+            "name IN (...)", "name = ANY(...)" and "name IS NULL" will also be
+            used to skip features. Only when every predicate is of this form
+            are the LIMIT and OFFSET pushed down to the API or applied here.
+
+            When a snapshot is used, the features are found with an R-tree
+            that is built once for each version of the file and with hash
+            indexes that are built for each column the first time it is
+            queried. Other predicates may be added, but they will be evaluated
+            in PostgreSQL and not here.
 
         :param list columns: List of columns requested in the SELECT statement.
+        :param int limit: LIMIT of the query, if it has been pushed down; the
+            file is then always parsed as it is read, so that no more of it is
+            downloaded than the rows need.
+        :param int offset: OFFSET of the query, if it has been pushed down.
         """
+        stream = limit is not None
+        limit, offset = self.get_limit(quals, limit, offset)
+        undecided = []
+        rows = self._execute_query(quals, columns, limit, offset, stream,
+                                   undecided)
+        if limit is None and not offset:
+            return rows
+        return self._limit_rows(rows, limit, offset or 0, undecided)
+
+    def can_limit(self, limit, offset):
+        return True
+
+    def enforces(self, quals):
+        return all(self._get_filter(qual) is not None for qual in quals)
+
+    def _limit_rows(self, rows, limit, offset, undecided):
+        """
+        Apply a LIMIT and OFFSET to the rows for as long as the filters have
+        decided every one of them. Once a row that only PostgreSQL can
+        compare has been let through (see _match), the rows skipped for the
+        OFFSET are returned after all and no more rows are cut.
+        """
+        skipped = []
+        returned = 0
+        for row in rows:
+            if undecided:
+                for r in skipped:
+                    yield r
+                yield row
+                for row in rows:
+                    yield row
+                return
+            if len(skipped) < offset:
+                skipped.append(row)
+                continue
+            yield row
+            returned += 1
+            if limit is not None and returned >= limit:
+                return
+
+    def _execute_query(self, quals, columns, limit, offset, stream, undecided):
+        bounds = self.get_bounds(quals)
+        if bounds and (bounds[0] > bounds[2] or bounds[1] > bounds[3]):
+            return []
+        filters = self._get_filters(quals)
+
+        if self.paging:
+            if limit is not None:
+                limit += offset or 0
+            features = self._paged(bounds, limit)
+            if bounds or filters:
+                features = self._filter(features, bounds, filters, undecided)
+            return self._execute(features, columns)
+
         try:
-            response = requests.get(self.url, auth=self.auth,
-                                    verify=self.verify)
+            response = self._get()
         except requests.exceptions.ConnectionError as e:
             self.log("GeoJSON FDW: unable to connect to %s" % self.url)
             return []
         except requests.exceptions.Timeout as e:  #pragma: no cover
             self.log("GeoJSON FDW: timeout connecting to %s" % self.url)
             return []
+        except (IOError, OSError) as e:
+            if not self.path:
+                raise
+            self.log("GeoJSON FDW: unable to read %s" % self.url)
+            return []
 
+        parse = self._get_parser(response)
+        if self.snapshot and isinstance(response, CachedResponse):
+            snapshot = self._get_snapshot(response, parse)
+            if snapshot is None:
+                return []
+            rows = self._select(response, snapshot, bounds, filters, undecided)
+            return self._execute_snapshot(snapshot, columns, rows)
+
+        if self.stream or self.path or stream or parse is iter_sequence:
+            features = self._stream(response, parse)
+        else:
+            try:
+                data = self._read(response)
+            except ValueError as e:
+                self.log("GeoJSON FDW: invalid JSON")
+                return []
+            try:
+                features = data["features"]
+            except KeyError as e:
+                self.log("GeoJSON FDW: invalid GeoJSON")
+                return []
+        if bounds or filters:
+            features = self._filter(features, bounds, filters, undecided)
+        return self._execute(features, columns)
+
+    def get_path_keys(self):
+        """
+        Query planner helper. Without a snapshot, every lookup reads the
+        whole file, so none is offered. With one, the columns that have been
+        indexed can be used to look up features, and the average number of
+        features per value is reported.
+        """
+        if not self.snapshot:
+            return []
+        return [(col, rows) for col, rows in self.path_rows.items()
+                if col in self.columns]
+
+    def get_cache(self):
+        cache_dir = self.get_option("cache_dir", required=False)
+        if cache_dir is None:
+            return None
+        ttl = self.get_option("cache_ttl", required=False, default=60,
+                              option_type=int)
+        size = self.get_option("cache_size", required=False, option_type=int)
+        if size is not None:
+            size = size * 1024 * 1024
+        return HTTPCache(cache_dir, ttl=ttl, max_size=size)
+
+    def _get(self):
+        if self.path:
+            if self.cache:
+                return self.cache.local(self.path)
+            return FileResponse(self.path)
+        if not self.cache:
+            return self._fetch({})
+        user = self.auth[0] if self.auth else None
+        response = self.cache.get(self.url, self._fetch, variant=user)
+        if getattr(response, "from_cache", False):
+            self.log("GeoJSON FDW: using cached copy of %s" % self.url, DEBUG)
+        return response
+
+    def _fetch(self, headers):
+        return self.session.get(self.url, auth=self.auth, verify=self.verify,
+                                headers=headers, stream=True)
+
+    def _paged(self, bounds, limit):
+        """
+        Yield the features of each page in turn, fetching the following pages
+        in the background while those of the current one are consumed. The
+        first page only asks for limit features, and when it has enough of
+        them, nothing more is fetched unless the rows run out.
+        """
+        params = {}
+        if bounds and self.bbox_param:
+            params[self.bbox_param] = ",".join(repr(float(b)) for b in bounds)
+        size = self.page_size if limit is None else max(1, min(self.page_size, limit))
+        executor = ThreadPoolExecutor(max_workers=self.prefetch)
+        pending = deque()
         try:
-            data = response.json()
-        except ValueError as e:
+            if self.paging == "next":
+                pages = self._follow(executor, pending, params, size, limit)
+            else:
+                pages = self._offsets(executor, pending, params, size, limit)
+            for features in pages:
+                for feature in features:
+                    yield feature
+        except requests.exceptions.ConnectionError as e:
+            self.log("GeoJSON FDW: unable to connect to %s" % self.url)
+        except requests.exceptions.RequestException as e:
+            self.log("GeoJSON FDW: unable to fetch %s: %s" % (self.url, e))
+        except KeyError as e:
+            self.log("GeoJSON FDW: invalid GeoJSON")
+        except (ValueError, zlib.error) as e:
             self.log("GeoJSON FDW: invalid JSON")
-            return []
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _follow(self, executor, pending, params, size, limit):
+        """
+        Yield the pages found by following the next links, fetching each
+        page while the one before it is consumed (once limit features have
+        been received, only when it has been consumed).
+        """
+        params = dict(params)
+        params[self.limit_param] = size
+        pending.append(executor.submit(self._get_page, self.url, params))
+        received = 0
+        while pending:
+            features, link, total, more = pending.popleft().result()
+            received += len(features)
+            if not features:
+                link = None
+            if link and (limit is None or received < limit):
+                pending.append(executor.submit(self._get_page, link, None))
+                link = None
+            yield features
+            if link:
+                pending.append(executor.submit(self._get_page, link, None))
+
+    def _offsets(self, executor, pending, params, size, limit):
+        """
+        Yield the pages requested by offset, keeping prefetch pages in
+        flight. Without a total, pages are requested until one comes back
+        short (those fetched beyond it are discarded). A first page that is
+        shorter than asked for may just be capped by the server, so the
+        following pages are then requested with its length.
+        """
+        first = dict(params)
+        first[self.offset_param] = 0
+        first[self.limit_param] = size
+        features, link, total, more = self._get_page(self.url, first)
+        returned = len(features)
+        if not returned or (total is not None and total <= returned):
+            yield features
+            return
+        # the server may return fewer features than asked for
+        step = returned if returned < size else self.page_size
+        offsets = count(returned, step)
+        if total is not None:
+            offsets = iter(range(returned, total, step))
+
+        def fill():
+            for offset in islice(offsets, self.prefetch - len(pending)):
+                page = dict(params)
+                page[self.offset_param] = offset
+                page[self.limit_param] = step
+                pending.append(executor.submit(self._get_page, self.url, page))
+
+        if limit is None or returned < limit:
+            fill()
+        yield features
+        while True:
+            fill()
+            if not pending:
+                return
+            features, link, total, more = pending.popleft().result()
+            yield features
+            if total is None and not more and len(features) < step:
+                return
+
+    def _get_page(self, url, params):
+        """
+        Fetch one page and return its features, the URL of the next page (or
+        None), the total number of features (or None) and whether the server
+        reported that more features remain.
+        """
+        response = self.session.get(url, params=params, auth=self.auth,
+                                    verify=self.verify)
         try:
-            features = data["features"]
+            response.raise_for_status()
+            data = self._read(response)
+        finally:
+            response.close()
+        if not isinstance(data, dict):
+            raise KeyError("features")
+        link = response.links.get("next", {}).get("url")
+        for l in data.get("links") or []:
+            if l.get("rel") == "next" and l.get("href"):
+                link = l["href"]
+        if link:
+            link = urljoin(response.url, link)
+        total = data.get("numberMatched", data.get("totalFeatures"))
+        if not isinstance(total, int):
+            total = None
+        return data["features"], link, total, bool(data.get("exceededTransferLimit"))
+
+    def _get_parser(self, response):
+        """
+        Return the function that turns the chunks of the response into
+        features, according to the format option or else the format
+        detected from the response.
+        """
+        fmt = self.format
+        if fmt is None:
+            fmt = detect_format(self.url, response.headers.get("Content-Type"))
+        if fmt == "geojsonseq":
+            return iter_sequence
+        return iter_features
+
+    def _read(self, response):
+        """
+        Read and decode a whole GeoJSON document, decompressing it first if
+        it is gzipped.
+        """
+        data = response.content
+        if data[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+            try:
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            except zlib.error as e:
+                raise ValueError(str(e))
+        return json.loads(data)
+
+    def _chunks(self, response):
+        return decompress(response.iter_content(chunk_size=CHUNK_SIZE))
+
+    def _get_snapshot(self, response, parse):
+        path = self.cache.derived(response, "%d.ewkb.snapshot" % self.srid)
+        if not os.path.exists(path):
+            self.log("GeoJSON FDW: building snapshot of %s" % self.url, DEBUG)
+            try:
+                write_snapshot(path, parse(self._chunks(response)), self._encode)
+            except KeyError as e:
+                self.log("GeoJSON FDW: invalid GeoJSON")
+                return None
+            except (ValueError, zlib.error) as e:
+                self.log("GeoJSON FDW: invalid JSON")
+                return None
+        response.close()
+        return Snapshot(path)
+
+    def _get_filters(self, quals):
+        """
+        Collect the equality predicates on attribute columns as a list of
+        (column, keys, types, null) where keys is the set of matching values
+        (see hash_key), types is the set of their types and null is True if
+        NULL matches. Predicates on values without a key are left for
+        PostgreSQL to evaluate.
+        """
+        filters = [self._get_filter(qual) for qual in quals]
+        return [f for f in filters if f is not None]
+
+    def _get_filter(self, qual):
+        if qual.field_name == "geom" or qual.field_name not in self.columns:
+            return None
+        if qual.operator == "=":
+            values = [qual.value]
+        elif qual.operator == ("=", True):
+            # NULL never matches an element of an ANY array
+            values = [v for v in qual.value if v is not None]
+        else:
+            return None
+        keys = set(hash_key(v) for v in values if v is not None)
+        if None in keys:
+            return None
+        types = set(key[0] for key in keys)
+        return qual.field_name, keys, types, None in values
+
+    def _select(self, response, snapshot, bounds, filters, undecided):
+        rows = None
+        if bounds:
+            path = self.cache.derived(response, "%d.rtree" % self.srid)
+            if not os.path.exists(path):
+                self.log("GeoJSON FDW: building R-tree of %s" % self.url, DEBUG)
+                RTree.build(snapshot.boxes).save(path)
+            rtree = RTree.load(path)
+            try:
+                rows = rtree.search(*bounds)
+            finally:
+                rtree.close()
+
+        for col, keys, types, null in filters:
+            matches = self._lookup(snapshot, col, keys, null, undecided)
+            if rows is None:
+                rows = matches
+            else:
+                rows = sorted(set(rows).intersection(matches))
+            if not rows:
+                break
+
+        if rows is None:
+            return range(len(snapshot))
+        return rows
+
+    def _lookup(self, snapshot, col, keys, null, undecided):
+        reader = self._resolve(snapshot, col)
+        if reader is None:
+            # the column is null for every feature
+            return range(len(snapshot)) if null else []
+        index = self._get_index(snapshot, reader, col)
+        if not index.decides(keys):
+            undecided.append(col)
+        rows = index.lookup(keys)
+        if null:
+            rows = sorted(set(rows).union(index.nulls))
+        return rows
+
+    def _get_index(self, snapshot, reader, col):
+        """
+        Return the hash index of a snapshot column, building it if it is the
+        first time this version of the file has been queried on the column.
+        """
+        key = (snapshot.path, reader.name)
+        index = self.indexes.get(key)
+        if index is None:
+            # drop the indexes of older versions of the file
+            for old in [k for k in self.indexes if k[0] != snapshot.path]:
+                del self.indexes[old]
+            self.log("GeoJSON FDW: indexing column %s" % col, DEBUG)
+            index = self.indexes[key] = HashIndex(reader)
+            self.path_rows[col] = max(1, (index.count - len(index.others)) //
+                                      max(1, len(index)) + len(index.others))
+        return index
+
+    def _resolve(self, snapshot, col):
+        reader = snapshot.column(col)
+        if reader is None:
+            for name, candidate in snapshot.columns.items():
+                if col == name.lower():
+                    return candidate
+        return reader
+
+    def _filter(self, features, bounds, filters, undecided=None):
+        """
+        Yield the features that may match the bounds and the filters. Those
+        that only PostgreSQL can compare are noted in undecided.
+        """
+        for feat in features:
+            if bounds:
+                feat_bounds = geojson_bounds(feat.get("geometry"))
+                if not feat_bounds or not intersects(feat_bounds, bounds):
+                    continue
+            if filters:
+                match = self._match(feat.get("properties") or {}, filters)
+                if match is False:
+                    continue
+                if match is None and undecided is not None:
+                    undecided.append(feat)
+            yield feat
+
+    def _match(self, properties, filters):
+        """
+        Return True if the properties match the filters, False if they do
+        not, or None if some of them can only be compared by PostgreSQL.
+        """
+        match = True
+        for col, keys, types, null in filters:
+            value = properties.get(col)
+            if value is None:
+                for p in properties.keys():
+                    if col == p.lower():
+                        value = properties.get(p)
+                        break
+            if value is None:
+                if not null:
+                    return False
+            elif type(value) not in types:
+                # a value of another type is left for PostgreSQL to compare
+                match = None
+            elif hash_key(value) not in keys:
+                return False
+        return match
+
+    def _encode(self, gj):
+        if not gj:
+            return None
+        return self.writer.geojson(gj)
+
+    def _stream(self, response, parse=iter_features):
+        try:
+            for feature in parse(self._chunks(response)):
+                yield feature
         except KeyError as e:
             self.log("GeoJSON FDW: invalid GeoJSON")
-            return []
-        return self._execute(features, columns)
+        except (ValueError, zlib.error) as e:
+            self.log("GeoJSON FDW: invalid JSON")
+        finally:
+            response.close()
 
     def _execute(self, features, columns):
-        if "geom" in columns:
-            columns.remove("geom")
-            use_geom = True
-        else:
-            use_geom = False
+        use_geom = "geom" in columns
+        project = _Projection(columns)
         for feat in features:
-            row = {}
+            row = project(feat["properties"] or {})
             if use_geom:
-                gj = feat["geometry"]
-                geom = Geometry.from_geojson(gj, srid=self.srid)
-                row["geom"] = geom.wkb
-
-            properties = feat["properties"]
-            for p in properties.keys():
-                for col in columns:
-                    if col == p or col == p.lower():
-                        row[col] = properties.get(p)
-                        break
+                row["geom"] = self._encode(feat["geometry"])
             yield row
+
+    def _execute_snapshot(self, snapshot, columns, rows):
+        use_geom = "geom" in columns
+        readers = []
+        for col in columns:
+            if col == "geom":
+                continue
+            reader = self._resolve(snapshot, col)
+            if reader is not None:
+                readers.append((col, reader))
+
+        try:
+            for i in rows:
+                row = {}
+                if use_geom:
+                    row["geom"] = snapshot.wkb(i)
+                for col, reader in readers:
+                    row[col] = reader[i]
+                yield row
+        finally:
+            snapshot.close()
+
+
+class _Projection(object):
+    """
+    Map the properties of a feature onto the requested columns. Each property
+    goes to the first column with the same name as either the property or
+    its lowercase form (if several properties go to the same column, the
+    last one wins). The mapping is worked out once and reused for as long as
+    the features have the same set of property names, so that each row only
+    costs one dictionary lookup per column. Only when several properties
+    compete for a column does the order of the names have to match as well.
+    """
+
+    def __init__(self, columns):
+        self.columns = [col for col in columns if col != "geom"]
+        self.keys = None
+        self.ordered = False
+        self.plan = ()
+
+    def __call__(self, properties):
+        keys = tuple(properties) if self.ordered else properties.keys()
+        if keys != self.keys:
+            self._prepare(properties)
+        return {col: properties[p] for col, p in self.plan}
+
+    def _prepare(self, properties):
+        plan = {}
+        matches = 0
+        for p in properties:
+            lower = p.lower()
+            for col in self.columns:
+                if col == p or col == lower:
+                    plan[col] = p
+                    matches += 1
+                    break
+        self.ordered = matches > len(plan)
+        if self.ordered:
+            self.keys = tuple(properties)
+        else:
+            self.keys = frozenset(properties)
+        self.plan = tuple(plan.items())
@@ -4,15 +4,54 @@
 
 from geofdw.base import *
 import geopy
-from plpygis import Geometry, Point, LineString
+from plpygis import Geometry
+import operator
 import os
 from datetime import datetime, timezone
+from itertools import islice, repeat
 from dateutil import parser
-from requests import Session
 from requests.auth import HTTPBasicAuth
 from requests.exceptions import JSONDecodeError
+from geofdw.statecache import (ANONYMOUS_RESOLUTION, FIELDS, USER_RESOLUTION,
+                               StateColumns, get_bucket, get_state_cache)
+from geofdw.ewkb import Writer
+from geofdw.stream import CHUNK_SIZE, iter_features
+from geofdw.utils import map_unordered, to_bool
+import time
 OSURL = "https://opensky-network.org/api"
 
+# the longest interval in seconds that each flights endpoint accepts
+FLIGHT_WINDOWS = {
+    "all": 2 * 3600,
+    "aircraft": 2 * 86400,
+    "arrival": 2 * 86400,
+    "departure": 2 * 86400,
+}
+
+# columns of a flight and the fields of the API they come from
+FLIGHT_FIELDS = {
+    "icao24": "icao24",
+    "callsign": "callsign",
+    "departure": "estDepartureAirport",
+    "arrival": "estArrivalAirport",
+    "departure_distance": "estDepartureAirportHorizDistance",
+    "arrival_distance": "estArrivalAirportHorizDistance",
+}
+
+# time columns of a flight and the fields of the API they come from
+FLIGHT_TIMES = {
+    "first_seen": "firstSeen",
+    "last_seen": "lastSeen",
+}
+
+COMPARISONS = {
+    "=": operator.eq,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
 CATEGORY = {
     0  : "No information at all",
     1  : "No ADS-B Emitter Category Information",
@@ -42,9 +81,105 @@ class _OpenSky(GeoFDW):
         super(_OpenSky, self).__init__(options, columns, srid=4326)
         osuser = options.get("osuser", os.getenv("OPENSKY_USER"))
         ospass = options.get("ospass", os.getenv("OPENSKY_PASS"))
-        self.opensky = Session()
+        self.url = self.get_option("url", required=False, default=OSURL)
+        self.opensky = self.get_session(self.url)
         if osuser and ospass:
-            self.opensky.auth = HTTPBasicAuth(osuser, ospass)
+            self.auth = HTTPBasicAuth(osuser, ospass)
+        else:
+            self.auth = None
+        self.max_workers = self.get_option("max_workers", required=False,
+                                           default=4, option_type=int)
+        if self.max_workers < 1:
+            raise OptionValueError("max_workers must be positive")
+
+    def _get(self, path, params):
+        """
+        Return the decoded response of an endpoint of the API, or None if it
+        found nothing.
+        """
+        return self._decode(self._request(path, params))
+
+    def _request(self, path, params):
+        """
+        Send a request to an endpoint of the API and return the response, or
+        the exception raised in sending it. This is all that is done in the
+        worker threads of _map: it neither logs nor raises, since PostgreSQL
+        may only be called from the main thread of the backend.
+        """
+        try:
+            return self.opensky.get(f"{self.url}{path}", params=params,
+                                    auth=self.auth)
+        except Exception as e:
+            return e
+
+    def _decode(self, response):
+        """
+        Decode a response returned by _request, or raise the exception that
+        it returned instead.
+        """
+        if isinstance(response, Exception):
+            raise response
+        if response.status_code == 404:
+            log_to_postgres("OPENSKY {} not found".format(response.url), INFO)
+            return None
+        try: 
+            json = response.json()
+            log_to_postgres("OPENSKY {}".format(response.url), INFO)
+        except JSONDecodeError as e:
+            log_to_postgres("OPENSKY {}".format(response.text), ERROR)
+            raise e
+        return json
+
+    def _get_range(self, quals, fields):
+        """
+        Find the interval of time that the fields must be within according to
+        the quals (=, <, <=, > and >=, so that BETWEEN is recognised too).
+
+        :return: (begin, end) as epochs, either of which may be None.
+        """
+        begin = None
+        end = None
+        for qual in quals:
+            if qual.field_name not in fields or qual.value is None:
+                continue
+            if qual.operator not in ["=", "<", "<=", ">", ">="]:
+                continue
+            epoch = int(qual.value.replace(tzinfo=timezone.utc).timestamp())
+            if qual.operator in ["=", ">", ">="]:
+                begin = epoch if begin is None else max(begin, epoch)
+            if qual.operator in ["=", "<", "<="]:
+                end = epoch if end is None else min(end, epoch)
+        return begin, end
+
+    def _chunks(self, begin, end, window):
+        """
+        Split [begin, end] into intervals no longer than window seconds.
+        """
+        chunks = []
+        while True:
+            chunks.append((begin, min(begin + window, end)))
+            begin += window
+            if begin >= end:
+                return chunks
+
+    def _map(self, request, items):
+        """
+        Send the request of each item, given by request(item) as (path,
+        params), with up to max_workers requests at once over the pooled
+        session, and yield (item, decoded response) as they arrive. No more
+        than max_workers requests are sent ahead of the results consumed.
+        Only _request runs in the worker threads; the responses are decoded
+        (and any error logged or raised) here.
+        """
+        items = list(items)
+        send = lambda item: self._request(*request(item))
+        if len(items) < 2 or self.max_workers == 1:
+            responses = ((item, send(item)) for item in items)
+        else:
+            responses = map_unordered(send, items,
+                                      min(self.max_workers, len(items)))
+        for item, response in responses:
+            yield item, self._decode(response)
 
 
 class StateVector(_OpenSky):
@@ -58,6 +193,18 @@ class StateVector(_OpenSky):
         :param dict options: Options passed to the table creation.
             osuser: OpenSky user name
             ospass: OpenSky password
+            url: base URL of the API (default
+                https://opensky-network.org/api)
+            pool_size, timeout, compress: see GeoFDW.get_session
+            max_workers: maximum number of concurrent requests (default 4)
+            snapshot: set to true to fetch the state vectors of all aircraft
+                once per refresh window of the API and to filter them by
+                position and icao24 locally, so that queries made within the
+                same window do not send further requests
+            resolution: length of the refresh window in seconds (default 10,
+                or 5 with a user name and password)
+            cache_dir: directory in which to share the snapshots with other
+                sessions; implies snapshot
 
         :param list columns: Columns the user has specified in PostGIS.
             geom [POINTZ]: position of the airplane
@@ -66,19 +213,37 @@ class StateVector(_OpenSky):
             callsign [TEXT]
             origin_country [TEXT]
             baro_altitude [FLOAT]: barometric altitude
+            geo_altitude [FLOAT]: geometric altitude
             velocity [FLOAT]: measured in m/s
             true_track [FLOAT]: degrees clockwise from north
             vertical_rate [FLOAT]: measured in m/s
-            squakw [TEXT]: transponder code
+            squawk [TEXT]: transponder code
             spi [BOOLEAN]: whether flight status has a special purpose indicator
             on_ground [BOOLEAN]
             position_source [INTEGER]: 0=ADS-B, 1=ASTERIX, 2=MLAT, 3=FLARM
             category [INTEGER]: aircraft category
             category_text [TEXT]: aircraft category (description)
+            near [GEOMETRY]: a point to find the nearest aircraft to
+            distance [FLOAT]: distance in metres from the near point
         """
         super(StateVector, self).__init__(options, columns)
+        self.states = self.get_state_cache()
 
-    def execute(self, quals, columns):
+    def get_state_cache(self):
+        cache_dir = self.get_option("cache_dir", required=False)
+        snapshot = self.get_option("snapshot", required=False,
+                                   default=cache_dir is not None,
+                                   option_type=to_bool)
+        if not snapshot:
+            return None
+        default = USER_RESOLUTION if self.auth else ANONYMOUS_RESOLUTION
+        resolution = self.get_option("resolution", required=False,
+                                     default=default, option_type=float)
+        if resolution <= 0:
+            raise OptionValueError("resolution must be positive")
+        return get_state_cache(resolution, cache_dir)
+
+    def execute(self, quals, columns, sortkeys=None, limit=None, offset=None):
         """
         Execute the query.
 
@@ -96,16 +261,55 @@ class StateVector(_OpenSky):
             Other predicates may be added, but they will be evaluated in
             PostgreSQL and not server-side.
 
+            Given a point with near = ST_MakePoint(...), the aircraft with a
+            known position are returned nearest first, so that the nearest
+            aircraft can be found with ORDER BY distance LIMIT n without
+            reading the whole state set:
+
+                SELECT * FROM opensky
+                WHERE near = ST_SetSRID(ST_MakePoint(24.96, 60.32), 4326)
+                ORDER BY distance LIMIT 5
+
         :param list columns: List of columns requested in the SELECT statement.
+        :param list sortkeys: Order requested by the query (see can_sort).
+        :param int limit: LIMIT of the query, if it has been pushed down and
+            every predicate is on the time or the near point. Without a
+            snapshot, the state vectors are then decoded as they are
+            downloaded and the download stops once there are enough rows; with
+            one, only the positions of the rows returned are encoded.
+        :param int offset: OFFSET of the query, if it has been pushed down.
+        """
+        limit, offset = self.get_limit(quals, limit, offset)
+        time, epoch, icao24, bounds, near = self._get_predicates(quals)
+        rows = self._execute(columns, time, epoch, icao24, bounds, near,
+                             limit is not None)
+        return self.limit_rows(rows, limit, offset)
+
+    def can_limit(self, limit, offset):
+        return True
+
+    def enforces(self, quals):
+        """
+        Every row has the time and the near point of the predicates "time =
+        ..." and "near = ...", while the others are left to the API or
+        PostgreSQL.
         """
-        time, epoch, icao24, bounds = self._get_predicates(quals)
-        return self._execute(columns, time, epoch, icao24, bounds)
+        return all(qual.field_name in ["time", "near"] and qual.operator == "="
+                   for qual in quals)
+
+    def can_sort(self, sortkeys):
+        """
+        The rows are ordered by distance whenever there is a near point (and
+        otherwise the distance is always NULL).
+        """
+        return [key for key in sortkeys
+                if key.attname == "distance" and not key.is_reversed]
 
     def _get_predicates(self, quals):
         time = None
         epoch = None
         icao24 = None
-        bounds = None
+        near = None
         log_to_postgres("QUAL {}".format(quals), INFO)
         for qual in quals:
             if qual.field_name == "time" and qual.operator == "=":
@@ -116,75 +320,469 @@ class StateVector(_OpenSky):
                     icao24 = qual.value
                 elif qual.operator == ("=", True):
                     icao24 = qual.value
+            if qual.field_name == "near" and qual.operator == "=":
+                near = qual.value
+        return time, epoch, icao24, self.get_bounds(quals), near
 
-            # note A ~ B is transformed into B @ A
-            if qual.field_name == "geom" and qual.operator in ["&&", "@"]:
-                bounds = Geometry(qual.value).bounds
-            elif qual.value == "geom" and qual.operator == "&&":
-                bounds = Geometry(qual.field_name).bounds
-        return time, epoch, icao24, bounds
-
-    def _execute(self, columns, time, epoch, icao24, bounds=None):
-        if "category" in columns:
-            category = True
+    def _execute(self, columns, time, epoch, icao24, bounds=None, near=None,
+                 limited=False):
+        category = "category" in columns or "category_text" in columns
+        if self.states:
+            states = self._get_snapshot(epoch, category)
+            indices = states.select(icao24, bounds)
+        elif limited and near is None:
+            # decode the state vectors as they arrive, a batch at a time
+            params = self._get_params(epoch, icao24, bounds, category)
+            for batch in _batches(self._stream_states(params)):
+                for row in self._rows(StateColumns(batch), range(len(batch)),
+                                      columns, time):
+                    yield row
+            return
         else:
-            category = False
+            states = StateColumns(self._get_states(epoch, icao24, bounds,
+                                                   category=category))
+            indices = range(len(states))
+        if not indices: return
 
-        row = {}
-        states = self._get_states(epoch, icao24, bounds, category=category)
-        if not states: return []
+        if near is None:
+            if not limited:
+                for row in self._rows(states, indices, columns, time):
+                    yield row
+                return
+            for batch in _batches(iter(indices)):
+                for row in self._rows(states, batch, columns, time):
+                    yield row
+            return
 
-        for state in states:
-            row["icao24"] = state[0]
-            if time:
-                row["time"] = time.isoformat()
+        # rows are built in batches, which grow so that a small LIMIT only
+        # reads the nearest few aircraft
+        minx, miny, maxx, maxy = Geometry(near).bounds
+        selected = None if len(indices) == len(states) else set(indices)
+        nearest = ((d, i) for d, i in states.nearest((minx + maxx) / 2.0,
+                                                      (miny + maxy) / 2.0)
+                   if selected is None or i in selected)
+        for batch in _batches(nearest):
+            extra = {
+                "near": repeat(near, len(batch)),
+                "distance": [d for d, i in batch],
+            }
+            for row in self._rows(states, [i for d, i in batch], columns, time,
+                                  extra):
+                yield row
+
+    def _rows(self, states, indices, columns, time, extra=None):
+        extra = extra or {}
+        names = []
+        values = []
+        for name in columns:
+            if name in extra:
+                column = extra[name]
             else:
-                row["time"] = datetime.utcfromtimestamp(state[4])
-            if state[5] is not None and state[6] is not None:
-                if state[7] is None:
-                    geom = Point((state[5], state[6]), srid=self.srid)
-                else:
-                    geom = Point((state[5], state[6], state[13]), srid=self.srid)
-                row["geom"] = geom
-            row["callsign"] = state[1]
-            row["origin_country"] = state[2]
-            row["on_ground"] = state[8]
-            row["velocity"] = state[9]
-            row["true_track"] = state[10]
-            row["vertical_rate"] = state[11]
-            row["squawk"] = state[14]
-            row["spi"] = state[15]
-            row["position_source"] = state[16]
-            if category:
-                row["category"] = state[17]
-                row["category_text"] = CATEGORY.get(state[17], None)
-            yield row
+                column = self._get_column(states, indices, name, time)
+            if column is not None:
+                names.append(name)
+                values.append(column)
+        if not names:
+            for i in indices:
+                yield {}
+            return
+        for row in zip(*values):
+            yield dict(zip(names, row))
+
+    def _get_column(self, states, indices, name, time):
+        """
+        Return the values of a column for the selected state vectors, or None
+        if the column is not known.
+        """
+        if name == "time":
+            if time:
+                return repeat(time.isoformat(), len(indices))
+            return [datetime.utcfromtimestamp(t) for t in
+                    self._select(states.column("last_contact"), indices)]
+        if name == "category_text":
+            return [CATEGORY.get(c, None) for c in
+                    self._select(states.column("category"), indices)]
+        if name == "geom":
+            return states.geometries(self.srid, indices)
+        if name in FIELDS:
+            return self._select(states.column(name), indices)
+        return None
+
+    def _select(self, values, indices):
+        if len(indices) == len(values):
+            return values
+        return [values[i] for i in indices]
 
     def _get_states(self, epoch, icao24, bounds, category):
+        params = self._get_params(epoch, icao24, bounds, category)
+        return self._fetch(params).get("states")
+
+    def _get_params(self, epoch, icao24, bounds, category):
         params = {}
         if category:
             params["extended"] = 1
         if bounds:
             params["lomin"] = bounds[0]
-            params["lomax"] = bounds[1]
-            params["lamin"] = bounds[2]
+            params["lamin"] = bounds[1]
+            params["lomax"] = bounds[2]
             params["lamax"] = bounds[3]
         if epoch:
             params["time"] = epoch
         if icao24:
             params["icao24"] = icao24
+        return params
 
-        response = self.opensky.get(f"{OSURL}/states/all", params=params)
-        try: 
-            json = response.json()
+    def _stream_states(self, params):
+        """
+        Yield the state vectors of /states/all as they are read from the
+        response, which is only read as far as they are taken.
+        """
+        response = self.opensky.get(f"{self.url}/states/all", params=params,
+                                    auth=self.auth, stream=True)
+        try:
+            if response.status_code == 404:
+                log_to_postgres("OPENSKY {} not found".format(response.url), INFO)
+                return
             log_to_postgres("OPENSKY {}".format(response.url), INFO)
-        except JSONDecodeError as e:
-            log_to_postgres("OPENSKY {}".format(response.text), ERROR)
-            raise e
-        return json.get("states")
+            chunks = response.iter_content(chunk_size=CHUNK_SIZE)
+            try:
+                for state in iter_features(chunks, "states"):
+                    yield state
+            except KeyError as e:
+                return
+            except ValueError as e:
+                log_to_postgres("OPENSKY invalid response from {}".format(response.url), ERROR)
+        finally:
+            response.close()
+
+    def _get_snapshot(self, epoch, category):
+        """
+        Return the state vectors of all aircraft at epoch (or now), as
+        StateColumns, from the snapshot of the refresh window that contains
+        it.
+        """
+        resolution = self.states.resolution
+        params = {}
+        if category:
+            params["extended"] = 1
+        if epoch:
+            bucket = get_bucket(epoch, resolution)
+            params["time"] = int(bucket * resolution)
+        else:
+            bucket = get_bucket(time.time(), resolution)
+        snapshot = self.states.get(bucket, category,
+                                   lambda: self._fetch(params))
+        log_to_postgres("OPENSKY snapshot {}: {}".format(
+            bucket, self.states.stats()), DEBUG)
+        return snapshot
+
+    def _fetch(self, params):
+        return self._get("/states/all", params) or {}
+
+    def get_path_keys(self):
+        """
+        Query planner helper.
+        """
+        return [("geom", 100), ("time", 10), ("icao24", 1), ("near", 10000)]
+
+
+def _batches(items):
+    """
+    Split items into lists that start small and double up to 1024, so that a
+    small LIMIT only builds the first few rows while a full scan still builds
+    them in large batches.
+    """
+    size = 16
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+        size = min(2 * size, 1024)
+
+
+class Flights(_OpenSky):
+    """
+    """
+
+    def __init__(self, options, columns):
+        """
+        Create a table containing the flights seen during an interval of time.
+
+        :param dict options: Options passed to the table creation.
+            osuser, ospass, url, pool_size, timeout, compress, max_workers: as
+                for StateVector
+
+        :param list columns: Columns the user has specified in PostGIS.
+            icao24 [TEXT]: the transponder address
+            callsign [TEXT]
+            first_seen [TIMESTAMP]: time the aircraft was first seen
+            last_seen [TIMESTAMP]: time the aircraft was last seen
+            departure [TEXT]: ICAO code of the estimated departure airport
+            arrival [TEXT]: ICAO code of the estimated arrival airport
+            departure_distance [INTEGER]: horizontal distance in metres from
+                the departure airport when the aircraft was first seen
+            arrival_distance [INTEGER]: horizontal distance in metres from the
+                arrival airport when the aircraft was last seen
+        """
+        super(Flights, self).__init__(options, columns)
+
+    def execute(self, quals, columns, sortkeys=None, limit=None, offset=None):
+        """
+        Execute the query.
+
+        :param list quals: List of predicates from the WHERE clause of the SQL
+        statement. The interval of time is given by comparisons of first_seen
+        or last_seen with a TIMESTAMP, e.g.
+
+                first_seen BETWEEN '2024-01-01' AND '2024-01-02'
+
+            and is required (without an upper bound it ends now). The flights
+            of an aircraft (icao24 = ...) or of an airport (departure = ... or
+            arrival = ...) may be looked up instead of all flights. The
+            interval is split into the longest intervals accepted by the API,
+            which are fetched concurrently; rows are returned as each interval
+            arrives.
+
+            The comparisons of first_seen and last_seen are also checked
+            here; other predicates are evaluated in PostgreSQL.
+
+        :param list columns: List of columns requested in the SELECT statement.
+        :param int limit, offset: LIMIT and OFFSET of the query, if they have
+            been pushed down and every predicate is a comparison of
+            first_seen or last_seen; intervals are then only fetched until
+            there are enough rows.
+        """
+        limit, offset = self.get_limit(quals, limit, offset)
+        rows = self._execute(quals, columns)
+        return self.limit_rows(rows, limit, offset)
+
+    def can_limit(self, limit, offset):
+        return True
+
+    def enforces(self, quals):
+        return all(self._get_check(qual) is not None for qual in quals)
+
+    def _get_check(self, qual):
+        """
+        Return the comparison of a qual as (field, compare, epoch) if it is
+        on first_seen or last_seen, or None.
+        """
+        field = FLIGHT_TIMES.get(qual.field_name)
+        compare = COMPARISONS.get(qual.operator) if isinstance(qual.operator, str) else None
+        if field is None or compare is None or qual.value is None:
+            return None
+        return field, compare, qual.value.replace(tzinfo=timezone.utc).timestamp()
+
+    def _execute(self, quals, columns):
+        checks = [check for check in map(self._get_check, quals) if check]
+        begin, end = self._get_range(quals, ["first_seen", "last_seen"])
+        if begin is None:
+            self.log("OpenSky FDW: flights require a lower bound on first_seen or last_seen", ERROR)
+            return
+        if end is None:
+            end = int(time.time())
+        if begin > end:
+            return
+        endpoint, params = self._get_endpoint(quals)
+        seen = set()
+        for flights in self.get_flights(endpoint, params, begin, end):
+            for flight in flights:
+                key = (flight.get("icao24"), flight.get("firstSeen"))
+                if key in seen:
+                    continue
+                if not all(flight.get(field) is not None and compare(flight[field], epoch)
+                           for field, compare, epoch in checks):
+                    continue
+                seen.add(key)
+                yield self._row(flight, columns)
+
+    def _get_endpoint(self, quals):
+        for qual in quals:
+            if qual.operator != "=":
+                continue
+            if qual.field_name == "icao24":
+                return "aircraft", {"icao24": qual.value.lower()}
+            if qual.field_name == "departure":
+                return "departure", {"airport": qual.value.upper()}
+            if qual.field_name == "arrival":
+                return "arrival", {"airport": qual.value.upper()}
+        return "all", {}
+
+    def get_flights(self, endpoint, params, begin, end):
+        """
+        Yield the lists of flights found by /flights/<endpoint> for each
+        interval within [begin, end], as they arrive.
+        """
+        def request(chunk):
+            return "/flights/%s" % endpoint, dict(params, begin=chunk[0], end=chunk[1])
+
+        chunks = self._chunks(begin, end, FLIGHT_WINDOWS[endpoint])
+        for chunk, flights in self._map(request, chunks):
+            yield flights or []
+
+    def _row(self, flight, columns):
+        row = {}
+        for name in columns:
+            if name == "first_seen":
+                row[name] = datetime.utcfromtimestamp(flight["firstSeen"])
+            elif name == "last_seen":
+                row[name] = datetime.utcfromtimestamp(flight["lastSeen"])
+            elif name in FLIGHT_FIELDS:
+                row[name] = flight.get(FLIGHT_FIELDS[name])
+        return row
+
+    def get_path_keys(self):
+        """
+        Query planner helper.
+        """
+        return [("icao24", 10), ("departure", 100), ("arrival", 100)]
+
+
+class Track(_OpenSky):
+    """
+    """
+
+    def __init__(self, options, columns):
+        """
+        Create a table containing the tracks of aircraft.
+
+        :param dict options: Options passed to the table creation.
+            osuser, ospass, url, pool_size, timeout, compress, max_workers: as
+                for StateVector
+
+        :param list columns: Columns the user has specified in PostGIS.
+            geom [LINESTRINGZ]: path of the aircraft, with the barometric
+                altitude as Z if it is known at every point
+            icao24 [TEXT]: the transponder address
+            time [TIMESTAMP]: a time during the flight
+            callsign [TEXT]
+            start_time [TIMESTAMP]: time of the first point of the track
+            end_time [TIMESTAMP]: time of the last point of the track
+        """
+        super(Track, self).__init__(options, columns)
+        self.writer = Writer(self.srid)
+
+    def execute(self, quals, columns, sortkeys=None, limit=None, offset=None):
+        """
+        Execute the query.
+
+        :param list quals: List of predicates from the WHERE clause of the SQL
+        statement. The icao24 (TEXT) of the aircraft is required, and may be a
+        list (icao24 = ANY(...)). Without a time, the current track of each
+        aircraft is returned; with time = TIMESTAMP, the track of the flight at
+        that time; and with a range of times (e.g. time BETWEEN ... AND ...),
+        the tracks of all the flights that started in that range, which are
+        looked up through the flights of the aircraft. The flights and tracks
+        are fetched concurrently and rows are returned as each track arrives.
+
+        :param list columns: List of columns requested in the SELECT statement.
+        :param int limit, offset: LIMIT and OFFSET of the query; they are
+            not pushed down, since the predicates are only checked by the API
+            and PostgreSQL, but tracks are still only fetched as the rows are
+            read.
+        """
+        limit, offset = self.get_limit(quals, limit, offset)
+        rows = self._execute(quals, columns)
+        return self.limit_rows(rows, limit, offset)
+
+    def _execute(self, quals, columns):
+        icao24 = None
+        at = None
+        for qual in quals:
+            if qual.field_name == "icao24":
+                if qual.operator == "=":
+                    icao24 = [qual.value]
+                elif qual.operator == ("=", True):
+                    icao24 = qual.value
+            if qual.field_name == "time" and qual.operator == "=":
+                at = qual.value
+        if not icao24:
+            self.log("OpenSky FDW: tracks require an icao24", ERROR)
+            return
+        icao24 = [i.lower() for i in icao24]
+
+        if at is not None:
+            epoch = int(at.replace(tzinfo=timezone.utc).timestamp())
+            tracks = self._map(lambda i: self._track_request(i, epoch), icao24)
+            for i, track in tracks:
+                if track:
+                    yield self._track_row(track, columns, at.isoformat())
+            return
+
+        begin, end = self._get_range(quals, ["time"])
+        if begin is None and end is None:
+            tracks = self._map(lambda i: self._track_request(i, 0), icao24)
+            for i, track in tracks:
+                if track:
+                    yield self._track_row(track, columns)
+            return
+        if begin is None:
+            self.log("OpenSky FDW: tracks require a lower bound on time", ERROR)
+            return
+        if end is None:
+            end = int(time.time())
+
+        searches = [(i, chunk) for i in icao24
+                    for chunk in self._chunks(begin, end, FLIGHT_WINDOWS["aircraft"])]
+
+        def request(search):
+            i, chunk = search
+            return "/flights/aircraft", {"icao24": i, "begin": chunk[0], "end": chunk[1]}
+
+        seen = set()
+        for search, flights in self._map(request, searches):
+            starts = []
+            for flight in flights or []:
+                key = (flight["icao24"], flight["firstSeen"])
+                if key not in seen and begin <= flight["firstSeen"] <= end:
+                    seen.add(key)
+                    starts.append(key)
+            # the time of each row is the start of its flight, so that it
+            # satisfies the range
+            tracks = self._map(lambda key: self._track_request(*key), starts)
+            for (i, start), track in tracks:
+                if track:
+                    yield self._track_row(track, columns,
+                                          datetime.utcfromtimestamp(start))
+
+    def _track_request(self, icao24, epoch):
+        return "/tracks/all", {"icao24": icao24, "time": epoch}
+
+    def _track_row(self, track, columns, at=None):
+        row = {}
+        for name in columns:
+            if name == "geom":
+                row[name] = self._linestring(track.get("path") or [])
+            elif name == "time":
+                if at is not None:
+                    row[name] = at
+                else:
+                    row[name] = datetime.utcfromtimestamp(track["startTime"])
+            elif name == "start_time":
+                row[name] = datetime.utcfromtimestamp(track["startTime"])
+            elif name == "end_time":
+                row[name] = datetime.utcfromtimestamp(track["endTime"])
+            elif name in ["icao24", "callsign"]:
+                row[name] = track.get(name)
+        return row
+
+    def _linestring(self, path):
+        """
+        Build the track from its waypoints, (time, latitude, longitude,
+        baro_altitude, true_track, on_ground).
+        """
+        path = [p for p in path if p[1] is not None and p[2] is not None]
+        if len(path) < 2:
+            return None
+        if all(p[3] is not None for p in path):
+            vertices = [(p[2], p[1], p[3]) for p in path]
+            return self.writer.linestring(vertices, z=True).hex()
+        vertices = [(p[2], p[1]) for p in path]
+        return self.writer.linestring(vertices).hex()
 
     def get_path_keys(self):
         """
         Query planner helper.
         """
-        return [("geom", 100), ("time", 10), ("icao24", 1)]
+        return [("icao24", 1)]
@@ -1,11 +1,35 @@
 from geofdw.base import GeoFDW
+from geofdw import ewkb
 from geofdw.exception import OptionValueError
-from plpygis import Point
 import random
+import struct
+
+try:
+  import numpy
+  from geofdw import sampler
+except ImportError:  #pragma: no cover
+  numpy = None
+  sampler = None
+
+BATCH_SIZE = 10000
 
 class RandomPoint(GeoFDW):
   """
-  The RandomPoint foreign data wrapper creates a number of random points.
+  The RandomPoint foreign data wrapper creates a number of random points (or
+  other random geometries).
+
+  Geometries are generated in batches and encoded directly as hex EWKB
+  without creating a geometry object for each row. If NumPy is installed,
+  each batch is generated and encoded with vectorized operations and other
+  distributions and geometry types can be chosen (see geofdw.sampler);
+  without it only uniformly distributed points are available.
+
+  Each batch has its own random number generator, keyed by the seed and the
+  number of the batch (with NumPy, a counter-based Philox generator whose
+  counter starts at the batch number). The batches can therefore be split
+  into shards that are generated independently, for example by several
+  sessions each inserting one shard, and the shards together always contain
+  the same geometries as the whole table, whatever the number of shards.
   """
   def __init__(self, options, columns):
     """
@@ -13,31 +37,210 @@ class RandomPoint(GeoFDW):
     single column geom of type GEOMETRY(POINT).
 
     :param dict options: Options passed to the table creation.
-      min_x: Minimum value for x (required)
-      min_y: Minimum value for y (required)
-      max_x: Maximum value for x (required)
-      max_y: Maximum value for y (required)
+      min_x: Minimum value for x (required unless distribution is polygon)
+      min_y: Minimum value for y (required unless distribution is polygon)
+      max_x: Maximum value for x (required unless distribution is polygon)
+      max_y: Maximum value for y (required unless distribution is polygon)
       num: Number of points
       srid: SRID of the points
+      batch_size: Number of points generated at a time (default 10000)
+      seed: Seed for the random number generator, for reproducible results
+        (the same seed and batch size give the same points in any number of
+        shards, but different points with and without NumPy)
+      distribution: 'uniform' (default), 'gaussian', 'poisson_disk' or
+        'polygon', each of which takes further options
+      geometry: 'point' (default), 'linestring' or 'polygon'
+      num_shards: Number of shards into which the batches are split (default
+        1); requires a seed if greater than 1
+      shard: Shard to generate, from 0 to num_shards - 1 (default all)
 
      :param list columns:
        geom (required)
+       shard, num_shards (optional): INTEGER columns that hold the shard of
+         each row; the predicates "shard = 2 AND num_shards = 4" select a
+         shard at query time instead of with the options
     """
     super(RandomPoint, self).__init__(options, columns)
     self.check_columns(["geom"])
-    self.min_x = self.get_option("min_x", option_type=float)
-    self.min_y = self.get_option("min_y", option_type=float)
-    self.max_x = self.get_option("max_x", option_type=float)
-    self.max_y = self.get_option("max_y", option_type=float)
+    self.distribution = self.get_option("distribution", required=False, default="uniform")
+    self.geometry = self.get_option("geometry", required=False, default="point")
+    bbox = self.distribution != "polygon"
+    self.min_x = self.get_option("min_x", required=bbox, option_type=float)
+    self.min_y = self.get_option("min_y", required=bbox, option_type=float)
+    self.max_x = self.get_option("max_x", required=bbox, option_type=float)
+    self.max_y = self.get_option("max_y", required=bbox, option_type=float)
     self.num = self.get_option("num", required=False, default=1, option_type=int)
     self.srid = self.get_option("srid", required=False, option_type=int)
+    self.batch_size = self.get_option("batch_size", required=False, default=BATCH_SIZE, option_type=int)
+    self.seed = self.get_option("seed", required=False, option_type=int)
+    self.shard = self.get_option("shard", required=False, option_type=int)
+    self.num_shards = self.get_option("num_shards", required=False, default=1, option_type=int)
 
-    if self.max_x <= self.min_x or self.max_y <= self.min_y:
+    if bbox and (self.max_x <= self.min_x or self.max_y <= self.min_y):
       raise OptionValueError("min must be smaller than max")
+    if self.batch_size < 1:
+      raise OptionValueError("batch_size must be positive")
+    if self.num_shards < 1:
+      raise OptionValueError("num_shards must be positive")
+    if self.shard is not None and not 0 <= self.shard < self.num_shards:
+      raise OptionValueError("shard must be between 0 and num_shards - 1")
+
+    if numpy:
+      self.sampler = sampler.get_sampler(self.distribution, self)
+      if not bbox:
+        if self.srid is None:
+          self.srid = self.sampler.srid
+        if self.min_x is None:
+          self.min_x, self.min_y, self.max_x, self.max_y = self.sampler.bounds
+      self.encoder = sampler.get_encoder(self.geometry, self)
+    elif self.distribution != "uniform" or self.geometry != "point":
+      raise OptionValueError("NumPy is required for distribution '%s' and geometry '%s'" %
+                             (self.distribution, self.geometry))
+    self._check_shards(self.num_shards)
+
+  def execute(self, quals, columns, sortkeys=None, limit=None, offset=None):
+    """
+    Generate the geometries of the selected shards.
+
+    :param list quals: List of predicates from the WHERE clause of the SQL
+    statement. Predicates of the form "shard = 2" and "num_shards = 4"
+    override the options; other predicates are evaluated in PostgreSQL.
+
+    :param list columns: List of columns requested in the SELECT statement.
+    :param int limit: LIMIT of the query, if it has been pushed down; when
+    every predicate is on the shards, only the geometries up to it are
+    encoded (they are the same geometries as without it).
+    :param int offset: OFFSET of the query, if it has been pushed down.
+    """
+    limit, offset = self.get_limit(quals, limit, offset)
+    needed = None if limit is None else limit + (offset or 0)
+    rows = self._execute(quals, columns, needed)
+    return self.limit_rows(rows, limit, offset)
+
+  def can_limit(self, limit, offset):
+    return True
+
+  def enforces(self, quals):
+    """
+    The predicates "shard = ..." and "num_shards = ..." are the only ones
+    that every row satisfies.
+    """
+    return all(qual.field_name in ["shard", "num_shards"] and qual.operator == "="
+               for qual in quals)
+
+  def _execute(self, quals, columns, needed):
+    shard, num_shards = self._get_shards(quals)
+    if num_shards is None:
+      return
+    self._check_shards(num_shards)
+    col_shard = "shard" in columns
+    col_num_shards = "num_shards" in columns
+    for k, batches in self._shards(shard, num_shards, needed):
+      for batch in batches:
+        for ewkb in batch:
+          row = { "geom" : ewkb }
+          if col_shard:
+            row["shard"] = k
+          if col_num_shards:
+            row["num_shards"] = num_shards
+          yield row
+
+  def _get_shards(self, quals):
+    """
+    Find the shard and the number of shards to generate. If the predicates
+    cannot be satisfied, the number of shards is None.
+    """
+    shard = self.shard
+    num_shards = self.num_shards
+    shard_quals = [qual.value for qual in quals
+                   if qual.field_name == "shard" and qual.operator == "="]
+    num_shards_quals = [qual.value for qual in quals
+                        if qual.field_name == "num_shards" and qual.operator == "="]
+    if shard_quals or num_shards_quals:
+      if len(set(shard_quals)) > 1 or len(set(num_shards_quals)) > 1:
+        return None, None
+      shard = shard_quals[0] if shard_quals else None
+      num_shards = num_shards_quals[0] if num_shards_quals else self.num_shards
+      if shard is not None and not 0 <= shard < num_shards:
+        return None, None
+    return shard, num_shards
+
+  def _check_shards(self, num_shards):
+    if num_shards > 1:
+      if self.seed is None:
+        raise OptionValueError("seed is required to split the geometries into shards")
+      if numpy and not self.sampler.shardable:
+        raise OptionValueError("distribution '%s' cannot be split into shards" % self.distribution)
+
+  def _shards(self, shard, num_shards, needed=None):
+    """
+    Yield each selected shard with its batches. The batches are divided into
+    num_shards contiguous ranges, so the shards in order form the whole
+    table. If only the first needed geometries are needed, the batches stop
+    there.
+    """
+    batches = -(-self.num // self.batch_size)
+    if numpy:
+      if self.seed is None:
+        key = numpy.random.SeedSequence().generate_state(2, numpy.uint64)
+      else:
+        key = numpy.random.SeedSequence(self.seed).generate_state(2, numpy.uint64)
+      self.sampler.reset(self._numpy_rng(key, 0, 1))
+    shards = range(num_shards) if shard is None else [shard]
+    for k in shards:
+      if needed is not None and needed <= 0:
+        return
+      first = k * batches // num_shards
+      last = (k + 1) * batches // num_shards
+      if numpy:
+        yield k, self._numpy_batches(key, first, last, needed)
+      else:
+        yield k, self._python_batches(first, last, needed)
+      if needed is not None:
+        needed -= sum(self._size(batch) for batch in range(first, last))
+
+  def _size(self, batch):
+    return min(self.batch_size, self.num - batch * self.batch_size)
+
+  def _numpy_rng(self, key, batch, stream=0):
+    # the counter is incremented from its lowest word, which no batch can
+    # overflow, so every batch (and the set up of the sampler, on a stream of
+    # its own) draws from a sequence that never overlaps another
+    return numpy.random.Generator(numpy.random.Philox(key=key, counter=[0, 0, stream, batch]))
+
+  def _numpy_batches(self, key, first, last, needed=None):
+    generated = first * self.batch_size
+    for batch in range(first, last):
+      if needed is not None and needed <= 0:
+        return
+      rng = self._numpy_rng(key, batch)
+      x, y = self.sampler.sample(rng, self._size(batch))
+      if not len(x):
+        self.log("RandomPoint FDW: only %d geometries could be generated" % generated)
+        return
+      generated += len(x)
+      # the whole batch is sampled so that it is the same with and without a
+      # limit, but only the geometries that are needed are encoded
+      yield self.encoder.encode(rng, x, y, needed)
+      if needed is not None:
+        needed -= len(x)
 
-  def execute(self, quals, columns):
-    for i in range(self.num):
-      x = random.uniform(self.min_x, self.max_x)
-      y = random.uniform(self.min_y, self.max_y)
-      point = Point((x, y), srid=self.srid)
-      yield { "geom" : point }
+  def _python_batches(self, first, last, needed=None):
+    header = ewkb.header(ewkb.POINT, self.srid).hex()
+    pack = struct.Struct("<dd").pack
+    for batch in range(first, last):
+      size = self._size(batch)
+      if needed is not None:
+        if needed <= 0:
+          return
+        # the points are drawn one after another, so the first few are the
+        # same as in the whole batch
+        size = min(size, needed)
+        needed -= size
+      if self.seed is None:
+        rng = random.Random()
+      else:
+        rng = random.Random("%d/%d" % (self.seed, batch))
+      yield [header + pack(rng.uniform(self.min_x, self.max_x),
+                           rng.uniform(self.min_y, self.max_y)).hex()
+             for i in range(size)]
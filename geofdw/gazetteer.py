@@ -0,0 +1,426 @@
+"""
+An offline geocoder backed by a gazetteer of place names and coordinates.
+
+The gazetteer is read from a CSV or GeoJSON file and indexed for both kinds of
+lookup:
+
+- forward lookups use an inverted index from normalised name tokens to
+  places, which also answers prefix queries (the sorted list of tokens is
+  searched with bisect) and, for tokens that match nothing else, approximate
+  queries through an index of the trigrams of each token;
+- reverse lookups use a KD-tree of the coordinates, stored as flat arrays in
+  the order of an implicit balanced tree.
+
+The index can be saved to a file so that it is only built once for each
+version of the gazetteer. The file holds a JSON header with the names and
+tokens followed by the arrays of the index, so that reading it never runs
+any code:
+
+    MAGIC | header length (uint64) | header JSON | arrays...
+"""
+
+import copy
+import csv
+import heapq
+import json
+import math
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import unicodedata
+from array import array
+from bisect import bisect_left
+
+from geofdw.geocache import Location
+from geofdw.index import geojson_bounds
+
+# score of a token matched exactly, by prefix and (at most) by trigrams
+EXACT = 1.0
+PREFIX = 0.8
+FUZZY = 0.6
+
+MIN_PREFIX = 3
+MIN_SIMILARITY = 0.4
+MAX_PREFIXES = 100
+
+_X_COLUMNS = ["longitude", "lon", "lng", "long", "x"]
+_Y_COLUMNS = ["latitude", "lat", "y"]
+_TOKEN = re.compile(r"\w+")
+_VERSION = 2
+
+MAGIC = b"GFDWGAZ2"
+_HEADER = struct.Struct("<8sQ")
+# typecodes of the arrays of a saved index (see Gazetteer._arrays)
+_ARRAYS = "ddIIIIII"
+
+
+def tokenize(text):
+    """
+    Split text into lower case tokens without accents.
+    """
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return _TOKEN.findall(text)
+
+
+def trigrams(token):
+    """
+    The set of trigrams of a token, padded so that short tokens have some.
+    """
+    padded = "  %s " % token
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def read_places(path, name_column="name", x_column=None, y_column=None):
+    """
+    Read (name, x, y) for each place in a CSV or GeoJSON file. The
+    coordinates of a GeoJSON feature that is not a point are the centre of its
+    bounding box. Places without a name or coordinates are skipped.
+    """
+    if path.lower().endswith((".json", ".geojson")):
+        with open(path, encoding="utf-8") as f:
+            features = json.load(f)["features"]
+        for feature in features:
+            name = (feature.get("properties") or {}).get(name_column)
+            bounds = geojson_bounds(feature.get("geometry"))
+            if name and bounds:
+                yield (str(name), (bounds[0] + bounds[2]) / 2.0,
+                       (bounds[1] + bounds[3]) / 2.0)
+        return
+
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        fields = dict((field.lower(), field) for field in reader.fieldnames or [])
+        x_column = x_column or next((fields[c] for c in _X_COLUMNS if c in fields), None)
+        y_column = y_column or next((fields[c] for c in _Y_COLUMNS if c in fields), None)
+        for column in [name_column, x_column, y_column]:
+            if column not in (reader.fieldnames or []):
+                raise ValueError("%s has no column %s" % (path, column))
+        for row in reader:
+            try:
+                x = float(row[x_column])
+                y = float(row[y_column])
+            except (TypeError, ValueError):
+                continue
+            if row[name_column]:
+                yield row[name_column], x, y
+
+
+class Gazetteer(object):
+    """
+    An index of named places. Its geocode and reverse methods follow the
+    interface of the geopy geocoders, and return geofdw.geocache.Location
+    tuples.
+    """
+
+    def __init__(self, places, limit=10):
+        """
+        :param iterable places: (name, x, y) for each place.
+        :param int limit: Maximum number of results of a forward lookup.
+        """
+        self.limit = limit
+        self.names = []
+        self.x = array("d")
+        self.y = array("d")
+        self.lengths = array("I")
+        postings = {}
+        for name, x, y in places:
+            i = len(self.names)
+            self.names.append(name)
+            self.x.append(x)
+            self.y.append(y)
+            tokens = set(tokenize(name))
+            self.lengths.append(len(tokens))
+            for token in tokens:
+                postings.setdefault(token, array("I")).append(i)
+
+        self.tokens = sorted(postings)
+        self.postings = [postings[token] for token in self.tokens]
+        self.trigrams = {}
+        for t, token in enumerate(self.tokens):
+            for trigram in trigrams(token):
+                self.trigrams.setdefault(trigram, array("I")).append(t)
+        self._build_tree()
+
+    def _build_tree(self):
+        """
+        Sort the places into a KD-tree: the median of each range (split
+        alternately by x and y) is its root and the ranges before and after
+        it are its subtrees.
+        """
+        self.tree = array("I", range(len(self.names)))
+        stack = [(0, len(self.tree), 0)]
+        while stack:
+            start, end, axis = stack.pop()
+            if end - start <= 1:
+                continue
+            coords = self.x if axis == 0 else self.y
+            self.tree[start:end] = array("I", sorted(self.tree[start:end],
+                                                     key=coords.__getitem__))
+            middle = (start + end) // 2
+            stack.append((start, middle, 1 - axis))
+            stack.append((middle + 1, end, 1 - axis))
+
+    def geocode(self, query, exactly_one=True, bounds=None):
+        """
+        Find the places whose names best match query. Each token of the query
+        contributes to the score of a place by how well it matches one of the
+        tokens of the name of the place: exactly, as a prefix or by sharing
+        trigrams. Places with the same score are ranked by how few other
+        tokens they have.
+
+        The tokens are processed from the rarest to the most common. Once the
+        places found so far are certain to outscore any place that only
+        matches the remaining tokens, those tokens are only used to update the
+        scores of the places already found, so the long lists of places that
+        have common tokens are not read.
+
+        :param str query: The name to look up.
+        :param bool exactly_one: Return only the best match.
+        :param tuple bounds: Optional (south, west, north, east) that a place
+        must be within.
+        """
+        count = 1 if exactly_one else self.limit
+        words = [list(self._match(word)) for word in tokenize(query)]
+        words.sort(key=lambda matches: sum(len(self.postings[t]) for t, score in matches))
+        tops = [max([score for t, score in matches] or [0]) for matches in words]
+        scores = {}
+        for w, matches in enumerate(words):
+            remaining = sum(tops[w:])
+            if len(scores) >= count and heapq.nlargest(count, scores.values())[-1] > remaining:
+                for i in scores:
+                    best = 0
+                    for t, score in matches:
+                        if score > best and self._contains(self.postings[t], i):
+                            best = score
+                    scores[i] += best
+                continue
+            best = {}
+            for t, score in matches:
+                for i in self.postings[t]:
+                    if best.get(i, 0) < score:
+                        best[i] = score
+            for i, score in best.items():
+                if i in scores:
+                    scores[i] += score
+                elif not bounds or self._within(i, bounds):
+                    scores[i] = score
+        ranked = heapq.nsmallest(count, scores.items(),
+                                 key=lambda item: (-item[1], self.lengths[item[0]], item[0]))
+        locations = [self._location(i) for i, score in ranked]
+        if exactly_one:
+            return locations[0] if locations else None
+        return locations
+
+    def _contains(self, posting, i):
+        j = bisect_left(posting, i)
+        return j < len(posting) and posting[j] == i
+
+    def _within(self, i, bounds):
+        south, west, north, east = bounds
+        return west <= self.x[i] <= east and south <= self.y[i] <= north
+
+    def _match(self, word):
+        """
+        Yield (token number, score) for the tokens that match word.
+        """
+        i = bisect_left(self.tokens, word)
+        if i < len(self.tokens) and self.tokens[i] == word:
+            yield i, EXACT
+            i += 1
+            found = True
+        else:
+            found = False
+        if len(word) >= MIN_PREFIX:
+            end = min(i + MAX_PREFIXES, len(self.tokens))
+            while i < end and self.tokens[i].startswith(word):
+                yield i, PREFIX
+                found = True
+                i += 1
+        if found:
+            return
+        grams = trigrams(word)
+        shared = {}
+        for trigram in grams:
+            for t in self.trigrams.get(trigram, ()):
+                shared[t] = shared.get(t, 0) + 1
+        for t, count in shared.items():
+            similarity = count / float(len(grams) + len(trigrams(self.tokens[t])) - count)
+            if similarity >= MIN_SIMILARITY:
+                yield t, FUZZY * similarity
+
+    def reverse(self, query, exactly_one=True, limit=None):
+        """
+        Find the places nearest to a point. Distances are measured in degrees
+        with longitude scaled by the cosine of the latitude.
+
+        :param tuple query: (latitude, longitude) of the point.
+        :param bool exactly_one: Return only the nearest place.
+        :param int limit: Number of places to return if not exactly_one
+        (by default the limit of the gazetteer).
+        """
+        lat, lon = float(query[0]), float(query[1])
+        scale = math.cos(math.radians(lat))
+        k = 1 if exactly_one else (limit or self.limit)
+        nearest = []  # max-heap of (-distance, place)
+        x, y, tree = self.x, self.y, self.tree
+        stack = [(0, len(tree), 0, 0.0)]
+        while stack:
+            start, end, axis, bound = stack.pop()
+            if start >= end or (len(nearest) == k and bound >= -nearest[0][0]):
+                continue
+            middle = (start + end) // 2
+            i = tree[middle]
+            dx = (x[i] - lon) * scale
+            dy = y[i] - lat
+            d = dx * dx + dy * dy
+            if len(nearest) < k:
+                heapq.heappush(nearest, (-d, i))
+            elif d < -nearest[0][0]:
+                heapq.heapreplace(nearest, (-d, i))
+            diff = dx if axis == 0 else dy
+            before = (start, middle, 1 - axis)
+            after = (middle + 1, end, 1 - axis)
+            near, far = (before, after) if diff > 0 else (after, before)
+            # the far side is searched last and only if it can be closer
+            stack.append(far + (diff * diff,))
+            stack.append(near + (0.0,))
+        locations = [self._location(i) for d, i in sorted(nearest, reverse=True)]
+        if exactly_one:
+            return locations[0] if locations else None
+        return locations
+
+    def _location(self, i):
+        return Location(self.names[i], self.y[i], self.x[i], 0.0)
+
+    def _arrays(self):
+        """
+        The arrays of the index, with the postings and the trigrams each
+        joined into one array and split again by an array of lengths.
+        """
+        trigrams = list(self.trigrams.values())
+        return [self.x, self.y, self.lengths, self.tree,
+                array("I", [len(p) for p in self.postings]),
+                array("I", [i for p in self.postings for i in p]),
+                array("I", [len(t) for t in trigrams]),
+                array("I", [i for t in trigrams for i in t])]
+
+    def save(self, path, source=None):
+        """
+        Write the index to path, replacing any existing file atomically.
+
+        :param source: Identifies the gazetteer the index was built from; it
+        must be serialisable as JSON.
+        """
+        arrays = self._arrays()
+        header = json.dumps({
+            "version": _VERSION,
+            "source": source,
+            "byteorder": sys.byteorder,
+            "names": self.names,
+            "tokens": self.tokens,
+            "trigrams": list(self.trigrams),
+            "itemsize": array("I").itemsize,
+            "sizes": [len(a) for a in arrays],
+        }).encode("utf-8")
+        directory = os.path.dirname(path) or "."
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(_HEADER.pack(MAGIC, len(header)))
+                f.write(header)
+                for a in arrays:
+                    a.tofile(f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path, source=None):
+        """
+        Read an index written by save, or return None if it does not exist,
+        is not valid or was built from a different gazetteer.
+        """
+        try:
+            with open(path, "rb") as f:
+                magic, length = _HEADER.unpack(f.read(_HEADER.size))
+                if magic != MAGIC:
+                    return None
+                header = json.loads(f.read(length).decode("utf-8"))
+                if (header["version"] != _VERSION or
+                        header["source"] != json.loads(json.dumps(source)) or
+                        header["byteorder"] != sys.byteorder or
+                        header["itemsize"] != array("I").itemsize or
+                        len(header["sizes"]) != len(_ARRAYS)):
+                    return None
+                arrays = []
+                for typecode, size in zip(_ARRAYS, header["sizes"]):
+                    a = array(typecode)
+                    a.fromfile(f, size)
+                    arrays.append(a)
+        except (IOError, OSError, EOFError, struct.error, ValueError,
+                KeyError, TypeError):
+            return None
+        if (sum(arrays[4]) != len(arrays[5]) or sum(arrays[6]) != len(arrays[7]) or
+                len(header["names"]) != len(arrays[0])):
+            return None
+        x, y, lengths, tree, posting_lengths, postings, trigram_lengths, tokens = arrays
+        gazetteer = cls.__new__(cls)
+        gazetteer.limit = 10
+        gazetteer.names = header["names"]
+        gazetteer.x, gazetteer.y = x, y
+        gazetteer.lengths = lengths
+        gazetteer.tree = tree
+        gazetteer.tokens = header["tokens"]
+        gazetteer.postings = _split(postings, posting_lengths)
+        gazetteer.trigrams = dict(zip(header["trigrams"],
+                                      _split(tokens, trigram_lengths)))
+        return gazetteer
+
+
+def _split(values, lengths):
+    """
+    Split an array into consecutive arrays of the given lengths.
+    """
+    parts = []
+    start = 0
+    for length in lengths:
+        parts.append(values[start:start + length])
+        start += length
+    return parts
+
+
+_gazetteers = {}
+_gazetteers_lock = threading.Lock()
+
+
+def open_gazetteer(path, index=None, name_column="name", x_column=None,
+                   y_column=None, limit=10):
+    """
+    Return the gazetteer in path. The index is shared by every table in this
+    process that uses the same file, and if index is given, it is read from
+    (or, the first time, written to) that file. The gazetteer is indexed
+    again whenever the file changes.
+    """
+    stat = os.stat(path)
+    source = (os.path.abspath(path), stat.st_mtime, stat.st_size,
+              name_column, x_column, y_column)
+    with _gazetteers_lock:
+        gazetteer = _gazetteers.get(source)
+        if gazetteer is None:
+            gazetteer = index and Gazetteer.load(index, source)
+            if gazetteer is None:
+                gazetteer = Gazetteer(read_places(path, name_column, x_column, y_column))
+                if index:
+                    gazetteer.save(index, source)
+            for key in [key for key in _gazetteers if key[0] == source[0]]:
+                del _gazetteers[key]
+            _gazetteers[source] = gazetteer
+    # the copy shares the index but has its own limit
+    gazetteer = copy.copy(gazetteer)
+    gazetteer.limit = limit
+    return gazetteer
@@ -0,0 +1,156 @@
+"""
+Cache of geocoding results, kept in memory and optionally in an SQLite
+database shared between PostgreSQL backends.
+
+Results are stored as lists of Location tuples under a key that identifies
+the lookup (see forward_key and reverse_key). An empty list records that a
+lookup found nothing, so that queries without a result are not sent to the
+geocoder again either; these negative results can be given a shorter
+lifetime than positive ones.
+"""
+
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict, namedtuple
+
+Location = namedtuple("Location", ["address", "latitude", "longitude", "altitude"])
+
+
+def forward_key(service, query, bounds=None):
+    """
+    Key of a forward lookup. Queries that differ only in case or whitespace
+    share a key.
+    """
+    query = " ".join(query.split()).casefold()
+    return json.dumps(["forward", service, query, bounds and list(bounds)])
+
+
+def reverse_key(service, x, y, precision):
+    """
+    Key of a reverse lookup. Coordinates are snapped to a grid with a spacing
+    of precision, so that points closer together than that share a key.
+    """
+    return json.dumps(["reverse", service, int(round(x / precision)),
+                       int(round(y / precision))])
+
+
+def to_locations(result):
+    """
+    Convert the result of a geopy geocoder (None, a Location or a list of
+    them) into a list of Location tuples.
+    """
+    if result is None:
+        return []
+    if not isinstance(result, list):
+        result = [result]
+    return [Location(r.address, r.latitude, r.longitude, r.altitude) for r in result]
+
+
+class GeocodeCache(object):
+    """
+    A two-level cache of geocoding results: a least recently used cache in
+    memory in front of an optional SQLite database. Entries found in the
+    database are copied into memory.
+
+    The numbers of hits in memory and in the database and of misses are
+    counted so that they can be reported.
+    """
+
+    def __init__(self, entries=1000, ttl=86400, negative_ttl=3600, path=None):
+        """
+        :param int entries: Maximum number of entries held in memory (0 to
+        use only the database).
+        :param int ttl: Number of seconds for which a result is used.
+        :param int negative_ttl: Number of seconds for which an empty result is
+        used.
+        :param str path: Location of the SQLite database, or None to keep
+        results only in memory.
+        """
+        self.entries = entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.path = path
+        self.memory = OrderedDict()
+        self.db = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Return the list of Location tuples cached under key, or None if there
+        is no current entry.
+        """
+        now = time.time()
+        entry = self.memory.get(key)
+        if entry is not None:
+            expires, locations = entry
+            if expires > now:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return locations
+            del self.memory[key]
+
+        if self.path is not None:
+            row = self._connect().execute(
+                "SELECT expires, locations FROM geocode WHERE key = ?",
+                (key,)).fetchone()
+            if row is not None and row[0] > now:
+                locations = [Location(*l) for l in json.loads(row[1])]
+                self._remember(key, row[0], locations)
+                self.disk_hits += 1
+                return locations
+
+        self.misses += 1
+        return None
+
+    def set(self, key, locations):
+        """
+        Cache a list of Location tuples under key.
+        """
+        ttl = self.ttl if locations else self.negative_ttl
+        expires = time.time() + ttl
+        self._remember(key, expires, locations)
+        if self.path is not None:
+            db = self._connect()
+            db.execute("INSERT OR REPLACE INTO geocode VALUES (?, ?, ?)",
+                       (key, expires, json.dumps(locations)))
+            db.execute("DELETE FROM geocode WHERE expires <= ?", (time.time(),))
+
+    def stats(self):
+        """
+        Describe the hits and misses so far.
+        """
+        return "%d hits (%d memory, %d disk), %d misses" % (
+            self.memory_hits + self.disk_hits, self.memory_hits,
+            self.disk_hits, self.misses)
+
+    def _remember(self, key, expires, locations):
+        if self.entries < 1:
+            return
+        self.memory[key] = (expires, locations)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.entries:
+            self.memory.popitem(last=False)
+
+    def _connect(self):
+        if self.db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # several backends may write at once, so wait for their locks
+            self.db = sqlite3.connect(self.path, timeout=30,
+                                      isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS geocode "
+                            "(key TEXT PRIMARY KEY, expires REAL, locations TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS geocode_expires "
+                            "ON geocode (expires)")
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,280 @@
+"""
+Indexes used to answer query predicates inside the wrappers.
+"""
+
+import math
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+from bisect import bisect_right
+
+NODE_SIZE = 16
+
+_MAGIC = b"GFDWRTR1"
+_HEADER = struct.Struct("<8sIQI")
+
+
+def geojson_bounds(geometry):
+    """
+    Return the bounding box (minx, miny, maxx, maxy) of a GeoJSON geometry, or
+    None if it is null or empty.
+    """
+    if not geometry:
+        return None
+    if geometry.get("type") == "GeometryCollection":
+        stack = [g.get("coordinates") for g in geometry.get("geometries", []) if g]
+    else:
+        stack = [geometry.get("coordinates")]
+    minx = miny = float("inf")
+    maxx = maxy = float("-inf")
+    while stack:
+        coords = stack.pop()
+        if not coords:
+            continue
+        if isinstance(coords[0], (int, float)):
+            x, y = coords[0], coords[1]
+            if x < minx:
+                minx = x
+            if x > maxx:
+                maxx = x
+            if y < miny:
+                miny = y
+            if y > maxy:
+                maxy = y
+        else:
+            stack.extend(coords)
+    if minx > maxx:
+        return None
+    return (minx, miny, maxx, maxy)
+
+
+def intersects(a, b):
+    """
+    Test whether two bounding boxes (minx, miny, maxx, maxy) intersect.
+    """
+    return not (a[2] < b[0] or a[3] < b[1] or a[0] > b[2] or a[1] > b[3])
+
+
+# the types of values whose equality is decided here: a value of one of
+# these types equals a qual of the same type exactly when PostgreSQL would
+# find them equal
+KEY_TYPES = (str, int, bool)
+
+
+def hash_key(value):
+    """
+    Return the key of a property value or a qual value, or None if it is not
+    of one of KEY_TYPES. Values of other types, or of another type than the
+    qual (e.g. the JSON number 5.0 and the NUMERIC 5, or the number 5 in a
+    TEXT column and the string '5'), may still be equal once PostgreSQL has
+    converted them to the column type, so they are left for it to compare.
+    """
+    if type(value) in KEY_TYPES:
+        return (type(value), value)
+    return None
+
+
+class HashIndex(object):
+    """
+    A hash index from the values of a column to the rows containing them.
+    """
+
+    def __init__(self, values):
+        """
+        :param sequence values: Column values in row order; None is null.
+        """
+        self.count = len(values)
+        self.rows = {}
+        self.types = {}
+        self.others = array("q")
+        self.nulls = array("q")
+        for i in range(self.count):
+            value = values[i]
+            if value is None:
+                self.nulls.append(i)
+                continue
+            key = hash_key(value)
+            if key is None:
+                self.others.append(i)
+                continue
+            rows = self.rows.get(key)
+            if rows is None:
+                rows = self.rows[key] = array("q")
+            rows.append(i)
+            typed = self.types.get(key[0])
+            if typed is None:
+                typed = self.types[key[0]] = array("q")
+            typed.append(i)
+
+    def __len__(self):
+        """
+        The number of distinct values that have a key.
+        """
+        return len(self.rows)
+
+    def lookup(self, keys):
+        """
+        Return the rows that may contain a value with one of keys (see
+        hash_key), in row order: those that do, and those whose values
+        cannot be compared with them here.
+        """
+        types = set(key[0] for key in keys)
+        rows = set(self.others)
+        for value_type, typed in self.types.items():
+            if value_type not in types:
+                rows.update(typed)
+        for key in keys:
+            rows.update(self.rows.get(key, ()))
+        return sorted(rows)
+
+    def decides(self, keys):
+        """
+        Return whether every value of the column that is not null has the
+        type of one of keys, so that lookup only returns rows that match.
+        """
+        types = set(key[0] for key in keys)
+        return not self.others and all(t in types for t in self.types)
+
+
+class RTree(object):
+    """
+    A static R-tree packed with the Sort-Tile-Recursive algorithm.
+
+    The nodes are stored in two flat arrays, leaves first and the root last:
+    boxes holds four coordinates per node, while indices holds the item
+    number for a leaf and the position of its first child for any other
+    node. The children of a node are contiguous, so the tree is searched
+    without building any node objects, and it can be written to and
+    memory-mapped from a file.
+    """
+
+    def __init__(self, node_size, num_items, level_bounds, boxes, indices):
+        self.node_size = node_size
+        self.num_items = num_items
+        self.level_bounds = list(level_bounds)
+        self.boxes = boxes
+        self.indices = indices
+        self.mmap = None
+
+    @classmethod
+    def build(cls, boxes, node_size=NODE_SIZE):
+        """
+        Build a tree.
+
+        :param sequence boxes: Four coordinates (minx, miny, maxx, maxy) for
+        each item; items whose first coordinate is NaN are left out.
+        :param int node_size: Maximum number of children per node.
+        """
+        items = [i for i in range(len(boxes) // 4) if not math.isnan(boxes[4 * i])]
+        num_items = len(items)
+
+        # sort into vertical slices by x, then each slice by y
+        leaves = math.ceil(num_items / node_size)
+        slice_size = node_size * max(1, math.ceil(math.sqrt(leaves)))
+        items.sort(key=lambda i: boxes[4 * i] + boxes[4 * i + 2])
+        ordered = []
+        for start in range(0, num_items, slice_size):
+            ordered.extend(sorted(items[start:start + slice_size],
+                                  key=lambda i: boxes[4 * i + 1] + boxes[4 * i + 3]))
+
+        node_boxes = array("d")
+        indices = array("q", ordered)
+        for i in ordered:
+            node_boxes.extend(boxes[4 * i:4 * i + 4])
+
+        level_bounds = [num_items]
+        start, end = 0, num_items
+        while end - start > 1:
+            for pos in range(start, end, node_size):
+                stop = min(pos + node_size, end)
+                node_boxes.append(min(node_boxes[4 * j] for j in range(pos, stop)))
+                node_boxes.append(min(node_boxes[4 * j + 1] for j in range(pos, stop)))
+                node_boxes.append(max(node_boxes[4 * j + 2] for j in range(pos, stop)))
+                node_boxes.append(max(node_boxes[4 * j + 3] for j in range(pos, stop)))
+                indices.append(pos)
+            start, end = end, len(indices)
+            level_bounds.append(end)
+        return cls(node_size, num_items, level_bounds, node_boxes, indices)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-map a tree written by save.
+        """
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, node_size, num_items, num_levels = _HEADER.unpack_from(mm)
+        if magic != _MAGIC:
+            mm.close()
+            raise ValueError("%s is not an R-tree" % path)
+        view = memoryview(mm)
+        offset = _HEADER.size
+        level_bounds = view[offset:offset + 8 * num_levels].cast("Q")
+        num_nodes = level_bounds[-1] if num_levels else 0
+        offset += 8 * num_levels
+        boxes = view[offset:offset + 32 * num_nodes].cast("d")
+        offset += 32 * num_nodes
+        indices = view[offset:offset + 8 * num_nodes].cast("q")
+        tree = cls(node_size, num_items, level_bounds, boxes, indices)
+        level_bounds.release()
+        tree.mmap = mm
+        tree.view = view
+        return tree
+
+    def save(self, path):
+        """
+        Write the tree to path, replacing any existing file atomically.
+        """
+        directory = os.path.dirname(path) or "."
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(_HEADER.pack(_MAGIC, self.node_size, self.num_items,
+                                     len(self.level_bounds)))
+                f.write(array("Q", self.level_bounds).tobytes())
+                f.write(bytes(self.boxes))
+                f.write(bytes(self.indices))
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def search(self, minx, miny, maxx, maxy):
+        """
+        Return the items whose boxes intersect the given box, in item order.
+        """
+        results = []
+        if not self.num_items:
+            return results
+        boxes = self.boxes
+        indices = self.indices
+        stack = []
+        node = len(indices) - 1
+        while True:
+            level_end = self.level_bounds[bisect_right(self.level_bounds, node)]
+            end = min(node + self.node_size, level_end)
+            leaf = node < self.num_items
+            for pos in range(node, end):
+                b = 4 * pos
+                if (maxx < boxes[b] or maxy < boxes[b + 1] or
+                        minx > boxes[b + 2] or miny > boxes[b + 3]):
+                    continue
+                if leaf:
+                    results.append(indices[pos])
+                else:
+                    stack.append(indices[pos])
+            if not stack:
+                break
+            node = stack.pop()
+        results.sort()
+        return results
+
+    def close(self):
+        if self.mmap is not None:
+            self.boxes.release()
+            self.indices.release()
+            self.view.release()
+            self.mmap.close()
+            self.mmap = None
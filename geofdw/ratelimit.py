@@ -0,0 +1,214 @@
+"""
+Rate limiting of requests to remote services.
+
+Requests are scheduled with token buckets. A bucket is shared by the threads
+of a session, and may also be shared between sessions (PostgreSQL backends)
+by keeping its state in a file that is locked whenever a token is taken, so
+that all the backends together stay within the quota of the service. Failed
+requests are retried with exponential backoff; while a request is backing
+off, the whole bucket is paused so that other requests do not keep hitting
+the service.
+"""
+
+import fcntl
+import os
+import random
+import struct
+import threading
+import time
+
+# requests per second allowed by the usage policies of the services
+SERVICE_RATES = {
+    "nominatim": 1.0,
+}
+
+_STATE = struct.Struct("<dd")
+
+
+class TokenBucket(object):
+    """
+    A token bucket that allows rate requests per second on average and bursts
+    of up to burst requests. It may be shared by several threads.
+
+    The state of the bucket is the number of tokens at the time it was last
+    updated. Tokens only accumulate after that time, so a pause is recorded by
+    moving it into the future, and a negative number of tokens means that
+    requests are already queued.
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param float rate: Requests per second, or None for no limit.
+        :param int burst: Number of requests that may be made at once.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a request may be made.
+        """
+        with self.lock:
+            wait = self._update(self._take)
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Hold back every request that has not yet been scheduled for (at
+        least) the given number of seconds, e.g. after the service has
+        reported that it is overloaded.
+        """
+        until = time.time() + seconds
+
+        def pause(tokens, updated, now):
+            start = max(now, updated)
+            tokens = min(self._refill(tokens, updated, start), 1)
+            return tokens, max(start, until), None
+
+        with self.lock:
+            self._update(pause)
+
+    def _refill(self, tokens, updated, now):
+        if not self.rate:
+            return float(self.burst)
+        return min(self.burst, tokens + max(0, now - updated) * self.rate)
+
+    def _take(self, tokens, updated, now):
+        # the token is taken now, so that later requests queue up behind it
+        start = max(now, updated)
+        tokens = self._refill(tokens, updated, start) - 1
+        wait = start - now
+        if tokens < 0:
+            wait += -tokens / self.rate
+        return tokens, start, wait
+
+    def _update(self, change):
+        """
+        Apply change, a function of (tokens, updated, now) that returns the new
+        tokens and update time and a result, to the state of the bucket.
+        """
+        self.tokens, self.updated, result = change(self.tokens, self.updated,
+                                                   time.time())
+        return result
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    A token bucket whose state is kept in a file so that it can be shared by
+    several processes.
+    """
+
+    def __init__(self, path, rate, burst=1):
+        """
+        :param str path: Location of the state file (created if it does not
+        exist).
+        """
+        super(SharedTokenBucket, self).__init__(rate, burst)
+        self.path = path
+
+    def _update(self, change):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.pread(fd, _STATE.size, 0)
+            now = time.time()
+            if len(data) == _STATE.size:
+                tokens, updated = _STATE.unpack(data)
+            else:
+                tokens, updated = float(self.burst), now
+            tokens, updated, result = change(tokens, updated, now)
+            os.pwrite(fd, _STATE.pack(tokens, updated), 0)
+            return result
+        finally:
+            os.close(fd)
+
+
+class Scheduler(object):
+    """
+    Sends requests through a token bucket and retries those that fail
+    because the service is overloaded or temporarily unavailable.
+    """
+
+    def __init__(self, bucket, retries=3, backoff=1.0, max_backoff=60.0,
+                 retry_after=None):
+        """
+        :param TokenBucket bucket: The bucket that limits the requests.
+        :param int retries: Number of times a request is retried.
+        :param float backoff: Delay in seconds before the first retry; the
+        delay doubles with every retry, with random jitter of up to half of
+        it.
+        :param float max_backoff: Maximum delay in seconds.
+        :param callable retry_after: Function that takes an exception raised
+        by a request and returns None if the request must not be retried, or
+        otherwise the minimum delay before retrying it (0 if the service gave
+        no hint).
+        """
+        self.bucket = bucket
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_after = retry_after or (lambda error: None)
+
+    def call(self, request, retried=None):
+        """
+        Wait for a token and call request, retrying as needed. The exception
+        raised by the last attempt is raised if every attempt fails.
+
+        :param list retried: List to which the exception raised by each
+        attempt that is retried is appended (optional).
+        """
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                return request()
+            except Exception as e:
+                hint = self.retry_after(e)
+                if hint is None or attempt >= self.retries:
+                    raise
+                if retried is not None:
+                    retried.append(e)
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                delay = max(hint, delay / 2 + random.uniform(0, delay / 2))
+                self.bucket.pause(delay)
+                attempt += 1
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(service, rate=None, burst=1, directory=None):
+    """
+    Return the token bucket shared by every table in this process that uses
+    service with the same limits.
+
+    :param str service: Name of the service.
+    :param float rate: Requests per second, by default the rate in
+    SERVICE_RATES (if any).
+    :param int burst: Number of requests that may be made at once.
+    :param str directory: Directory in which to keep the state of the bucket
+    so that it is also shared with other processes (which use the same
+    limits), or None.
+    """
+    if rate is None:
+        rate = SERVICE_RATES.get(service)
+    key = (service, rate, burst, directory)
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            if directory is None:
+                bucket = TokenBucket(rate, burst)
+            else:
+                os.makedirs(directory, exist_ok=True)
+                # tables with other limits for the same service must not
+                # share the state of this bucket
+                name = "%s-%s-%d.bucket" % (service, "unlimited" if rate is None else repr(float(rate)), burst)
+                path = os.path.join(directory, name)
+                bucket = SharedTokenBucket(path, rate, burst)
+            _buckets[key] = bucket
+        return bucket
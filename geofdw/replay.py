@@ -0,0 +1,410 @@
+"""
+A local stand-in for the HTTP services used by the wrappers, so that they can
+be tested and benchmarked offline.
+
+The server answers like the real services would:
+
+- /geojson returns a synthetic FeatureCollection; the number of features,
+  the number of properties of each feature and the type of geometry are given
+  by the query string (features, properties, geometry and seed);
+- /items returns the same features a page at a time, like an OGC API
+  Features items endpoint: it honours limit, offset and bbox, and reports
+  numberMatched (unless matched=0) and a link to the next page; max_limit
+  caps the size of its pages;
+- /api/states/all, /api/flights/<endpoint> and /api/tracks/all return
+  synthetic OpenSky responses, honouring the same parameters as the OpenSky
+  API (use the url option of the OpenSky tables to point them at
+  <server>/api);
+- /search and /reverse return synthetic Nominatim responses (use the domain
+  and scheme options of the geocoding tables to point them at the server).
+
+Responses are deterministic: the same request always gets the same answer.
+Responses recorded from the real services with record() are replayed instead
+of the synthetic ones, and any other file in the recording directory is
+served as is. Every response can be delayed by a fixed latency.
+
+    python -m geofdw.replay --port 8000 --aircraft 10000 --latency 0.05
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from geofdw.index import geojson_bounds, intersects
+
+_COUNTRIES = ["Finland", "Germany", "Sweden", "United States", "France"]
+_AIRPORTS = ["EFHK", "ESSA", "EDDF", "KJFK", "LFPG", "EGLL"]
+
+
+def request_key(path, query):
+    """
+    Name of the file that holds the recorded response to a request. The
+    parameters are sorted so that their order does not matter.
+    """
+    params = sorted((k, v) for k, values in parse_qs(query).items() for v in values)
+    text = json.dumps([path, params])
+    return hashlib.sha1(text.encode("utf-8")).hexdigest() + ".response"
+
+
+def record(url, directory, base):
+    """
+    Fetch url and save the response in directory, so that a server with the
+    same directory replays it for the request url would make relative to
+    base.
+
+    :param str url: The URL of the request to the real service.
+    :param str directory: The recording directory.
+    :param str base: The part of url that the server replaces, e.g.
+    "https://opensky-network.org" for the OpenSky API.
+    """
+    import requests
+    response = requests.get(url)
+    split = urlsplit(url[len(base):])
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, request_key(split.path, split.query))
+    with open(path, "wb") as f:
+        f.write(json.dumps({
+            "status": response.status_code,
+            "content_type": response.headers.get("Content-Type", "application/json"),
+        }).encode("utf-8") + b"\n")
+        f.write(response.content)
+    return path
+
+
+def synthetic_features(count, properties=5, geometry="point", seed=0):
+    """
+    A FeatureCollection of count features spread over the world.
+    """
+    rng = random.Random(seed)
+    features = []
+    for i in range(count):
+        x = rng.uniform(-180, 180)
+        y = rng.uniform(-85, 85)
+        if geometry == "polygon":
+            r = rng.uniform(0.01, 0.5)
+            ring = [[x + r * math.cos(a * math.pi / 3), y + r * math.sin(a * math.pi / 3)]
+                    for a in range(6)]
+            geom = {"type": "Polygon", "coordinates": [ring + ring[:1]]}
+        elif geometry == "linestring":
+            geom = {"type": "LineString",
+                    "coordinates": [[x, y], [x + rng.uniform(-1, 1), y + rng.uniform(-1, 1)]]}
+        else:
+            geom = {"type": "Point", "coordinates": [x, y]}
+        props = {"id": i, "name": "feature %d" % i}
+        for p in range(properties - 2):
+            props["property_%d" % p] = rng.randint(0, 1000)
+        features.append({"type": "Feature", "geometry": geom, "properties": props})
+    return {"type": "FeatureCollection", "features": features}
+
+
+def synthetic_states(count, epoch, extended=False, seed=0):
+    """
+    The state vectors of count aircraft at epoch. Each aircraft flies in a
+    straight line from a fixed starting point, so its position changes with
+    time.
+    """
+    rng = random.Random(seed)
+    states = []
+    for i in range(count):
+        x0 = rng.uniform(-180, 180)
+        y0 = rng.uniform(-80, 80)
+        heading = rng.uniform(0, 360)
+        velocity = rng.uniform(50, 250)
+        known = rng.random() > 0.05
+        altitude = rng.choice([None, rng.uniform(0, 12000)])
+        # degrees moved since the start of the day
+        moved = velocity * (epoch % 86400) / 111195.0 / 100
+        x = (x0 + moved * math.sin(math.radians(heading)) + 180) % 360 - 180
+        y = max(-85.0, min(85.0, y0 + moved * math.cos(math.radians(heading))))
+        state = ["%06x" % (0x400000 + i), "TST%04d " % i,
+                 _COUNTRIES[i % len(_COUNTRIES)], epoch - 1, epoch,
+                 x if known else None, y if known else None, altitude,
+                 altitude is None, velocity, heading, 0.0, None,
+                 None if altitude is None else altitude + 50.0,
+                 "%04d" % (i % 7777), False, 0]
+        if extended:
+            state.append(i % 21)
+        states.append(state)
+    return states
+
+
+def synthetic_flights(begin, end, icao24=None, airport=None, per_hour=100, seed=0):
+    """
+    Flights that depart within [begin, end], at a rate of per_hour.
+    """
+    flights = []
+    hour = begin // 3600
+    while hour * 3600 <= end:
+        rng = random.Random("%d/%d" % (seed, hour))
+        for i in range(per_hour):
+            first = hour * 3600 + rng.randrange(3600)
+            aircraft = "%06x" % (0x400000 + rng.randrange(1000))
+            departure = rng.choice(_AIRPORTS)
+            arrival = rng.choice(_AIRPORTS)
+            flight = {
+                "icao24": aircraft, "firstSeen": first,
+                "lastSeen": first + rng.randrange(1800, 36000),
+                "callsign": "TST%04d " % i,
+                "estDepartureAirport": departure, "estArrivalAirport": arrival,
+                "estDepartureAirportHorizDistance": rng.randrange(5000),
+                "estArrivalAirportHorizDistance": rng.randrange(5000),
+            }
+            if not begin <= first <= end:
+                continue
+            if icao24 and aircraft != icao24:
+                continue
+            if airport and airport not in (departure, arrival):
+                continue
+            flights.append(flight)
+        hour += 1
+    return flights
+
+
+def synthetic_track(icao24, epoch, points=100):
+    """
+    The track of a flight of icao24 that is under way at epoch.
+    """
+    rng = random.Random("%s/%d" % (icao24, epoch // 3600))
+    start = epoch - epoch % 3600
+    x, y = rng.uniform(-170, 170), rng.uniform(-80, 80)
+    path = []
+    for i in range(points):
+        path.append([start + 30 * i, y + 0.01 * i, x + 0.01 * i,
+                     min(11000.0, 100.0 * i), 45.0, i == 0])
+    return {"icao24": icao24, "callsign": "TST0001 ", "startTime": start,
+            "endTime": start + 30 * (points - 1), "path": path}
+
+
+def synthetic_place(query):
+    """
+    A Nominatim search result for query, somewhere that depends on it.
+    """
+    digest = hashlib.sha1(query.casefold().encode("utf-8")).digest()
+    lat = int.from_bytes(digest[:4], "little") / 2.0 ** 32 * 170 - 85
+    lon = int.from_bytes(digest[4:8], "little") / 2.0 ** 32 * 360 - 180
+    return {"place_id": int.from_bytes(digest[8:12], "little"),
+            "lat": "%.7f" % lat, "lon": "%.7f" % lon,
+            "display_name": query.strip().title(),
+            "boundingbox": ["%.7f" % (lat - 0.1), "%.7f" % (lat + 0.1),
+                            "%.7f" % (lon - 0.1), "%.7f" % (lon + 0.1)]}
+
+
+class ReplayServer(object):
+    """
+    The stand-in server, which runs in a background thread:
+
+        with ReplayServer(aircraft=1000) as server:
+            table = GeoJSON({"url": server.url + "/geojson?features=100"}, {})
+    """
+
+    def __init__(self, port=0, directory=None, latency=0.0, aircraft=1000,
+                 flights_per_hour=100, track_points=100, chunk_size=65536):
+        """
+        :param int port: Port to listen on (by default any free port).
+        :param str directory: Directory of recorded responses and files.
+        :param float latency: Seconds to wait before each response.
+        :param int aircraft: Number of aircraft in the OpenSky state vectors.
+        :param int flights_per_hour: Number of OpenSky flights per hour.
+        :param int track_points: Number of points of an OpenSky track.
+        :param int chunk_size: Size of the pieces in which responses are
+        written.
+        """
+        self.directory = directory
+        self.latency = latency
+        self.aircraft = aircraft
+        self.flights_per_hour = flights_per_hour
+        self.track_points = track_points
+        self.chunk_size = chunk_size
+        self.requests = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self._bodies = {}
+        self._collections = {}
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), _handler(self))
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def respond(self, path, query):
+        """
+        Return (status, content type, body) for a request.
+        """
+        if self.directory:
+            recorded = os.path.join(self.directory, request_key(path, query))
+            if os.path.exists(recorded):
+                with open(recorded, "rb") as f:
+                    header = json.loads(f.readline().decode("utf-8"))
+                    return header["status"], header["content_type"], f.read()
+            name = os.path.normpath(path.lstrip("/"))
+            filename = os.path.join(self.directory, name)
+            if not name.startswith("..") and os.path.isfile(filename):
+                with open(filename, "rb") as f:
+                    return 200, "application/octet-stream", f.read()
+
+        params = dict((k, v[-1]) for k, v in parse_qs(query).items())
+        if path == "/geojson":
+            key = (params.get("features"), params.get("properties"),
+                   params.get("geometry"), params.get("seed"))
+            body = self._bodies.get(key)
+            if body is None:
+                body = json.dumps(synthetic_features(
+                    int(params.get("features", 1000)),
+                    int(params.get("properties", 5)),
+                    params.get("geometry", "point"),
+                    int(params.get("seed", 0)))).encode("utf-8")
+                with self.lock:
+                    self._bodies[key] = body
+            return 200, "application/geo+json", body
+        if path == "/items":
+            return self._json(self._items(path, params))
+        if path == "/api/states/all":
+            return self._json(self._states(query, params))
+        if path.startswith("/api/flights/"):
+            flights = synthetic_flights(
+                int(params["begin"]), int(params["end"]), params.get("icao24"),
+                params.get("airport"), self.flights_per_hour)
+            if not flights:
+                return 404, "text/plain", b"Not found"
+            return self._json(flights)
+        if path == "/api/tracks/all":
+            epoch = int(params.get("time", 0)) or int(time.time())
+            return self._json(synthetic_track(params["icao24"], epoch,
+                                              self.track_points))
+        if path == "/search":
+            return self._json([synthetic_place(params.get("q", ""))])
+        if path == "/reverse":
+            lat, lon = float(params["lat"]), float(params["lon"])
+            place = synthetic_place("%.3f %.3f" % (lat, lon))
+            place.update(lat="%.7f" % lat, lon="%.7f" % lon)
+            return self._json(place)
+        return 404, "text/plain", b"Not found"
+
+    def _json(self, value):
+        return 200, "application/json", json.dumps(value).encode("utf-8")
+
+    def _items(self, path, params):
+        key = (params.get("features"), params.get("properties"),
+               params.get("geometry"), params.get("seed"))
+        features = self._collections.get(key)
+        if features is None:
+            features = synthetic_features(
+                int(params.get("features", 1000)),
+                int(params.get("properties", 5)),
+                params.get("geometry", "point"),
+                int(params.get("seed", 0)))["features"]
+            with self.lock:
+                self._collections[key] = features
+        if "bbox" in params:
+            bbox = [float(v) for v in params["bbox"].split(",")]
+            features = [f for f in features
+                        if intersects(geojson_bounds(f["geometry"]), bbox)]
+        limit = int(params.get("limit", 10))
+        if "max_limit" in params:
+            # a server that caps the size of its pages
+            limit = min(limit, int(params["max_limit"]))
+        offset = int(params.get("offset", 0))
+        page = features[offset:offset + limit]
+        links = []
+        if offset + limit < len(features):
+            params = dict(params, offset=offset + limit)
+            links.append({"rel": "next", "type": "application/geo+json",
+                          "href": "%s?%s" % (path, urlencode(params))})
+        collection = {"type": "FeatureCollection", "features": page,
+                      "numberReturned": len(page), "links": links}
+        if params.get("matched") != "0":
+            collection["numberMatched"] = len(features)
+        return collection
+
+    def _states(self, query, params):
+        epoch = int(params.get("time", 0)) or int(time.time())
+        states = synthetic_states(self.aircraft, epoch, params.get("extended") == "1")
+        icao24 = parse_qs(query).get("icao24")
+        if icao24:
+            icao24 = set(icao24)
+            states = [s for s in states if s[0] in icao24]
+        if "lamin" in params:
+            lamin, lomin = float(params["lamin"]), float(params["lomin"])
+            lamax, lomax = float(params["lamax"]), float(params["lomax"])
+            states = [s for s in states if s[5] is not None and
+                      lomin <= s[5] <= lomax and lamin <= s[6] <= lamax]
+        return {"time": epoch, "states": states}
+
+
+def _handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            split = urlsplit(self.path)
+            status, content_type, body = server.respond(split.path, split.query)
+            with server.lock:
+                server.requests += 1
+            if server.latency:
+                time.sleep(server.latency)
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            view = memoryview(body)
+            sent = 0
+            try:
+                for i in range(0, len(body), server.chunk_size):
+                    sent += self.wfile.write(view[i:i + server.chunk_size]) or 0
+            except (BrokenPipeError, ConnectionResetError):
+                # the client stopped reading early (e.g. at a LIMIT)
+                self.close_connection = True
+            with server.lock:
+                server.bytes_sent += sent
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--directory", help="recorded responses and files")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--aircraft", type=int, default=1000)
+    parser.add_argument("--flights-per-hour", type=int, default=100)
+    args = parser.parse_args()
+    server = ReplayServer(args.port, args.directory, args.latency,
+                          args.aircraft, args.flights_per_hour)
+    print("Serving on %s" % server.url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
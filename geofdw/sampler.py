@@ -0,0 +1,537 @@
+"""
+Vectorized samplers for generating random geometries with NumPy.
+
+A sampler draws the positions of random geometries from a distribution and
+an encoder turns those positions into geometries of a particular type,
+encoded as hex EWKB. Both are looked up by name in a registry, so new ones can
+be added with the register_sampler and register_encoder decorators. Each is
+constructed with the foreign data wrapper, from which it reads its options
+with get_option.
+"""
+
+import math
+
+import numpy
+
+from geofdw import ewkb
+from geofdw.exception import OptionValueError
+
+SAMPLERS = {}
+ENCODERS = {}
+
+
+def register_sampler(name):
+    """
+    Class decorator that makes a Sampler available as a distribution.
+    """
+    def decorator(cls):
+        SAMPLERS[name] = cls
+        return cls
+    return decorator
+
+
+def register_encoder(name):
+    """
+    Class decorator that makes an Encoder available as a geometry type.
+    """
+    def decorator(cls):
+        ENCODERS[name] = cls
+        return cls
+    return decorator
+
+
+def get_sampler(name, fdw):
+    try:
+        cls = SAMPLERS[name]
+    except KeyError:
+        raise OptionValueError("Unknown distribution '%s'" % name)
+    return cls(fdw)
+
+
+def get_encoder(name, fdw):
+    try:
+        cls = ENCODERS[name]
+    except KeyError:
+        raise OptionValueError("Unknown geometry type '%s'" % name)
+    return cls(fdw)
+
+
+class Sampler(object):
+    """
+    Base class for distributions of positions.
+
+    A sampler is shardable if the positions in each batch depend only on the
+    random number generator passed to sample (and on the state set up by
+    reset), so that the batches can be generated independently of each other.
+    """
+
+    shardable = True
+
+    def __init__(self, fdw):
+        self.fdw = fdw
+
+    def reset(self, rng):
+        """
+        Prepare to generate a new set of positions (e.g. choose the cluster
+        centres or clear the positions already taken).
+        """
+        pass
+
+    def sample(self, rng, size):
+        """
+        Return arrays of x and y coordinates for up to size positions. Fewer
+        positions are only returned if the distribution is exhausted.
+        """
+        raise NotImplementedError
+
+
+@register_sampler("uniform")
+class UniformSampler(Sampler):
+    """
+    Positions distributed uniformly in the bounding box.
+    """
+
+    def sample(self, rng, size):
+        fdw = self.fdw
+        x = rng.uniform(fdw.min_x, fdw.max_x, size)
+        y = rng.uniform(fdw.min_y, fdw.max_y, size)
+        return x, y
+
+
+@register_sampler("gaussian")
+class GaussianSampler(Sampler):
+    """
+    Positions in normally distributed clusters around centres placed uniformly
+    in the bounding box. Positions falling outside the bounding box are
+    drawn again.
+
+    Options:
+        clusters: number of clusters (default 5)
+        sigma: standard deviation of each cluster (default 5% of the smaller
+            side of the bounding box)
+    """
+
+    def __init__(self, fdw):
+        super(GaussianSampler, self).__init__(fdw)
+        self.clusters = fdw.get_option("clusters", required=False, default=5,
+                                       option_type=int)
+        default = 0.05 * min(fdw.max_x - fdw.min_x, fdw.max_y - fdw.min_y)
+        self.sigma = fdw.get_option("sigma", required=False, default=default,
+                                    option_type=float)
+        if self.clusters < 1 or self.sigma <= 0:
+            raise OptionValueError("clusters and sigma must be positive")
+
+    def reset(self, rng):
+        fdw = self.fdw
+        self.centres_x = rng.uniform(fdw.min_x, fdw.max_x, self.clusters)
+        self.centres_y = rng.uniform(fdw.min_y, fdw.max_y, self.clusters)
+
+    def sample(self, rng, size):
+        fdw = self.fdw
+        xs = []
+        ys = []
+        needed = size
+        while needed > 0:
+            cluster = rng.integers(0, self.clusters, needed)
+            x = self.centres_x[cluster] + rng.normal(0, self.sigma, needed)
+            y = self.centres_y[cluster] + rng.normal(0, self.sigma, needed)
+            inside = ((x >= fdw.min_x) & (x <= fdw.max_x) &
+                      (y >= fdw.min_y) & (y <= fdw.max_y))
+            xs.append(x[inside])
+            ys.append(y[inside])
+            needed -= int(inside.sum())
+        return numpy.concatenate(xs), numpy.concatenate(ys)
+
+
+@register_sampler("poisson_disk")
+class PoissonDiskSampler(Sampler):
+    """
+    Positions distributed uniformly in the bounding box but never closer than
+    radius to each other, generated by dart throwing against a background
+    grid with cells small enough to hold at most one position. Candidates are
+    tested against their neighbours a batch at a time; a candidate is kept if
+    no earlier position or candidate lies within radius. Once the bounding
+    box is full, fewer positions than requested are returned.
+
+    Every batch depends on the positions of the batches before it, so the
+    positions cannot be split into shards.
+
+    Options:
+        radius: minimum distance between positions (required)
+    """
+
+    shardable = False
+
+    MAX_CELLS = 50000000
+    ATTEMPTS = 10
+
+    def __init__(self, fdw):
+        super(PoissonDiskSampler, self).__init__(fdw)
+        self.radius = fdw.get_option("radius", option_type=float)
+        if self.radius <= 0:
+            raise OptionValueError("radius must be positive")
+        self.cell = self.radius / math.sqrt(2)
+        self.width = int(math.ceil((fdw.max_x - fdw.min_x) / self.cell)) or 1
+        self.height = int(math.ceil((fdw.max_y - fdw.min_y) / self.cell)) or 1
+        if self.width * self.height > self.MAX_CELLS:
+            raise OptionValueError("radius is too small for the bounding box")
+
+    def reset(self, rng):
+        self.grid = numpy.full((self.width + 4, self.height + 4), -1, dtype=numpy.int64)
+        self.x = numpy.empty(0)
+        self.y = numpy.empty(0)
+        self.failures = 0
+
+    def sample(self, rng, size):
+        fdw = self.fdw
+        start = len(self.x)
+        while len(self.x) - start < size and self.failures < self.ATTEMPTS:
+            count = len(self.x)
+            n = max(size - (count - start), 1024)
+            x = rng.uniform(fdw.min_x, fdw.max_x, n)
+            y = rng.uniform(fdw.min_y, fdw.max_y, n)
+            # the grid has a margin of two cells on each side
+            cx = numpy.minimum(((x - fdw.min_x) / self.cell).astype(numpy.int64), self.width - 1) + 2
+            cy = numpy.minimum(((y - fdw.min_y) / self.cell).astype(numpy.int64), self.height - 1) + 2
+
+            # keep the first candidate in each free cell
+            free = self.grid[cx, cy] < 0
+            cells = cx * self.grid.shape[1] + cy
+            _, first = numpy.unique(numpy.where(free, cells, -1), return_index=True)
+            keep = numpy.zeros(n, dtype=bool)
+            keep[first] = True
+            keep &= free
+            x, y, cx, cy = x[keep], y[keep], cx[keep], cy[keep]
+            ids = numpy.arange(count, count + len(x))
+            all_x = numpy.concatenate([self.x, x])
+            all_y = numpy.concatenate([self.y, y])
+            self.grid[cx, cy] = ids
+
+            # reject candidates with an earlier neighbour within radius
+            reject = numpy.zeros(len(x), dtype=bool)
+            for dx in range(-2, 3):
+                for dy in range(-2, 3):
+                    if dx == 0 and dy == 0:
+                        continue
+                    other = self.grid[cx + dx, cy + dy]
+                    earlier = (other >= 0) & (other < ids)
+                    o = numpy.where(earlier, other, 0)
+                    close = (all_x[o] - x) ** 2 + (all_y[o] - y) ** 2 < self.radius ** 2
+                    reject |= earlier & close
+            self.grid[cx[reject], cy[reject]] = -1
+
+            accepted = ~reject
+            if not accepted.any():
+                self.failures += 1
+                continue
+            self.failures = 0
+            # renumber the accepted candidates so that ids stay contiguous
+            self.grid[cx[accepted], cy[accepted]] = numpy.arange(count, count + int(accepted.sum()))
+            self.x = numpy.concatenate([self.x, x[accepted]])
+            self.y = numpy.concatenate([self.y, y[accepted]])
+
+        end = min(len(self.x), start + size)
+        return self.x[start:end], self.y[start:end]
+
+
+@register_sampler("polygon")
+class PolygonSampler(Sampler):
+    """
+    Positions distributed uniformly inside a polygon. The exterior rings are
+    triangulated once when the table is created, after which a position is
+    sampled by picking a triangle weighted by its area and a random point in
+    that triangle. Positions that fall in a hole are drawn again, unless
+    none of a round of draws lands outside the holes ATTEMPTS times in a row,
+    in which case the holes must cover the polygon.
+
+    Options:
+        polygon: POLYGON or MULTIPOLYGON as WKT or EWKT (required); if it has
+            an SRID and the table does not, the SRID of the polygon is used,
+            and its bounding box is used if none is given
+    """
+
+    ATTEMPTS = 10
+
+    def __init__(self, fdw):
+        super(PolygonSampler, self).__init__(fdw)
+        from plpygis import Geometry
+        wkt = fdw.get_option("polygon")
+        try:
+            geometry = Geometry.from_wkt(wkt)
+        except Exception:
+            raise OptionValueError("Invalid polygon '%s'" % wkt)
+        geojson = geometry.geojson
+        if geojson["type"] == "Polygon":
+            polygons = [geojson["coordinates"]]
+        elif geojson["type"] == "MultiPolygon":
+            polygons = geojson["coordinates"]
+        else:
+            raise OptionValueError("polygon must be a POLYGON or MULTIPOLYGON")
+        self.srid = geometry.srid
+
+        triangles = []
+        self.holes = []
+        for rings in polygons:
+            triangles.extend(triangulate(rings[0]))
+            self.holes.extend(numpy.array(ring, dtype=float)[:, :2] for ring in rings[1:])
+        if not triangles:
+            raise OptionValueError("polygon has no area")
+        t = numpy.array(triangles, dtype=float)
+        self.bounds = (t[:, :, 0].min(), t[:, :, 1].min(),
+                       t[:, :, 0].max(), t[:, :, 1].max())
+        self.a = t[:, 0]
+        self.ab = t[:, 1] - t[:, 0]
+        self.ac = t[:, 2] - t[:, 0]
+        areas = numpy.abs(self.ab[:, 0] * self.ac[:, 1] - self.ab[:, 1] * self.ac[:, 0])
+        self.cumulative = numpy.cumsum(areas)
+
+    def sample(self, rng, size):
+        xs = []
+        ys = []
+        needed = size
+        failures = 0
+        while needed > 0:
+            target = rng.uniform(0, self.cumulative[-1], needed)
+            t = numpy.minimum(numpy.searchsorted(self.cumulative, target, side="right"),
+                              len(self.cumulative) - 1)
+            r1 = rng.random(needed)
+            r2 = rng.random(needed)
+            flip = r1 + r2 > 1
+            r1[flip] = 1 - r1[flip]
+            r2[flip] = 1 - r2[flip]
+            x = self.a[t, 0] + r1 * self.ab[t, 0] + r2 * self.ac[t, 0]
+            y = self.a[t, 1] + r1 * self.ab[t, 1] + r2 * self.ac[t, 1]
+            outside = numpy.zeros(needed, dtype=bool)
+            for hole in self.holes:
+                outside |= contains(hole, x, y)
+            accepted = int((~outside).sum())
+            if not accepted:
+                failures += 1
+                if failures >= self.ATTEMPTS:
+                    raise OptionValueError("polygon is covered by its holes")
+                continue
+            failures = 0
+            xs.append(x[~outside])
+            ys.append(y[~outside])
+            needed -= accepted
+        return numpy.concatenate(xs), numpy.concatenate(ys)
+
+
+def triangulate(ring):
+    """
+    Triangulate a simple polygon ring by ear clipping.
+
+    :param list ring: Coordinates of the ring, which may be closed.
+    :return: List of triangles, each a tuple of three (x, y) coordinates.
+    """
+    points = [(p[0], p[1]) for p in ring]
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    area = sum(points[i - 1][0] * points[i][1] - points[i][0] * points[i - 1][1]
+               for i in range(len(points)))
+    if area < 0:
+        points.reverse()
+
+    def cross(a, b, c):
+        return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+
+    remaining = list(range(len(points)))
+    triangles = []
+    while len(remaining) > 3:
+        n = len(remaining)
+        for k in range(n):
+            a = points[remaining[k - 1]]
+            b = points[remaining[k]]
+            c = points[remaining[(k + 1) % n]]
+            turn = cross(a, b, c)
+            if turn == 0:
+                # drop collinear and repeated vertices
+                del remaining[k]
+                break
+            if turn < 0:
+                continue
+            ear = True
+            for i in remaining:
+                p = points[i]
+                if p in (a, b, c):
+                    continue
+                if cross(a, b, p) >= 0 and cross(b, c, p) >= 0 and cross(c, a, p) >= 0:
+                    ear = False
+                    break
+            if ear:
+                triangles.append((a, b, c))
+                del remaining[k]
+                break
+        else:
+            raise OptionValueError("polygon is not simple")
+    if len(remaining) == 3:
+        a, b, c = [points[i] for i in remaining]
+        if cross(a, b, c) != 0:
+            triangles.append((a, b, c))
+    return triangles
+
+
+def contains(ring, x, y):
+    """
+    Test which of the points (x, y) lie inside a ring, by counting crossings.
+    """
+    inside = numpy.zeros(len(x), dtype=bool)
+    x0, y0 = ring[:-1, 0], ring[:-1, 1]
+    x1, y1 = ring[1:, 0], ring[1:, 1]
+    for i in range(len(x0)):
+        crosses = (y0[i] > y) != (y1[i] > y)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            at = x0[i] + (y - y0[i]) * (x1[i] - x0[i]) / (y1[i] - y0[i])
+        inside ^= crosses & (x < at)
+    return inside
+
+
+def hex_rows(records):
+    """
+    Hex-encode a structured array with one fixed-size geometry per record.
+    """
+    width = 2 * records.dtype.itemsize
+    data = records.tobytes().hex()
+    return [data[i:i + width] for i in range(0, len(data), width)]
+
+
+class Encoder(object):
+    """
+    Base class for geometry types. The EWKB of every geometry in a batch has
+    the same size, so a batch is written into a NumPy structured array whose
+    constant parts are filled in once.
+    """
+
+    geometry_type = None
+
+    def __init__(self, fdw):
+        self.fdw = fdw
+        self.template = None
+
+    def dtype(self, header):
+        raise NotImplementedError
+
+    def records(self, size):
+        """
+        Return a structured array for size geometries with the header (and
+        any other constant fields) already filled in.
+        """
+        if self.template is None or len(self.template) < size:
+            header = ewkb.header(self.geometry_type, self.fdw.srid)
+            self.template = numpy.zeros(size, dtype=self.dtype(header))
+            self.template["header"] = header
+            self.prepare(self.template)
+        return self.template[:size]
+
+    def prepare(self, records):
+        pass
+
+    def encode(self, rng, x, y, count=None):
+        """
+        Return hex EWKB for a geometry at each position (x, y), or only for
+        the first count of them. The random shapes of every position are
+        drawn either way, so that the geometries are the same as in the whole
+        batch.
+        """
+        raise NotImplementedError
+
+
+@register_encoder("point")
+class PointEncoder(Encoder):
+    geometry_type = ewkb.POINT
+
+    def dtype(self, header):
+        return numpy.dtype([("header", "S%d" % len(header)), ("x", "<f8"), ("y", "<f8")])
+
+    def encode(self, rng, x, y, count=None):
+        x, y = x[:count], y[:count]
+        records = self.records(len(x))
+        records["x"] = x
+        records["y"] = y
+        return hex_rows(records)
+
+
+class _ShapeEncoder(Encoder):
+    """
+    Geometries with a fixed number of vertices around each position.
+
+    Options:
+        vertices: number of vertices in each geometry
+        size: maximum distance of a vertex from the previous one (lines) or
+            from the centre (polygons), by default 1% of the larger side of
+            the bounding box
+    """
+
+    min_vertices = None
+
+    def __init__(self, fdw):
+        super(_ShapeEncoder, self).__init__(fdw)
+        self.vertices = fdw.get_option("vertices", required=False,
+                                       default=self.min_vertices, option_type=int)
+        if self.vertices < self.min_vertices:
+            raise OptionValueError("vertices must be at least %d" % self.min_vertices)
+        default = 0.01 * max(fdw.max_x - fdw.min_x, fdw.max_y - fdw.min_y)
+        self.size = fdw.get_option("size", required=False, default=default,
+                                   option_type=float)
+
+
+@register_encoder("linestring")
+class LineStringEncoder(_ShapeEncoder):
+    """
+    Random walks starting at each position.
+    """
+
+    geometry_type = ewkb.LINESTRING
+    min_vertices = 2
+
+    def dtype(self, header):
+        return numpy.dtype([("header", "S%d" % len(header)), ("count", "<u4"),
+                            ("coords", "<f8", (self.vertices, 2))])
+
+    def prepare(self, records):
+        records["count"] = self.vertices
+
+    def encode(self, rng, x, y, count=None):
+        n = len(x)
+        angle = rng.uniform(0, 2 * math.pi, (n, self.vertices - 1))
+        length = rng.uniform(0, self.size, (n, self.vertices - 1))
+        x, y, angle, length = x[:count], y[:count], angle[:count], length[:count]
+        records = self.records(len(x))
+        coords = records["coords"]
+        coords[:, 0, 0] = x
+        coords[:, 0, 1] = y
+        coords[:, 1:, 0] = x[:, None] + numpy.cumsum(length * numpy.cos(angle), axis=1)
+        coords[:, 1:, 1] = y[:, None] + numpy.cumsum(length * numpy.sin(angle), axis=1)
+        return hex_rows(records)
+
+
+@register_encoder("polygon")
+class PolygonEncoder(_ShapeEncoder):
+    """
+    Star-shaped polygons centred on each position, so that every polygon is
+    simple: the vertices are at random angles in order around the centre, at
+    between half of and the full size away from it.
+    """
+
+    geometry_type = ewkb.POLYGON
+    min_vertices = 3
+
+    def dtype(self, header):
+        return numpy.dtype([("header", "S%d" % len(header)), ("rings", "<u4"),
+                            ("count", "<u4"), ("coords", "<f8", (self.vertices + 1, 2))])
+
+    def prepare(self, records):
+        records["rings"] = 1
+        records["count"] = self.vertices + 1
+
+    def encode(self, rng, x, y, count=None):
+        n = len(x)
+        angle = numpy.sort(rng.uniform(0, 2 * math.pi, (n, self.vertices)), axis=1)
+        radius = rng.uniform(self.size / 2, self.size, (n, self.vertices))
+        x, y, angle, radius = x[:count], y[:count], angle[:count], radius[:count]
+        records = self.records(len(x))
+        coords = records["coords"]
+        coords[:, :-1, 0] = x[:, None] + radius * numpy.cos(angle)
+        coords[:, :-1, 1] = y[:, None] + radius * numpy.sin(angle)
+        coords[:, -1] = coords[:, 0]
+        return hex_rows(records)
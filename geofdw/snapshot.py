@@ -0,0 +1,262 @@
+"""
+Columnar snapshots of GeoJSON features stored in memory-mapped files.
+
+A snapshot holds the WKB of every geometry together with the feature
+properties, each property in its own typed column. Once a snapshot has been
+written, scanning it requires no JSON decoding and no geometry construction:
+the WKB is sliced straight out of the mapped file.
+
+The file consists of a series of sections, each aligned to eight bytes,
+followed by a JSON footer describing them and finally the length of the footer
+and a magic number:
+
+    geometry offsets (uint64 * count + 1) | geometry data
+    | bounding boxes (float64 * 4 * count) | column sections...
+    | footer JSON | footer length (uint64) | MAGIC
+
+The bounding box of a feature without a geometry is stored as NaNs.
+
+Columns are stored as a null mask (one byte per feature) plus either an
+array of values (int64, float64 or bool) or offsets into a blob of UTF-8 text
+(str, or any other value encoded as JSON).
+"""
+
+import json
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+
+from geofdw.index import geojson_bounds
+
+MAGIC = b"GFDWSNP1"
+_TRAILER = struct.Struct("<Q8s")
+
+_ARRAY_TYPES = {"int": "q", "float": "d", "bool": "B"}
+_NO_BOUNDS = (float("nan"),) * 4
+
+
+def _value_type(value):
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, str):
+        return "str"
+    return "json"
+
+
+class _Column(object):
+    """
+    Accumulates the values of a single property while a snapshot is being
+    written. The column starts with the type of the first value that is not
+    null and is widened (int to float, anything to JSON) if a later value does
+    not fit.
+    """
+
+    def __init__(self, name, count):
+        self.name = name
+        self.type = None
+        self.nulls = bytearray(b"\x01" * count)
+        self.values = [None] * count
+
+    def append(self, value):
+        if value is None:
+            self.nulls.append(1)
+            self.values.append(None)
+            return
+        vtype = _value_type(value)
+        if self.type is None or self.type == vtype:
+            self.type = vtype
+        elif {self.type, vtype} == {"int", "float"}:
+            self.type = "float"
+        else:
+            self.type = "json"
+        self.nulls.append(0)
+        self.values.append(value)
+
+    def pad(self, count):
+        while len(self.nulls) < count:
+            self.append(None)
+
+    def sections(self):
+        ctype = self.type or "json"
+        yield "nulls", bytes(self.nulls)
+        if ctype in _ARRAY_TYPES:
+            if ctype == "float":
+                values = [0.0 if v is None else float(v) for v in self.values]
+            else:
+                values = [0 if v is None else int(v) for v in self.values]
+            yield "values", array(_ARRAY_TYPES[ctype], values).tobytes()
+        else:
+            offsets = array("Q", [0])
+            data = bytearray()
+            for value in self.values:
+                if value is not None:
+                    if ctype == "json":
+                        value = json.dumps(value)
+                    data += value.encode("utf-8")
+                offsets.append(len(data))
+            yield "offsets", offsets.tobytes()
+            yield "data", bytes(data)
+
+
+def write_snapshot(path, features, encode):
+    """
+    Write a snapshot of features to path. The file is written to a temporary
+    file and moved into place so that concurrent readers only ever see
+    complete snapshots.
+
+    :param str path: Location of the snapshot.
+    :param iterable features: GeoJSON features (dicts).
+    :param callable encode: Function that converts a GeoJSON geometry into
+    WKB.
+    """
+    count = 0
+    geom_offsets = array("Q", [0])
+    geom_data = bytearray()
+    boxes = array("d")
+    columns = {}
+    for feature in features:
+        geometry = feature.get("geometry")
+        if geometry:
+            geom_data += encode(geometry)
+        geom_offsets.append(len(geom_data))
+        boxes.extend(geojson_bounds(geometry) or _NO_BOUNDS)
+        properties = feature.get("properties") or {}
+        for name, value in properties.items():
+            column = columns.get(name)
+            if column is None:
+                column = columns[name] = _Column(name, count)
+            column.append(value)
+        count += 1
+        for column in columns.values():
+            column.pad(count)
+
+    directory = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            def section(data):
+                offset = f.tell()
+                f.write(data)
+                f.write(b"\0" * (-len(data) % 8))
+                return [offset, len(data)]
+
+            footer = {
+                "count": count,
+                "geometry": {
+                    "offsets": section(geom_offsets.tobytes()),
+                    "data": section(bytes(geom_data)),
+                    "bbox": section(boxes.tobytes()),
+                },
+                "columns": [],
+            }
+            for column in columns.values():
+                desc = {"name": column.name, "type": column.type or "json"}
+                for name, data in column.sections():
+                    desc[name] = section(data)
+                footer["columns"].append(desc)
+            data = json.dumps(footer).encode("utf-8")
+            f.write(data)
+            f.write(_TRAILER.pack(len(data), MAGIC))
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class Snapshot(object):
+    """
+    A read-only view of a snapshot file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        length, magic = _TRAILER.unpack_from(self.mmap, len(self.mmap) - _TRAILER.size)
+        if magic != MAGIC:
+            raise ValueError("%s is not a snapshot" % path)
+        start = len(self.mmap) - _TRAILER.size - length
+        footer = json.loads(self.mmap[start:start + length].decode("utf-8"))
+        self.count = footer["count"]
+        geometry = footer["geometry"]
+        self.geom_offsets = self._section(geometry["offsets"], "Q")
+        self.geom_data = geometry["data"][0]
+        self.boxes = self._section(geometry["bbox"], "d")
+        self.columns = {}
+        for desc in footer["columns"]:
+            self.columns[desc["name"]] = _ColumnReader(self, desc)
+
+    def __len__(self):
+        return self.count
+
+    def _section(self, section, fmt=None):
+        offset, length = section
+        view = self.view[offset:offset + length]
+        return view.cast(fmt) if fmt else view
+
+    def wkb(self, i):
+        """
+        Return the WKB of the i-th geometry, or None if it has no geometry.
+        """
+        start = self.geom_offsets[i]
+        end = self.geom_offsets[i + 1]
+        if start == end:
+            return None
+        return self.mmap[self.geom_data + start:self.geom_data + end]
+
+    def column(self, name):
+        """
+        Return a reader for the property name, or None if no feature has it.
+        """
+        return self.columns.get(name)
+
+    def close(self):
+        for column in self.columns.values():
+            column.release()
+        self.geom_offsets.release()
+        self.boxes.release()
+        self.view.release()
+        self.mmap.close()
+
+
+class _ColumnReader(object):
+    def __init__(self, snapshot, desc):
+        self.name = desc["name"]
+        self.type = desc["type"]
+        self.nulls = snapshot._section(desc["nulls"])
+        if self.type in _ARRAY_TYPES:
+            self.values = snapshot._section(desc["values"], _ARRAY_TYPES[self.type])
+            self.offsets = None
+        else:
+            self.values = None
+            self.offsets = snapshot._section(desc["offsets"], "Q")
+            self.data = snapshot._section(desc["data"])
+
+    def __len__(self):
+        return len(self.nulls)
+
+    def __getitem__(self, i):
+        if self.nulls[i]:
+            return None
+        if self.type == "bool":
+            return bool(self.values[i])
+        if self.values is not None:
+            return self.values[i]
+        value = str(self.data[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+        if self.type == "json":
+            return json.loads(value)
+        return value
+
+    def release(self):
+        for view in [self.nulls, self.values, self.offsets]:
+            if view is not None:
+                view.release()
+        if self.offsets is not None:
+            self.data.release()
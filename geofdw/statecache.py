@@ -0,0 +1,450 @@
+"""
+Cache of OpenSky state vector snapshots.
+
+The OpenSky API only updates the state vectors every few seconds (every 10
+seconds for anonymous users and every 5 for registered ones), so requests made
+within the same window all get the same data. Instead of asking the API for
+the aircraft in a bounding box or with a given transponder address on every
+query, the cache fetches the global set of state vectors once per window and
+the queries made in that window are answered from it.
+
+A snapshot is identified by its bucket (the time divided by the length of the
+window) and by whether it was requested with the extended flag, which adds the
+aircraft categories. Snapshots are kept in memory and may also be written to a
+directory shared between PostgreSQL backends: the first backend that needs a
+snapshot fetches it while holding a lock on the directory and the others wait
+for it and then read the file.
+"""
+
+import fcntl
+import heapq
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from geofdw.ewkb import points_hex
+
+# seconds between updates of the state vectors for anonymous and registered
+# users
+ANONYMOUS_RESOLUTION = 10
+USER_RESOLUTION = 5
+
+# fields of a state vector, by their index in the response of the API
+FIELDS = {
+    "icao24": 0,
+    "callsign": 1,
+    "origin_country": 2,
+    "time_position": 3,
+    "last_contact": 4,
+    "longitude": 5,
+    "latitude": 6,
+    "baro_altitude": 7,
+    "on_ground": 8,
+    "velocity": 9,
+    "true_track": 10,
+    "vertical_rate": 11,
+    "sensors": 12,
+    "geo_altitude": 13,
+    "squawk": 14,
+    "spi": 15,
+    "position_source": 16,
+    "category": 17,
+}
+
+# size in degrees of the cells of the grid index of a snapshot
+GRID_SIZE = 1.0
+
+# length in metres of a degree of latitude
+METRES_PER_DEGREE = 111195.08
+
+_NAN = float("nan")
+
+
+def get_bucket(epoch, resolution):
+    """
+    Number of the refresh window containing epoch (in seconds).
+    """
+    return int(epoch // resolution)
+
+
+class StateColumns(object):
+    """
+    The state vectors of a response decoded into columns. A column is only
+    decoded the first time it is used, and is then kept for every later query
+    of the same snapshot; fields that no query asks for are never read.
+    """
+
+    def __init__(self, states, time=None):
+        """
+        :param list states: The state vectors (lists of fields) returned by
+        the API.
+        :param int time: The time of the state vectors.
+        """
+        self.states = states or []
+        self.time = time
+        self.count = len(self.states)
+        self.columns = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return self.count
+
+    def _memo(self, key, decode):
+        value = self.columns.get(key)
+        if value is None:
+            with self.lock:
+                value = self.columns.get(key)
+                if value is None:
+                    value = self.columns[key] = decode()
+        return value
+
+    def column(self, name):
+        """
+        Return the values of the field name as a list with None for missing
+        values (e.g. the category of a state vector that is not extended).
+        """
+        i = FIELDS[name]
+
+        def decode():
+            return [s[i] if len(s) > i else None for s in self.states]
+
+        return self._memo(name, decode)
+
+    def coordinates(self):
+        """
+        Return the longitudes and latitudes as arrays of floats, with NaN for
+        aircraft without a known position.
+        """
+        def decode():
+            return tuple(array("d", [_NAN if v is None else v for v in self.column(name)])
+                         for name in ["longitude", "latitude"])
+
+        return self._memo("coordinates", decode)
+
+    def geometries(self, srid, indices=None):
+        """
+        Return the hex EWKB of the position of each aircraft: a point with the
+        geometric altitude as Z when the aircraft reports its altitude, or None
+        if its position is unknown. All the points are packed into one buffer
+        that is hex-encoded at once and then sliced.
+
+        :param sequence indices: Only return the points of these aircraft.
+        Unless the points of every aircraft have already been kept, only
+        these are encoded (and they are not kept).
+        """
+        key = ("geometries", srid)
+        if indices is not None and len(indices) < self.count and \
+                key not in self.columns:
+            x, y = self.coordinates()
+            baro = self.column("baro_altitude")
+            geo = self.column("geo_altitude")
+            z = [None if baro[i] is None else (_NAN if geo[i] is None else geo[i])
+                 for i in indices]
+            return points_hex([x[i] for i in indices], [y[i] for i in indices],
+                              z, srid)
+
+        def decode():
+            x, y = self.coordinates()
+            z = [None if b is None else (_NAN if g is None else g)
+                 for b, g in zip(self.column("baro_altitude"),
+                                 self.column("geo_altitude"))]
+            return points_hex(x, y, z, srid)
+
+        values = self._memo(key, decode)
+        if indices is None or len(indices) == self.count:
+            return values
+        return [values[i] for i in indices]
+
+    def select(self, icao24=None, bounds=None):
+        """
+        Return the indices of the aircraft with a transponder address in
+        icao24 (a string or a list of them) whose position is within bounds,
+        (minx, miny, maxx, maxy). Like the API, aircraft without a known
+        position are only selected if there are no bounds.
+        """
+        if icao24 is None:
+            if bounds is not None:
+                return self.grid().search(*bounds)
+            indices = range(self.count)
+        else:
+            if isinstance(icao24, str):
+                icao24 = [icao24]
+            lookup = self._memo("lookup", self._lookup)
+            indices = sorted(i for a in set(a.lower() for a in icao24)
+                             for i in lookup.get(a, ()))
+        if bounds is None:
+            return indices
+        x, y = self.coordinates()
+        minx, miny, maxx, maxy = bounds
+        # comparisons with NaN are false, so unknown positions are excluded
+        return [i for i in indices
+                if minx <= x[i] <= maxx and miny <= y[i] <= maxy]
+
+    def grid(self):
+        """
+        Return the grid index of the positions of the aircraft.
+        """
+        return self._memo("grid", lambda: Grid(*self.coordinates()))
+
+    def nearest(self, x, y):
+        """
+        Yield (distance, index) for the aircraft with a known position, in
+        order of their distance from (x, y); see Grid.nearest.
+        """
+        return self.grid().nearest(x, y)
+
+    def _lookup(self):
+        lookup = {}
+        for i, a in enumerate(self.column("icao24")):
+            lookup.setdefault(a, []).append(i)
+        return lookup
+
+
+class Grid(object):
+    """
+    A uniform grid index of points. Each cell of the grid lists the points
+    that lie within it, so a bounding box query only reads the points in the
+    cells that the box overlaps, and a nearest neighbour query reads the cells
+    in rings of increasing size around the query point until the remaining
+    points are known to be further away than those already found.
+    """
+
+    def __init__(self, x, y, size=GRID_SIZE):
+        """
+        :param array x: Longitudes of the points (NaN if unknown).
+        :param array y: Latitudes of the points (NaN if unknown).
+        :param float size: Width and height of a cell in degrees.
+        """
+        self.x = x
+        self.y = y
+        self.size = size
+        self.cells = {}
+        for i in range(len(x)):
+            if x[i] == x[i] and y[i] == y[i]:
+                self.cells.setdefault(self._cell(x[i], y[i]), array("I")).append(i)
+        if self.cells:
+            cxs = [cx for cx, cy in self.cells]
+            cys = [cy for cx, cy in self.cells]
+            self.extent = (min(cxs), min(cys), max(cxs), max(cys))
+
+    def _cell(self, x, y):
+        return int(math.floor(x / self.size)), int(math.floor(y / self.size))
+
+    def search(self, minx, miny, maxx, maxy):
+        """
+        Return the sorted indices of the points within the bounding box.
+        """
+        if not self.cells or minx > maxx or miny > maxy:
+            return []
+        x, y = self.x, self.y
+        x0, y0 = self._cell(max(minx, -180.0), max(miny, -90.0))
+        x1, y1 = self._cell(min(maxx, 180.0), min(maxy, 90.0))
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+            cells = [(cell, points) for cell, points in self.cells.items()
+                     if x0 <= cell[0] <= x1 and y0 <= cell[1] <= y1]
+        else:
+            cells = [((cx, cy), self.cells.get((cx, cy)))
+                     for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1)]
+        indices = []
+        for (cx, cy), points in cells:
+            if not points:
+                continue
+            if (minx <= cx * self.size and (cx + 1) * self.size <= maxx and
+                    miny <= cy * self.size and (cy + 1) * self.size <= maxy):
+                indices.extend(points)
+            else:
+                indices.extend(i for i in points
+                               if minx <= x[i] <= maxx and miny <= y[i] <= maxy)
+        indices.sort()
+        return indices
+
+    def nearest(self, qx, qy):
+        """
+        Yield (distance, index) for every point in order of increasing
+        distance from (qx, qy). The distance, in metres, is measured on a
+        plane tangent to the query point (longitudes are scaled by the
+        cosine of its latitude), which is accurate for nearby points; it does
+        not wrap around the antimeridian.
+
+        Points are yielded as soon as no point in the cells still to be read
+        can be closer, so only the cells needed for the points consumed are
+        read.
+        """
+        if not self.cells:
+            return
+        x, y, size = self.x, self.y, self.size
+        scale = math.cos(math.radians(qy))
+        cx, cy = self._cell(qx, qy)
+        x0, y0, x1, y1 = self.extent
+        rings = max(cx - x0, x1 - cx, cy - y0, y1 - cy, 0)
+        heap = []
+        for r in range(rings + 1):
+            for cell in self._ring(cx, cy, r):
+                for i in self.cells.get(cell, ()):
+                    dx = (x[i] - qx) * scale
+                    dy = y[i] - qy
+                    heapq.heappush(heap, (math.sqrt(dx * dx + dy * dy), i))
+            # the points outside the rings read so far are at least this far
+            bound = min((qx - (cx - r) * size) * scale,
+                        ((cx + r + 1) * size - qx) * scale,
+                        qy - (cy - r) * size, (cy + r + 1) * size - qy)
+            while heap and heap[0][0] <= bound:
+                d, i = heapq.heappop(heap)
+                yield d * METRES_PER_DEGREE, i
+        while heap:
+            d, i = heapq.heappop(heap)
+            yield d * METRES_PER_DEGREE, i
+
+    def _ring(self, cx, cy, r):
+        if r == 0:
+            yield cx, cy
+            return
+        for i in range(-r, r + 1):
+            yield cx + i, cy - r
+            yield cx + i, cy + r
+        for j in range(-r + 1, r):
+            yield cx - r, cy + j
+            yield cx + r, cy + j
+
+
+class StateCache(object):
+    """
+    Snapshots of the response of the /states/all endpoint, keyed by (bucket,
+    extended). Only the most recent snapshots are kept in memory, and old
+    files are removed from the directory as new ones are written.
+    """
+
+    def __init__(self, resolution, directory=None, keep=4):
+        """
+        :param float resolution: Length of a refresh window in seconds.
+        :param str directory: Directory in which to share the snapshots with
+        other processes, or None to keep them only in memory.
+        :param int keep: Number of snapshots kept in memory; files are kept for
+        as many windows.
+        """
+        self.resolution = resolution
+        self.directory = directory
+        self.keep = keep
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, bucket, extended, fetch):
+        """
+        Return the snapshot for (bucket, extended) as StateColumns, calling
+        fetch to get it from the API if no process has done so yet.
+
+        :param callable fetch: Function that returns the decoded response of
+        the API.
+        """
+        key = (bucket, bool(extended))
+        with self.lock:
+            snapshot = self.memory.get(key)
+            if snapshot is not None:
+                self.memory_hits += 1
+                return snapshot
+            if self.directory is None:
+                snapshot = fetch()
+                self.misses += 1
+            else:
+                snapshot = self._get_shared(key, fetch)
+            snapshot = StateColumns(snapshot.get("states"), snapshot.get("time"))
+            self.memory[key] = snapshot
+            while len(self.memory) > self.keep:
+                self.memory.popitem(last=False)
+            return snapshot
+
+    def stats(self):
+        """
+        Describe the hits and misses so far.
+        """
+        return "%d hits (%d memory, %d disk), %d misses" % (
+            self.memory_hits + self.disk_hits, self.memory_hits,
+            self.disk_hits, self.misses)
+
+    def _path(self, key):
+        bucket, extended = key
+        return os.path.join(self.directory, "states-%g-%d-%d.json" % (
+            self.resolution, extended, bucket))
+
+    def _get_shared(self, key, fetch):
+        path = self._path(key)
+        snapshot = self._read(path)
+        if snapshot is not None:
+            self.disk_hits += 1
+            return snapshot
+        fd = os.open(os.path.join(self.directory, "states.lock"),
+                     os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # another process may have fetched it while we waited
+            snapshot = self._read(path)
+            if snapshot is not None:
+                self.disk_hits += 1
+                return snapshot
+            snapshot = fetch()
+            self.misses += 1
+            self._write(path, snapshot)
+            self._expire()
+        finally:
+            os.close(fd)
+        return snapshot
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write(self, path, snapshot):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _expire(self):
+        """
+        Remove the files written more than keep windows ago.
+        """
+        prefix = "states-%g-" % self.resolution
+        oldest = time.time() - self.keep * self.resolution
+        for name in os.listdir(self.directory):
+            if not name.startswith(prefix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime < oldest:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_state_cache(resolution, directory=None):
+    """
+    Return the state cache shared by every table in this process with the same
+    resolution and directory.
+    """
+    key = (resolution, directory)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = StateCache(resolution, directory)
+        return cache
@@ -0,0 +1,355 @@
+"""
+Incremental parsing of GeoJSON documents that arrive in chunks.
+"""
+
+import codecs
+import json
+import re
+import zlib
+from urllib.parse import urlparse
+
+CHUNK_SIZE = 64 * 1024
+
+GZIP_MAGIC = b"\x1f\x8b"
+RECORD_SEPARATOR = b"\x1e"
+
+# media types and file extensions of GeoJSON text sequences (RFC 8142) and
+# of newline-delimited GeoJSON
+SEQUENCE_TYPES = ("application/geo+json-seq", "application/json-seq",
+                  "application/x-ndjson", "application/ndjson",
+                  "application/jsonl", "application/x-jsonlines")
+SEQUENCE_EXTENSIONS = (".geojsons", ".geojsonseq", ".geojsonl", ".geojsonld",
+                       ".ndjson", ".jsonl", ".jsonseq")
+
+GEOMETRY_TYPES = ("Point", "LineString", "Polygon", "MultiPoint",
+                  "MultiLineString", "MultiPolygon", "GeometryCollection")
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_SCALAR = re.compile(r"[^,\]}\s]+")
+_DELIMITER = re.compile(r'[{}\[\]"]')
+
+
+class FeatureReader(object):
+    """
+    Iterate over the members of the features array of a GeoJSON
+    FeatureCollection without holding the whole document in memory. Only the
+    feature currently being decoded (plus at most one unread chunk) is kept in
+    the buffer, and no more of the input is read than is needed to decode the
+    features that have been taken.
+
+    Raises ValueError if the input is not valid JSON and KeyError if the
+    top-level object has no features member, matching the errors raised when
+    indexing the result of json.loads.
+    """
+
+    def __init__(self, chunks, member="features"):
+        """
+        :param iterable chunks: Byte strings (e.g. from
+        requests.Response.iter_content) that together form the document.
+        :param str member: Name of the array to read (e.g. the states of an
+        OpenSky response); null is read as an empty array.
+        """
+        self.chunks = iter(chunks)
+        self.member = member
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def __iter__(self):
+        if self._peek() != "{":
+            raise ValueError("GeoJSON document is not an object")
+        self.pos += 1
+        while True:
+            c = self._peek()
+            if c is None:
+                raise ValueError("Unexpected end of document")
+            if c == "}":
+                raise KeyError(self.member)
+            if c == ",":
+                self.pos += 1
+                continue
+            start, end = self._value()
+            key = self.json.decode(self.buf[start:end])
+            if self._peek() != ":":
+                raise ValueError("Expected ':' after object key")
+            self.pos += 1
+            if key == self.member:
+                for feature in self._features():
+                    yield feature
+                return
+            self._value()
+
+    def _features(self):
+        if self._peek() == "n":
+            start, end = self._value()
+            if self.buf[start:end] == "null":
+                return
+        if self._peek() != "[":
+            raise ValueError("%s is not an array" % self.member)
+        self.pos += 1
+        while True:
+            c = self._peek()
+            if c is None:
+                raise ValueError("Unexpected end of document")
+            if c == "]":
+                self.pos += 1
+                return
+            if c == ",":
+                self.pos += 1
+                continue
+            start, end = self._value()
+            feature, _ = self.json.raw_decode(self.buf, start)
+            yield feature
+
+    def _fill(self):
+        """
+        Append the next chunk to the buffer. Returns False once the input is
+        exhausted.
+        """
+        if self.eof:
+            return False
+        for chunk in self.chunks:
+            if chunk:
+                self.buf += self.decoder.decode(chunk)
+                return True
+        self.buf += self.decoder.decode(b"", final=True)
+        self.eof = True
+        return False
+
+    def _peek(self):
+        """
+        Skip whitespace and return the next character without consuming it,
+        or None at the end of the input. Consumed input is discarded here,
+        between values, so that the buffer never grows beyond the current
+        value plus one chunk.
+        """
+        if self.pos > CHUNK_SIZE:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return None
+
+    def _value(self):
+        """
+        Find the extent of the JSON value at the current position, reading
+        more input as needed, and move past it. Returns (start, end) offsets
+        into the buffer.
+        """
+        c = self._peek()
+        start = self.pos
+        if c is None:
+            raise ValueError("Unexpected end of document")
+        elif c == '"':
+            end = self._string_end(start)
+        elif c in "{[":
+            end = self._container_end(start)
+        else:
+            end = self._scalar_end(start)
+        self.pos = end
+        return start, end
+
+    def _string_end(self, start):
+        while True:
+            m = _STRING.match(self.buf, start)
+            if m:
+                return m.end()
+            if not self._fill():
+                raise ValueError("Unterminated string")
+
+    def _scalar_end(self, start):
+        while True:
+            m = _SCALAR.match(self.buf, start)
+            if m is None:
+                raise ValueError("Expected a JSON value")
+            if m.end() < len(self.buf) or not self._fill():
+                return m.end()
+
+    def _container_end(self, start):
+        depth = 0
+        i = start
+        while True:
+            m = _DELIMITER.search(self.buf, i)
+            if m is None:
+                i = len(self.buf)
+                if not self._fill():
+                    raise ValueError("Unexpected end of document")
+                continue
+            c = m.group()
+            if c == '"':
+                s = _STRING.match(self.buf, m.start())
+                if s is None:
+                    i = m.start()
+                    if not self._fill():
+                        raise ValueError("Unterminated string")
+                    continue
+                i = s.end()
+            elif c in "{[":
+                depth += 1
+                i = m.end()
+            else:
+                depth -= 1
+                i = m.end()
+                if depth == 0:
+                    return i
+
+
+def iter_features(chunks, member="features"):
+    """
+    Yield each feature of a GeoJSON FeatureCollection (or each element of
+    another top-level array member) as soon as it has been read from chunks.
+    """
+    return iter(FeatureReader(chunks, member))
+
+
+def detect_format(url, content_type=None):
+    """
+    Guess whether a resource is a GeoJSON text sequence ("geojsonseq") or a
+    single GeoJSON document ("geojson"), from its media type or else from the
+    extension of its path (ignoring a trailing .gz).
+
+    :param str url: Location of the resource.
+    :param str content_type: Value of its Content-Type header, if known.
+    """
+    if content_type:
+        media_type = content_type.split(";")[0].strip().lower()
+        if media_type in SEQUENCE_TYPES:
+            return "geojsonseq"
+    path = urlparse(url).path.lower()
+    if path.endswith(".gz"):
+        path = path[:-len(".gz")]
+    if path.endswith(SEQUENCE_EXTENSIONS):
+        return "geojsonseq"
+    return "geojson"
+
+
+def decompress(chunks):
+    """
+    Decompress chunks as they are read if they start with the gzip magic
+    number, and pass them through unchanged otherwise. No more than
+    CHUNK_SIZE bytes are inflated at a time, however well the input
+    compresses, and concatenated gzip members are read one after another.
+    """
+    chunks = iter(chunks)
+    for first in chunks:
+        if first:
+            break
+    else:
+        return
+    if first[:len(GZIP_MAGIC)] != GZIP_MAGIC:
+        yield first
+        for chunk in chunks:
+            yield chunk
+        return
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in _prepend(first, chunks):
+        while True:
+            data = decompressor.decompress(chunk, CHUNK_SIZE)
+            if data:
+                yield data
+            chunk = decompressor.unconsumed_tail
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                if not chunk:
+                    break
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif not chunk and len(data) < CHUNK_SIZE:
+                break
+    if not decompressor.eof:
+        raise ValueError("Truncated gzip data")
+
+
+def _prepend(first, chunks):
+    yield first
+    for chunk in chunks:
+        yield chunk
+
+
+def iter_sequence(chunks):
+    """
+    Yield each feature of a GeoJSON text sequence (RFC 8142) or of
+    newline-delimited GeoJSON as soon as its text has been read from chunks.
+    Only the current text (plus at most one unread chunk) is held in memory.
+
+    If the input starts with a record separator, the texts are delimited by
+    record separators alone, so that they may be pretty-printed over several
+    lines; otherwise each line is a text (and any record separators in it
+    also delimit texts).
+
+    Each text may be a Feature, a FeatureCollection (whose features are
+    yielded in turn) or a bare geometry (yielded as a feature without
+    properties). As RFC 8142 asks, a text that follows a record separator but
+    cannot be parsed is taken to be truncated and skipped; otherwise the
+    errors are those of FeatureReader.
+    """
+    buf = bytearray()
+    separator = None
+    for chunk in chunks:
+        buf += chunk
+        if separator is None:
+            start = bytes(buf).lstrip()
+            if not start:
+                continue
+            separator = RECORD_SEPARATOR if start.startswith(RECORD_SEPARATOR) else b"\n"
+        end = buf.rfind(separator)
+        if end < 0:
+            continue
+        for text in bytes(buf[:end]).split(separator):
+            for feature in _iter_record(text, separator):
+                yield feature
+        del buf[:end + 1]
+    for feature in _iter_record(bytes(buf), separator):
+        yield feature
+
+
+def _iter_record(text, separator):
+    if separator == RECORD_SEPARATOR:
+        return _iter_text(text, True)
+    return _iter_line(text)
+
+
+def _iter_line(line):
+    texts = line.split(RECORD_SEPARATOR)
+    for i, text in enumerate(texts):
+        for feature in _iter_text(text, i > 0):
+            yield feature
+
+
+def _iter_text(text, truncated):
+    """
+    Yield the features of a text, skipping it if it cannot be parsed and may
+    be truncated.
+    """
+    text = text.strip()
+    if not text:
+        return
+    try:
+        value = json.loads(text)
+    except ValueError:
+        if truncated:
+            return
+        raise
+    for feature in _features(value):
+        yield feature
+
+
+def _features(value):
+    if not isinstance(value, dict):
+        raise ValueError("GeoJSON text is not an object")
+    kind = value["type"]
+    if kind == "Feature":
+        yield value
+    elif kind == "FeatureCollection":
+        for feature in value["features"]:
+            yield feature
+    elif kind in GEOMETRY_TYPES:
+        yield {"type": "Feature", "geometry": value, "properties": {}}
+    else:
+        raise KeyError("type")
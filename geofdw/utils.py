@@ -1,4 +1,9 @@
 from geofdw.exception import CRSError
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from urllib.parse import urlparse
+import os
+from urllib.request import url2pathname
 
 
 def crs_to_srid(crs):
@@ -9,3 +14,71 @@ def crs_to_srid(crs):
         return int(srid)
     except ValueError as e:
         raise CRSError(crs)
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    value = str(value).lower()
+    if value in ["1", "t", "true", "y", "yes", "on"]:
+        return True
+    if value in ["0", "f", "false", "n", "no", "off"]:
+        return False
+    raise ValueError(value)
+
+
+def local_path(url):
+    """
+    Return the path of a file:// URL or of a plain path, or None if url
+    refers to a remote resource.
+    """
+    parts = urlparse(url)
+    if parts.scheme == "file":
+        return url2pathname(parts.path)
+    if parts.scheme == "":
+        return url
+    return None
+
+
+def allowed_path(path, directories):
+    """
+    Return the real path of a local file (with symbolic links and .. resolved)
+    if it is inside one of directories, or None if it is not or if either is
+    a relative path.
+    """
+    if not os.path.isabs(path):
+        return None
+    path = os.path.realpath(path)
+    for directory in directories:
+        if not os.path.isabs(directory):
+            continue
+        directory = os.path.realpath(directory)
+        if os.path.commonpath([path, directory]) == directory:
+            return path
+    return None
+
+
+def map_unordered(function, items, max_workers):
+    """
+    Call function on each item from a pool of max_workers threads and yield
+    (item, result) as the calls complete. Items are only taken as results
+    are consumed, so that no more than max_workers calls are ever ahead of
+    the consumer: a scan that stops early (e.g. at a LIMIT) leaves the rest
+    of the items untouched.
+    """
+    items = iter(items)
+    executor = ThreadPoolExecutor(max_workers)
+    pending = {}
+    try:
+        while True:
+            for item in islice(items, max_workers - len(pending)):
+                pending[executor.submit(function, item)] = item
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
@@ -48,7 +48,8 @@ setup(
       "plpygis>=0.0.3"
     ],
     extras_require = {
-      'testing': ['pytest']
+      'testing': ['pytest'],
+      'numpy': ['numpy']
     },
     keywords='gis geographical postgis fdw postgresql'
 )
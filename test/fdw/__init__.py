@@ -1,3 +1,5 @@
 from .randompoint import RandomPointTestCase
 from .geojson import GeoJSONTestCase
+from .opensky import FlightsTestCase, TrackTestCase
+from .geocode import FGeocodeTestCase, LocalTestCase, RGeocodeTestCase
 #from .wcs import WCSTestCase
@@ -0,0 +1,187 @@
+"""
+Test geocode fdw
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from urllib.parse import urlsplit
+from plpygis import Geometry
+from geofdw.fdw.geocode import FGeocode, RGeocode
+from geofdw.replay import ReplayServer, synthetic_place
+from geofdw.exception import OptionValueError
+from multicorn import Qual
+
+def ewkb(geojson, srid=4326):
+    return Geometry.from_geojson(geojson, srid=srid).ewkb.hex()
+
+def point(x, y, srid=4326):
+    return ewkb({'type' : 'Point', 'coordinates' : [x, y]}, srid)
+
+def replay_options(server, **options):
+    """
+    Options of a table that looks up places on the replay server.
+    """
+    options.update({'service' : 'nominatim', 'domain' : urlsplit(server.url).netloc,
+                    'scheme' : 'http', 'rate_limit' : '1000', 'rate_burst' : '100'})
+    return options
+
+class LocalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'places.csv')
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write('name,latitude,longitude\nHelsinki,60.17,24.94\nEspoo,60.21,24.66\n')
+        os.environ['GEOFDW_ALLOWED_DIRS'] = self.directory
+
+    def tearDown(self):
+        os.environ.pop('GEOFDW_ALLOWED_DIRS', None)
+        shutil.rmtree(self.directory)
+
+    def test_execute(self):
+        """
+        fdw.FGeocode.execute look up places in a gazetteer with its index
+        """
+        index = os.path.join(self.directory, 'places.idx')
+        options = {'service' : 'local', 'gazetteer' : self.path, 'gazetteer_index' : index}
+        fdw = FGeocode(options, ['query', 'rank', 'address'])
+        self.assertTrue(os.path.exists(index))
+        rows = list(fdw.execute([Qual('query', '=', 'espoo')], ['query', 'rank', 'address']))
+        self.assertListEqual(rows, [{'query' : 'espoo', 'rank' : 1, 'address' : 'Espoo'}])
+
+    def test_not_allowed(self):
+        """
+        fdw.FGeocode.__init__ refuse a gazetteer or index outside of the allowed directories
+        """
+        columns = ['query', 'geom']
+        other = tempfile.mkdtemp()
+        try:
+            for options in [{'gazetteer' : '/etc/passwd'},
+                            {'gazetteer' : self.path, 'gazetteer_index' : os.path.join(other, 'places.idx')},
+                            {'gazetteer' : os.path.join(self.directory, '..', 'places.csv')}]:
+                options['service'] = 'local'
+                self.assertRaises(OptionValueError, FGeocode, options, columns)
+            self.assertListEqual(os.listdir(other), [])
+            os.environ.pop('GEOFDW_ALLOWED_DIRS')
+            self.assertRaises(OptionValueError, FGeocode, {'service' : 'local', 'gazetteer' : self.path}, columns)
+        finally:
+            shutil.rmtree(other)
+
+class FGeocodeTestCase(unittest.TestCase):
+    COLUMNS = ['query', 'rank', 'geom', 'address']
+
+    def test_execute_any(self):
+        """
+        fdw.FGeocode.execute look up each distinct query of an array once, logging from the main thread
+        """
+        threads = []
+        def log(message, level=None, *args):
+            threads.append(threading.current_thread())
+        queries = ['helsinki', 'espoo', 'helsinki', 'tampere', 'espoo']
+        with ReplayServer() as server, mock.patch('geofdw.fdw.geocode.log_to_postgres', log):
+            fdw = FGeocode(replay_options(server, max_workers='3'), self.COLUMNS)
+            requests = server.requests
+            rows = list(fdw.execute([Qual('query', ('=', True), queries)], self.COLUMNS))
+            self.assertEqual(server.requests - requests, 3)
+        self.assertListEqual(sorted(row['query'] for row in rows), sorted(queries))
+        for row in rows:
+            place = synthetic_place(row['query'])
+            geom = Geometry(row['geom'])
+            self.assertEqual(row['rank'], 1)
+            self.assertEqual(row['address'], place['display_name'])
+            self.assertAlmostEqual(geom.y, float(place['lat']))
+            self.assertAlmostEqual(geom.x, float(place['lon']))
+        self.assertTrue(threads)
+        self.assertTrue(all(thread is threading.main_thread() for thread in threads))
+
+    def test_pool_options(self):
+        """
+        fdw.FGeocode.__init__ check the options of the pooled sessions
+        """
+        for options in [{'pool_size' : '0'}, {'timeout' : '-1'}]:
+            options['service'] = 'nominatim'
+            self.assertRaises(OptionValueError, FGeocode, options, self.COLUMNS)
+
+    def test_execute_cached(self):
+        """
+        fdw.FGeocode.execute return cached results first and only look up the others
+        """
+        with ReplayServer() as server:
+            fdw = FGeocode(replay_options(server), self.COLUMNS)
+            requests = server.requests
+            rows = list(fdw.execute([Qual('query', '=', 'helsinki')], self.COLUMNS))
+            self.assertEqual(len(rows), 1)
+            self.assertEqual(server.requests - requests, 1)
+            quals = [Qual('query', ('=', True), ['espoo', 'helsinki'])]
+            rows = list(fdw.execute(quals, self.COLUMNS))
+            self.assertEqual(server.requests - requests, 2)
+        self.assertListEqual([row['query'] for row in rows], ['helsinki', 'espoo'])
+
+    def test_execute_limit(self):
+        """
+        fdw.FGeocode.execute stop looking up queries at a pushed down LIMIT
+        """
+        queries = ['place %d' % i for i in range(20)]
+        with ReplayServer() as server:
+            fdw = FGeocode(replay_options(server, max_workers='2'), self.COLUMNS)
+            quals = [Qual('query', ('=', True), queries)]
+            requests = server.requests
+            rows = list(fdw.execute(quals, self.COLUMNS, limit=3))
+            self.assertEqual(len(rows), 3)
+            self.assertLessEqual(server.requests - requests, 5)
+
+class RGeocodeTestCase(unittest.TestCase):
+    COLUMNS = ['query', 'rank', 'geom', 'address', 'point']
+
+    def test_execute(self):
+        """
+        fdw.RGeocode.execute look up a point
+        """
+        with ReplayServer() as server:
+            fdw = RGeocode(replay_options(server), self.COLUMNS)
+            query = point(24.94, 60.17)
+            rows = list(fdw.execute([Qual('query', '=', query)], self.COLUMNS))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['query'], query)
+        self.assertEqual(rows[0]['rank'], 1)
+        geom = Geometry(rows[0]['geom'])
+        self.assertEqual((round(geom.x, 5), round(geom.y, 5), geom.srid), (24.94, 60.17, 4326))
+        self.assertEqual(Geometry(rows[0]['point']).srid, 4326)
+
+    def test_execute_any(self):
+        """
+        fdw.RGeocode.execute look up each cell of an array of points once
+        """
+        with ReplayServer() as server:
+            fdw = RGeocode(replay_options(server, cache_precision='0.001'), self.COLUMNS)
+            queries = [point(24.94, 60.17), point(24.66, 60.21), point(24.9401, 60.1701)]
+            requests = server.requests
+            rows = list(fdw.execute([Qual('query', ('=', True), queries)], self.COLUMNS))
+            self.assertEqual(server.requests - requests, 2)
+        self.assertListEqual(sorted(row['query'] for row in rows), sorted(queries))
+        for row in rows:
+            # each row keeps its own point, even when it shares the result
+            self.assertEqual(row['point'], row['query'])
+            query = Geometry(row['query'])
+            geom = Geometry(row['geom'])
+            self.assertAlmostEqual(geom.x, query.x, delta=0.001)
+            self.assertAlmostEqual(geom.y, query.y, delta=0.001)
+
+    def test_execute_multipoint(self):
+        """
+        fdw.RGeocode.execute look up every point of a MULTIPOINT
+        """
+        multipoint = {'type' : 'MultiPoint', 'coordinates' : [[24.94, 60.17], [24.66, 60.21]]}
+        with ReplayServer() as server:
+            fdw = RGeocode(replay_options(server), self.COLUMNS)
+            query = ewkb(multipoint, 4258)
+            requests = server.requests
+            rows = list(fdw.execute([Qual('query', '=', query)], self.COLUMNS))
+            self.assertEqual(server.requests - requests, 2)
+        self.assertEqual(len(rows), 2)
+        self.assertTrue(all(row['query'] == query for row in rows))
+        self.assertListEqual(sorted(row['point'] for row in rows),
+                             sorted(point(x, y, 4258) for x, y in multipoint['coordinates']))
@@ -2,10 +2,19 @@
 Test GeoJSON fdw
 """
 
+import gzip
+import json
+import os
+import shutil
+import tempfile
 import unittest
+from datetime import datetime
+from decimal import Decimal
 from plpygis import Geometry, Point
 from geofdw.fdw import GeoJSON
-from geofdw.exception import MissingColumnError, MissingOptionError, OptionTypeError
+from geofdw.replay import ReplayServer, synthetic_features
+from multicorn import Qual
+from geofdw.exception import MissingColumnError, MissingOptionError, OptionTypeError, OptionValueError
 
 class GeoJSONTestCase(unittest.TestCase):
 
@@ -132,3 +141,291 @@ class GeoJSONTestCase(unittest.TestCase):
         rows = fdw.execute([], ['NAME'])
         for row in rows:
           self.assertIn(row['NAME'], ['Alex', 'Bonnie', 'Charley', 'Danielle', 'Earl', 'Frances', 'Gaston', 'Hermine', 'Ivan', 'Tropical Depression 2', 'Tropical Depression 10', 'Jeanne', 'Karl', 'Lisa', 'Matthew', 'Nicole', 'Otto'])
+
+    def test_stream_option(self):
+        """
+        fdw.GeoJSON.__init__ enable streaming
+        """
+        options = {'url' : self.EXAMPLE, 'stream' : 'true'}
+        columns = ['geom']
+        fdw = GeoJSON(options, columns)
+        self.assertEqual(fdw.stream, True)
+
+    def test_geojson_stream(self):
+        """
+        fdw.GeoJSON.execute receive streamed GeoJSON response
+        """
+        columns = ['geom', 'name']
+        with ReplayServer(chunk_size=1000) as server:
+            url = server.url + '/geojson?features=500'
+            fdw = GeoJSON({'url' : url, 'stream' : 'true'}, columns)
+            rows = list(fdw.execute([], columns))
+            self.assertListEqual(rows, list(GeoJSON({'url' : url}, columns).execute([], columns)))
+        self.assertListEqual([row['name'] for row in rows], ['feature %d' % i for i in range(500)])
+        for row in rows:
+            geom = Geometry(row["geom"])
+            self.assertIsInstance(geom, Point)
+
+    def test_format_option(self):
+        """
+        fdw.GeoJSON.__init__ set the format
+        """
+        options = {'url' : self.EXAMPLE, 'format' : 'geojsonseq'}
+        columns = ['geom']
+        fdw = GeoJSON(options, columns)
+        self.assertEqual(fdw.format, 'geojsonseq')
+        self.assertEqual(GeoJSON({'url' : self.EXAMPLE}, columns).format, None)
+
+    def test_invalid_format(self):
+        """
+        fdw.GeoJSON.__init__ set an unknown format
+        """
+        options = {'url' : self.EXAMPLE, 'format' : 'shapefile'}
+        columns = ['geom']
+        self.assertRaises(OptionValueError, GeoJSON, options, columns)
+
+    def test_cache_options(self):
+        """
+        fdw.GeoJSON.__init__ enable caching
+        """
+        options = {'url' : self.EXAMPLE, 'cache_dir' : '/tmp/geofdw-test',
+                   'cache_ttl' : '30', 'cache_size' : '10'}
+        columns = ['geom']
+        fdw = GeoJSON(options, columns)
+        self.assertEqual(fdw.cache.ttl, 30)
+        self.assertEqual(fdw.cache.max_size, 10 * 1024 * 1024)
+
+    def test_snapshot_without_cache(self):
+        """
+        fdw.GeoJSON.__init__ enable snapshot without a cache directory
+        """
+        options = {'url' : self.EXAMPLE, 'snapshot' : 'true'}
+        columns = ['geom']
+        self.assertRaises(OptionValueError, GeoJSON, options, columns)
+
+    def test_execute_projection(self):
+        """
+        fdw.GeoJSON._execute map properties onto columns case-insensitively
+        """
+        options = {'url' : self.EXAMPLE}
+        columns = ['geom', 'name', 'year']
+        fdw = GeoJSON(options, columns)
+        features = [
+            {'geometry': None, 'properties': {'NAME': 'Alex', 'YEAR': 2004, 'other': 1}},
+            {'geometry': None, 'properties': {'NAME': 'Bonnie', 'YEAR': 2004, 'other': 2}},
+            {'geometry': None, 'properties': {'name': 'Charley', 'other': 3}},
+            {'geometry': None, 'properties': None}
+        ]
+        rows = list(fdw._execute(features, ['name', 'year']))
+        self.assertListEqual(rows, [
+            {'name': 'Alex', 'year': 2004},
+            {'name': 'Bonnie', 'year': 2004},
+            {'name': 'Charley'},
+            {}
+        ])
+
+    def test_filter_types(self):
+        """
+        fdw.GeoJSON._filter leave values of other types than a qual to PostgreSQL
+        """
+        fdw = GeoJSON({'url' : self.EXAMPLE}, ['geom', 'code'])
+        values = [5, 5.0, '5', '5.0', True, 6, 'six', None]
+        features = [{'geometry': None, 'properties': {'code': v}} for v in values]
+        def kept(qual):
+            filters = fdw._get_filters([qual])
+            return [f['properties']['code'] for f in fdw._filter(features, None, filters)]
+        self.assertListEqual(kept(Qual('code', '=', '5')), [5, 5.0, '5', True, 6])
+        self.assertListEqual(kept(Qual('code', '=', 5)), [5, 5.0, '5', '5.0', True, 'six'])
+        self.assertListEqual(kept(Qual('code', ('=', True), [6, None])), [5.0, '5', '5.0', True, 6, 'six'])
+        self.assertListEqual(kept(Qual('code', '=', Decimal('5.0'))), values)
+        self.assertListEqual(kept(Qual('code', '=', datetime(2024, 1, 1))), values)
+
+    def test_path_keys(self):
+        """
+        fdw.GeoJSON.get_path_keys offer the indexed columns of a snapshot only
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            with ReplayServer() as server:
+                url = server.url + '/geojson?features=100'
+                columns = ['geom', 'id', 'name']
+                fdw = GeoJSON({'url' : url, 'cache_dir' : directory}, columns)
+                self.assertListEqual(fdw.get_path_keys(), [])
+                fdw = GeoJSON({'url' : url, 'cache_dir' : directory, 'snapshot' : 'true'}, columns)
+                self.assertListEqual(fdw.get_path_keys(), [])
+                rows = list(fdw.execute([Qual('id', '=', 7)], ['id', 'name']))
+                self.assertListEqual(rows, [{'id' : 7, 'name' : 'feature 7'}])
+                self.assertListEqual(fdw.get_path_keys(), [('id', 1)])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_local_file(self):
+        """
+        fdw.GeoJSON.execute read a local file given as a path or file URL
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            features = [{'type' : 'Feature', 'geometry' : {'type' : 'Point', 'coordinates' : [i, i]},
+                         'properties' : {'name' : 'f%d' % i}} for i in range(10)]
+            path = os.path.join(directory, 'data.geojson')
+            with open(path, 'w') as f:
+                json.dump({'type' : 'FeatureCollection', 'features' : features}, f)
+            seq = os.path.join(directory, 'data.geojsonl.gz')
+            with gzip.open(seq, 'wt') as f:
+                f.write('\n'.join(json.dumps(feature) for feature in features))
+            os.environ['GEOFDW_ALLOWED_DIRS'] = '/nonexistent' + os.pathsep + directory
+            for url in [path, 'file://' + path, seq]:
+                fdw = GeoJSON({'url' : url}, ['geom', 'name'])
+                rows = list(fdw.execute([], ['geom', 'name']))
+                self.assertListEqual([row['name'] for row in rows], ['f%d' % i for i in range(10)])
+                self.assertIsInstance(Geometry(rows[0]['geom']), Point)
+            fdw = GeoJSON({'url' : os.path.join(directory, 'missing.geojson')}, ['geom'])
+            self.assertListEqual(list(fdw.execute([], ['geom'])), [])
+        finally:
+            os.environ.pop('GEOFDW_ALLOWED_DIRS', None)
+            shutil.rmtree(directory)
+
+    def test_local_file_not_allowed(self):
+        """
+        fdw.GeoJSON.__init__ refuse local files outside of the allowed directories
+        """
+        columns = ['geom']
+        os.environ.pop('GEOFDW_ALLOWED_DIRS', None)
+        self.assertRaises(OptionValueError, GeoJSON, {'url' : '/etc/passwd'}, columns)
+        os.environ['GEOFDW_ALLOWED_DIRS'] = '/srv/geojson'
+        try:
+            for url in ['/etc/passwd', 'file:///etc/passwd', '/srv/geojson/../../etc/passwd',
+                        'data.geojson']:
+                self.assertRaises(OptionValueError, GeoJSON, {'url' : url}, columns)
+        finally:
+            os.environ.pop('GEOFDW_ALLOWED_DIRS', None)
+
+    def test_paging_options(self):
+        """
+        fdw.GeoJSON.__init__ set invalid paging options
+        """
+        columns = ['geom']
+        self.assertRaises(OptionValueError, GeoJSON, {'url' : self.EXAMPLE, 'paging' : 'cursor'}, columns)
+        self.assertRaises(OptionValueError, GeoJSON, {'url' : self.EXAMPLE, 'paging' : 'next', 'page_size' : '0'}, columns)
+        self.assertRaises(OptionValueError, GeoJSON, {'url' : '/data.geojson', 'paging' : 'offset'}, columns)
+
+    def test_paging(self):
+        """
+        fdw.GeoJSON.execute read every page of a paged API
+        """
+        with ReplayServer() as server:
+            url = server.url + '/items?features=250'
+            for paging in ['next', 'offset']:
+                fdw = GeoJSON({'url' : url, 'paging' : paging, 'page_size' : '40'}, ['geom', 'id'])
+                requests = server.requests
+                rows = list(fdw.execute([], ['id']))
+                self.assertListEqual([row['id'] for row in rows], list(range(250)))
+                self.assertEqual(server.requests - requests, 7)
+
+    def test_paging_limit(self):
+        """
+        fdw.GeoJSON.execute request no more pages than a pushed down LIMIT needs
+        """
+        with ReplayServer() as server:
+            url = server.url + '/items?features=250'
+            for paging in ['next', 'offset']:
+                fdw = GeoJSON({'url' : url, 'paging' : paging, 'page_size' : '40'}, ['geom', 'id'])
+                requests = server.requests
+                rows = list(fdw.execute([], ['id'], limit=5, offset=3))
+                self.assertListEqual([row['id'] for row in rows], list(range(3, 8)))
+                self.assertEqual(server.requests - requests, 1)
+
+    def test_paging_limit_quals(self):
+        """
+        fdw.GeoJSON.execute only pass a LIMIT on to the API when every predicate is checked here
+        """
+        with ReplayServer() as server:
+            url = server.url + '/items?features=250'
+            for paging in ['next', 'offset']:
+                fdw = GeoJSON({'url' : url, 'paging' : paging, 'page_size' : '40'}, ['geom', 'id', 'name'])
+                quals = [Qual('name', '~~', 'feature 1%')]
+                self.assertFalse(fdw.enforces(quals))
+                requests = server.requests
+                rows = list(fdw.execute(quals, ['id', 'name'], limit=5))
+                self.assertEqual(len(rows), 250)
+                self.assertEqual(server.requests - requests, 7)
+                quals = [Qual('id', ('=', True), [100, 120, 200])]
+                self.assertTrue(fdw.enforces(quals))
+                rows = list(fdw.execute(quals, ['id'], limit=2))
+                self.assertListEqual([row['id'] for row in rows], [100, 120])
+
+    def test_limit_undecided(self):
+        """
+        fdw.GeoJSON.execute stop applying a LIMIT at a value that PostgreSQL has to compare
+        """
+        with ReplayServer() as server:
+            fdw = GeoJSON({'url' : server.url + '/geojson?features=20'}, ['geom', 'id'])
+            rows = list(fdw.execute([Qual('id', '=', 3)], ['id'], limit=1))
+            self.assertListEqual(rows, [{'id' : 3}])
+            # the ids are numbers, which may be equal to the text '3'
+            rows = list(fdw.execute([Qual('id', '=', '3')], ['id'], limit=1, offset=2))
+            self.assertEqual(sorted(row['id'] for row in rows), list(range(20)))
+
+    def test_paging_capped(self):
+        """
+        fdw.GeoJSON.execute read every page of a server that caps their size
+        """
+        with ReplayServer() as server:
+            url = server.url + '/items?features=250&max_limit=30&matched=0'
+            fdw = GeoJSON({'url' : url, 'paging' : 'offset', 'page_size' : '100'}, ['geom', 'id'])
+            rows = list(fdw.execute([], ['id']))
+            self.assertListEqual([row['id'] for row in rows], list(range(250)))
+
+    def test_paging_bbox(self):
+        """
+        fdw.GeoJSON.execute send the bounding box of the query with each page
+        """
+        box = {'type' : 'Polygon', 'coordinates' : [[[0, 0], [20, 0], [20, 20], [0, 20], [0, 0]]]}
+        quals = [Qual('geom', '&&', str(Geometry.from_geojson(box, srid=4326)))]
+        features = synthetic_features(1000)['features']
+        expected = [f['properties']['id'] for f in features
+                    if 0 <= f['geometry']['coordinates'][0] <= 20 and
+                    0 <= f['geometry']['coordinates'][1] <= 20]
+        with ReplayServer() as server:
+            url = server.url + '/items?features=1000'
+            for paging in ['next', 'offset']:
+                fdw = GeoJSON({'url' : url, 'paging' : paging, 'page_size' : '10'}, ['geom', 'id'])
+                requests = server.requests
+                rows = list(fdw.execute(quals, ['id']))
+                self.assertListEqual([row['id'] for row in rows], expected)
+                # the server only returned the features in the box
+                self.assertLessEqual(server.requests - requests, len(expected) // 10 + 1)
+
+    def test_limit(self):
+        """
+        fdw.GeoJSON.execute stop reading the response at a pushed down LIMIT
+        """
+        with ReplayServer() as server:
+            fdw = GeoJSON({'url' : server.url + '/geojson?features=20000'}, ['geom', 'name'])
+            read = self.count_reads(fdw)
+            rows = list(fdw.execute([], ['name']))
+            total = read[0]
+            self.assertEqual(len(rows), 20000)
+            for limit, offset in [(10, None), (5, 100)]:
+                read[0] = 0
+                limited = list(fdw.execute([], ['name'], limit=limit, offset=offset))
+                self.assertListEqual(limited, rows[offset or 0:(offset or 0) + limit])
+                self.assertLess(read[0], total / 10)
+
+    def count_reads(self, fdw):
+        """
+        Count the bytes that a wrapper reads from its responses.
+        """
+        read = [0]
+        fetch = fdw._fetch
+        def counted_fetch(headers):
+            response = fetch(headers)
+            iter_content = response.iter_content
+            def counted(*args, **kwargs):
+                for chunk in iter_content(*args, **kwargs):
+                    read[0] += len(chunk)
+                    yield chunk
+            response.iter_content = counted
+            return response
+        fdw._fetch = counted_fetch
+        return read
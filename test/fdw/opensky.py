@@ -0,0 +1,207 @@
+"""
+Test OpenSky fdw
+"""
+
+import unittest
+from datetime import datetime
+from plpygis import Geometry
+from geofdw.fdw.opensky import Flights, Track
+from geofdw.replay import ReplayServer, synthetic_flights
+from multicorn import Qual
+
+# the start of an hour, from which the flights of the replay server are drawn
+EPOCH = 1700000000 - 1700000000 % 3600
+
+def timestamp(epoch):
+    return datetime.utcfromtimestamp(epoch)
+
+def flight_keys(flights):
+    return sorted((f["icao24"], f["firstSeen"]) for f in flights)
+
+class FlightsTestCase(unittest.TestCase):
+    def test_get_range(self):
+        """
+        fdw.Flights._get_range combine the bounds of comparisons
+        """
+        fdw = Flights({}, ['icao24'])
+        quals = [Qual('first_seen', '>=', timestamp(EPOCH)),
+                 Qual('first_seen', '>', timestamp(EPOCH + 10)),
+                 Qual('last_seen', '<=', timestamp(EPOCH + 100)),
+                 Qual('first_seen', '<', timestamp(EPOCH + 50)),
+                 Qual('icao24', '=', 'abcdef')]
+        self.assertEqual(fdw._get_range(quals, ['first_seen', 'last_seen']),
+                         (EPOCH + 10, EPOCH + 50))
+        quals = [Qual('first_seen', '=', timestamp(EPOCH))]
+        self.assertEqual(fdw._get_range(quals, ['first_seen']), (EPOCH, EPOCH))
+        self.assertEqual(fdw._get_range([], ['first_seen']), (None, None))
+
+    def test_chunks(self):
+        """
+        fdw.Flights._chunks split an interval into windows
+        """
+        fdw = Flights({}, ['icao24'])
+        self.assertListEqual(fdw._chunks(0, 10, 4), [(0, 4), (4, 8), (8, 10)])
+        self.assertListEqual(fdw._chunks(0, 8, 4), [(0, 4), (4, 8)])
+        self.assertListEqual(fdw._chunks(5, 5, 4), [(5, 5)])
+
+    def test_execute(self):
+        """
+        fdw.Flights.execute fetch the flights of each window once
+        """
+        # a flight that is seen in two windows, as it starts at the end of
+        # the first and the beginning of the second
+        boundary = synthetic_flights(EPOCH + 7200, EPOCH + 10800)[0]["firstSeen"]
+        begin, end = boundary - 7200, boundary + 5000
+        columns = ['icao24', 'first_seen', 'last_seen', 'callsign', 'departure']
+        with ReplayServer() as server:
+            fdw = Flights({'url' : server.url + '/api'}, columns)
+            quals = [Qual('first_seen', '>=', timestamp(begin)),
+                     Qual('first_seen', '<=', timestamp(end))]
+            requests = server.requests
+            rows = list(fdw.execute(quals, columns))
+            self.assertEqual(server.requests - requests, 2)
+        expected = synthetic_flights(begin, end)
+        keys = sorted((row['icao24'], int((row['first_seen'] - datetime(1970, 1, 1)).total_seconds()))
+                      for row in rows)
+        self.assertListEqual(keys, flight_keys(expected))
+        self.assertIn(boundary, [key[1] for key in keys])
+        first = [f for f in expected if f["firstSeen"] == boundary][0]
+        row = [r for r in rows if r['first_seen'] == timestamp(boundary)][0]
+        self.assertEqual(row['last_seen'], timestamp(first["lastSeen"]))
+        self.assertEqual(row['departure'], first["estDepartureAirport"])
+
+    def test_execute_endpoints(self):
+        """
+        fdw.Flights.execute look up the flights of an aircraft or an airport
+        """
+        begin, end = EPOCH, EPOCH + 4 * 86400
+        flight = synthetic_flights(EPOCH, EPOCH + 3600)[0]
+        columns = ['icao24', 'first_seen', 'departure', 'arrival']
+        with ReplayServer() as server:
+            fdw = Flights({'url' : server.url + '/api'}, columns)
+            time = [Qual('first_seen', '>=', timestamp(begin)),
+                    Qual('last_seen', '<', timestamp(end))]
+            requests = server.requests
+            rows = list(fdw.execute(time + [Qual('icao24', '=', flight["icao24"].upper())], columns))
+            # the windows of the aircraft endpoint are two days long
+            self.assertEqual(server.requests - requests, 2)
+            self.assertTrue(all(row['icao24'] == flight["icao24"] for row in rows))
+            # the flights that end after the interval are left out
+            expected = synthetic_flights(begin, end, icao24=flight["icao24"])
+            self.assertEqual(len(rows), len([f for f in expected if f["lastSeen"] < end]))
+
+            airport = flight["estDepartureAirport"]
+            rows = list(fdw.execute(time + [Qual('departure', '=', airport.lower())], columns))
+            self.assertTrue(all(airport in (row['departure'], row['arrival']) for row in rows))
+            expected = synthetic_flights(begin, end, airport=airport)
+            self.assertEqual(len(rows), len([f for f in expected if f["lastSeen"] < end]))
+
+    def test_execute_limit(self):
+        """
+        fdw.Flights.execute stop fetching windows at a pushed down LIMIT
+        """
+        columns = ['icao24', 'first_seen']
+        with ReplayServer() as server:
+            fdw = Flights({'url' : server.url + '/api', 'max_workers' : '1'}, columns)
+            quals = [Qual('first_seen', '>=', timestamp(EPOCH)),
+                     Qual('first_seen', '<=', timestamp(EPOCH + 10 * 7200))]
+            requests = server.requests
+            rows = list(fdw.execute(quals, columns, limit=3))
+            self.assertEqual(len(rows), 3)
+            self.assertEqual(server.requests - requests, 1)
+
+    def test_execute_limit_quals(self):
+        """
+        fdw.Flights.execute ignore a LIMIT when a predicate is left to PostgreSQL
+        """
+        columns = ['icao24', 'first_seen', 'callsign']
+        with ReplayServer() as server:
+            fdw = Flights({'url' : server.url + '/api', 'max_workers' : '1'}, columns)
+            quals = [Qual('first_seen', '>=', timestamp(EPOCH)),
+                     Qual('first_seen', '<=', timestamp(EPOCH + 10 * 7200)),
+                     Qual('callsign', '=', 'X')]
+            self.assertTrue(fdw.can_limit(3, None))
+            self.assertFalse(fdw.enforces(quals))
+            requests = server.requests
+            rows = list(fdw.execute(quals, columns, limit=3))
+            self.assertEqual(server.requests - requests, 10)
+        self.assertEqual(len(rows), len(synthetic_flights(EPOCH, EPOCH + 10 * 7200)))
+
+class TrackTestCase(unittest.TestCase):
+    def test_execute_time(self):
+        """
+        fdw.Track.execute fetch the track of each aircraft at a time
+        """
+        columns = ['geom', 'icao24', 'start_time', 'end_time']
+        with ReplayServer(track_points=10) as server:
+            fdw = Track({'url' : server.url + '/api'}, columns)
+            quals = [Qual('icao24', ('=', True), ['ABC123', 'def456']),
+                     Qual('time', '=', timestamp(EPOCH + 600))]
+            rows = list(fdw.execute(quals, columns))
+        self.assertListEqual(sorted(row['icao24'] for row in rows), ['abc123', 'def456'])
+        for row in rows:
+            self.assertEqual(row['start_time'], timestamp(EPOCH))
+            self.assertEqual(row['end_time'], timestamp(EPOCH + 270))
+            line = Geometry(row['geom'])
+            self.assertEqual(line.type, 'LineString')
+            self.assertEqual(line.srid, 4326)
+            self.assertTrue(line.dimz)
+            self.assertEqual(len(line.vertices), 10)
+
+    def test_execute_current(self):
+        """
+        fdw.Track.execute fetch the current track without a time
+        """
+        columns = ['icao24', 'time', 'start_time']
+        with ReplayServer() as server:
+            fdw = Track({'url' : server.url + '/api'}, columns)
+            rows = list(fdw.execute([Qual('icao24', '=', 'abc123')], columns))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['icao24'], 'abc123')
+        self.assertEqual(rows[0]['time'], rows[0]['start_time'])
+
+    def test_execute_range(self):
+        """
+        fdw.Track.execute fetch the tracks of the flights that start in a range
+        """
+        # a flight that is seen in two windows of the flights of the
+        # aircraft, which are two days long
+        flight = synthetic_flights(EPOCH, EPOCH + 3600)[0]
+        icao24 = flight["icao24"]
+        begin = flight["firstSeen"] - 2 * 86400
+        end = flight["firstSeen"] + 86400
+        expected = synthetic_flights(begin, end, icao24=icao24)
+        columns = ['icao24', 'time', 'geom']
+        with ReplayServer() as server:
+            fdw = Track({'url' : server.url + '/api'}, columns)
+            quals = [Qual('icao24', '=', icao24),
+                     Qual('time', '>=', timestamp(begin)),
+                     Qual('time', '<=', timestamp(end))]
+            requests = server.requests
+            rows = list(fdw.execute(quals, columns))
+            # two windows of flights, then one track for each flight
+            self.assertEqual(server.requests - requests, 2 + len(expected))
+        self.assertListEqual(sorted(row['time'] for row in rows),
+                             sorted(timestamp(f["firstSeen"]) for f in expected))
+        self.assertIn(timestamp(flight["firstSeen"]), [row['time'] for row in rows])
+
+    def test_linestring(self):
+        """
+        fdw.Track._linestring build a track with Z only if every point has it
+        """
+        fdw = Track({}, ['geom'])
+        path = [[0, 50.0, 1.0, 100.0, 0, False],
+                [30, 50.1, 1.1, 200.0, 0, False],
+                [60, None, None, None, 0, False],
+                [90, 50.2, 1.2, 300.0, 0, False]]
+        line = Geometry(fdw._linestring(path))
+        self.assertTrue(line.dimz)
+        self.assertEqual(line.srid, 4326)
+        self.assertEqual([(v.x, v.y, v.z) for v in line.vertices],
+                         [(1.0, 50.0, 100.0), (1.1, 50.1, 200.0), (1.2, 50.2, 300.0)])
+        path[1][3] = None
+        line = Geometry(fdw._linestring(path))
+        self.assertFalse(line.dimz)
+        self.assertEqual(len(line.vertices), 3)
+        self.assertIsNone(fdw._linestring(path[:1]))
+        self.assertIsNone(fdw._linestring(path[1:3]))
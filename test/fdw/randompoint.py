@@ -7,6 +7,7 @@ import unittest
 from plpygis import Geometry
 from geofdw.fdw import RandomPoint
 from geofdw.exception import MissingOptionError, OptionTypeError, OptionValueError
+from multicorn import Qual
 
 class RandomPointTestCase(unittest.TestCase):
     def test_missing_option(self):
@@ -60,3 +61,173 @@ class RandomPointTestCase(unittest.TestCase):
             point = Geometry(wkb)
             self.assertTrue(10 <= point.x <= 20)
             self.assertTrue(30 <= point.y <= 40)
+
+    def test_execute_batches(self):
+        """
+        fdw.RandomPoint.execute generate points across several batches
+        """
+        options = {'min_x':10, 'max_x':20, 'min_y':30, 'max_y':40, 'num': 25, 'batch_size': 7}
+        columns = ['geom']
+        fdw = RandomPoint(options, columns)
+        rows = list(fdw.execute([], columns))
+        self.assertEqual(len(rows), 25)
+        for row in rows:
+            point = Geometry(row["geom"])
+            self.assertIsNone(point.srid)
+            self.assertTrue(10 <= point.x <= 20)
+
+    def test_execute_seed(self):
+        """
+        fdw.RandomPoint.execute reproduce points with a seed
+        """
+        options = {'min_x':10, 'max_x':20, 'min_y':30, 'max_y':40, 'num': 10, 'seed': 42}
+        columns = ['geom']
+        first = list(RandomPoint(options, columns).execute([], columns))
+        second = list(RandomPoint(options, columns).execute([], columns))
+        self.assertListEqual(first, second)
+
+    def test_bad_batch_size(self):
+        """
+        fdw.RandomPoint.__init__ incorrect batch size
+        """
+        options = {'min_x':0, 'max_x':1, 'min_y':0, 'max_y':1, 'batch_size': 0}
+        columns = ['geom']
+        self.assertRaises(OptionValueError, RandomPoint, options, columns)
+
+    def test_execute_shards(self):
+        """
+        fdw.RandomPoint.execute generate the same points in any number of shards
+        """
+        options = {'min_x':10, 'max_x':20, 'min_y':30, 'max_y':40, 'num': 100,
+                   'seed': 42, 'batch_size': 7}
+        columns = ['geom', 'shard']
+        whole = [row["geom"] for row in RandomPoint(options, columns).execute([], columns)]
+        for num_shards in [2, 3, 20]:
+            shards = []
+            for shard in range(num_shards):
+                options['shard'] = shard
+                options['num_shards'] = num_shards
+                rows = list(RandomPoint(options, columns).execute([], columns))
+                self.assertTrue(all(row["shard"] == shard for row in rows))
+                shards.extend(row["geom"] for row in rows)
+            self.assertListEqual(shards, whole)
+
+    def test_execute_shard_quals(self):
+        """
+        fdw.RandomPoint.execute select a shard with predicates
+        """
+        options = {'min_x':10, 'max_x':20, 'min_y':30, 'max_y':40, 'num': 100,
+                   'seed': 42, 'batch_size': 7}
+        columns = ['geom', 'shard', 'num_shards']
+        fdw = RandomPoint(options, columns)
+        whole = [row["geom"] for row in fdw.execute([], columns)]
+        shards = []
+        for shard in range(4):
+            quals = [Qual('shard', '=', shard), Qual('num_shards', '=', 4)]
+            shards.extend(row["geom"] for row in fdw.execute(quals, columns))
+        self.assertListEqual(shards, whole)
+        quals = [Qual('shard', '=', 4), Qual('num_shards', '=', 4)]
+        self.assertListEqual(list(fdw.execute(quals, columns)), [])
+
+    def test_bad_shard(self):
+        """
+        fdw.RandomPoint.__init__ incorrect shard options
+        """
+        options = {'min_x':0, 'max_x':1, 'min_y':0, 'max_y':1, 'seed': 1, 'shard': 2, 'num_shards': 2}
+        columns = ['geom']
+        self.assertRaises(OptionValueError, RandomPoint, options, columns)
+        options = {'min_x':0, 'max_x':1, 'min_y':0, 'max_y':1, 'num_shards': 2}
+        self.assertRaises(OptionValueError, RandomPoint, options, columns)
+
+    def test_distribution_polygon(self):
+        """
+        fdw.RandomPoint.execute generate points inside a polygon
+        """
+        options = {'distribution': 'polygon', 'num': 50, 'seed': 1,
+                   'polygon': 'SRID=4326;POLYGON((0 0, 10 0, 10 10, 0 10, 0 0), (1 1, 9 1, 9 9, 1 9, 1 1))'}
+        columns = ['geom']
+        try:
+            fdw = RandomPoint(options, columns)
+        except OptionValueError:
+            self.skipTest("NumPy is not installed")
+        self.assertEqual(fdw.srid, 4326)
+        for row in fdw.execute([], columns):
+            point = Geometry(row["geom"])
+            self.assertTrue(0 <= point.x <= 10 and 0 <= point.y <= 10)
+            self.assertFalse(1 < point.x < 9 and 1 < point.y < 9)
+
+    def test_distribution_polygon_covered(self):
+        """
+        fdw.RandomPoint.execute give up on a polygon whose holes cover it
+        """
+        options = {'distribution': 'polygon', 'num': 10, 'seed': 1,
+                   'polygon': 'POLYGON((0 0, 10 0, 10 10, 0 10, 0 0), (-1 -1, 11 -1, 11 11, -1 11, -1 -1))'}
+        columns = ['geom']
+        try:
+            fdw = RandomPoint(options, columns)
+        except OptionValueError:
+            self.skipTest("NumPy is not installed")
+        self.assertRaises(OptionValueError, list, fdw.execute([], columns))
+
+    def test_distribution_poisson_disk(self):
+        """
+        fdw.RandomPoint.execute keep points apart with a Poisson disk distribution
+        """
+        options = {'min_x':0, 'max_x':10, 'min_y':0, 'max_y':10, 'num': 20,
+                   'distribution': 'poisson_disk', 'radius': 1}
+        columns = ['geom']
+        try:
+            fdw = RandomPoint(options, columns)
+        except OptionValueError:
+            self.skipTest("NumPy is not installed")
+        points = [Geometry(row["geom"]) for row in fdw.execute([], columns)]
+        self.assertEqual(len(points), 20)
+        for i, a in enumerate(points):
+            for b in points[i + 1:]:
+                self.assertTrue((a.x - b.x) ** 2 + (a.y - b.y) ** 2 >= 1)
+
+    def test_geometry_polygon(self):
+        """
+        fdw.RandomPoint.execute generate polygons
+        """
+        options = {'min_x':10, 'max_x':20, 'min_y':30, 'max_y':40, 'num': 5,
+                   'geometry': 'polygon', 'vertices': 6}
+        columns = ['geom']
+        try:
+            fdw = RandomPoint(options, columns)
+        except OptionValueError:
+            self.skipTest("NumPy is not installed")
+        for row in fdw.execute([], columns):
+            polygon = Geometry(row["geom"])
+            self.assertEqual(polygon.type, 'Polygon')
+            self.assertEqual(len(polygon.exterior.vertices), 7)
+
+    def test_limit(self):
+        """
+        fdw.RandomPoint.execute generate the same geometries up to a pushed down LIMIT
+        """
+        options = {'min_x':0, 'max_x':10, 'min_y':0, 'max_y':10, 'num': 250,
+                   'batch_size': 100, 'seed': 1}
+        columns = ['geom']
+        fdw = RandomPoint(options, columns)
+        rows = list(fdw.execute([], columns))
+        self.assertListEqual(list(fdw.execute([], columns, limit=20, offset=90)), rows[90:110])
+        self.assertListEqual(list(fdw.execute([], columns, limit=1000)), rows)
+
+    def test_limit_quals(self):
+        """
+        fdw.RandomPoint.execute only apply a LIMIT when the shards are the only predicates
+        """
+        options = {'min_x':0, 'max_x':10, 'min_y':0, 'max_y':10, 'num': 250,
+                   'batch_size': 100, 'seed': 1, 'num_shards': 2}
+        columns = ['geom', 'shard']
+        fdw = RandomPoint(options, columns)
+        self.assertTrue(fdw.can_limit(10, None))
+        quals = [Qual('shard', '=', 1)]
+        rows = list(fdw.execute(quals, columns))
+        self.assertListEqual(list(fdw.execute(quals, columns, limit=10)), rows[:10])
+        # the bounding box is checked by PostgreSQL, so every row is returned
+        box = Geometry.from_geojson({'type': 'Polygon',
+                                     'coordinates': [[[0, 0], [0, 5], [5, 5], [5, 0], [0, 0]]]})
+        quals = [Qual('geom', '&&', box.wkb)]
+        self.assertEqual(len(list(fdw.execute(quals, columns, limit=10))), 250)
@@ -0,0 +1,131 @@
+"""
+Test geofdw cache
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from geofdw.cache import FileResponse, HTTPCache
+
+class FakeResponse(object):
+  def __init__(self, status_code, body=b"", headers=None):
+    self.status_code = status_code
+    self.body = body
+    self.headers = headers or {}
+
+  def iter_content(self, chunk_size=1):
+    for i in range(0, len(self.body), chunk_size):
+      yield self.body[i:i + chunk_size]
+
+  def close(self):
+    pass
+
+class cache(unittest.TestCase):
+  URL = 'http://example.com/data.geojson'
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.requests = []
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def fetch(self, *responses):
+    responses = list(responses)
+    def fetch(headers):
+      self.requests.append(headers)
+      return responses.pop(0)
+    return fetch
+
+  def test_fresh_hit(self):
+    """
+    HTTPCache.get serving a fresh entry without a request
+    """
+    cache = HTTPCache(self.directory, ttl=60)
+    fetch = self.fetch(FakeResponse(200, b'{"a": 1}'))
+    response = cache.get(self.URL, fetch)
+    self.assertFalse(response.from_cache)
+    self.assertEqual(response.json(), {"a": 1})
+    response = cache.get(self.URL, fetch)
+    self.assertTrue(response.from_cache)
+    self.assertEqual(response.content, b'{"a": 1}')
+    self.assertEqual(len(self.requests), 1)
+
+  def test_revalidate(self):
+    """
+    HTTPCache.get revalidating a stale entry
+    """
+    cache = HTTPCache(self.directory, ttl=0)
+    headers = {'ETag': '"v1"', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+    fetch = self.fetch(FakeResponse(200, b'old', headers), FakeResponse(304))
+    version = cache.get(self.URL, fetch).version
+    response = cache.get(self.URL, fetch)
+    self.assertEqual(self.requests[1]['If-None-Match'], '"v1"')
+    self.assertEqual(self.requests[1]['If-Modified-Since'], headers['Last-Modified'])
+    self.assertTrue(response.from_cache)
+    self.assertEqual(response.version, version)
+    self.assertEqual(response.content, b'old')
+
+  def test_replace(self):
+    """
+    HTTPCache.get replacing a changed entry
+    """
+    cache = HTTPCache(self.directory, ttl=0)
+    fetch = self.fetch(FakeResponse(200, b'old'), FakeResponse(200, b'new'))
+    old = cache.get(self.URL, fetch)
+    new = cache.get(self.URL, fetch)
+    self.assertNotEqual(old.version, new.version)
+    self.assertEqual(old.content, b'old')
+    self.assertEqual(new.content, b'new')
+    bodies = [f for f in os.listdir(self.directory) if f.endswith('.body')]
+    self.assertEqual(len(bodies), 1)
+
+  def test_not_cached(self):
+    """
+    HTTPCache.get passing through an error response
+    """
+    cache = HTTPCache(self.directory)
+    error = FakeResponse(404)
+    self.assertIs(cache.get(self.URL, self.fetch(error)), error)
+
+  def test_evict(self):
+    """
+    HTTPCache.get evicting the least recently used entry
+    """
+    cache = HTTPCache(self.directory, max_size=15)
+    for url in ['http://a', 'http://b']:
+      cache.get(url, self.fetch(FakeResponse(200, b'123456')))
+    cache.get('http://a', self.fetch())
+    cache.get('http://c', self.fetch(FakeResponse(200, b'123456')))
+    self.assertEqual(len(self.requests), 3)
+    self.assertTrue(cache.get('http://a', self.fetch()).from_cache)
+    self.assertFalse(cache.get('http://b', self.fetch(FakeResponse(200, b'123456'))).from_cache)
+
+  def test_local(self):
+    """
+    HTTPCache.local versioning a file and removing files derived from old versions
+    """
+    cache = HTTPCache(self.directory)
+    path = os.path.join(self.directory, 'data.geojson')
+    with open(path, 'wb') as f:
+      f.write(b'{"a": 1}')
+    response = cache.local(path)
+    self.assertEqual(b''.join(response.iter_content(3)), b'{"a": 1}')
+    derived = cache.derived(response, 'snapshot')
+    open(derived, 'w').close()
+    self.assertEqual(cache.local(path).version, response.version)
+    self.assertTrue(os.path.exists(derived))
+    os.utime(path, ns=(0, 0))
+    changed = cache.local(path)
+    self.assertNotEqual(changed.version, response.version)
+    self.assertFalse(os.path.exists(derived))
+    self.assertEqual(changed.json(), {"a": 1})
+
+  def test_file_response_empty(self):
+    """
+    FileResponse reading an empty file
+    """
+    path = os.path.join(self.directory, 'empty.geojson')
+    open(path, 'wb').close()
+    self.assertListEqual(list(FileResponse(path).iter_content()), [])
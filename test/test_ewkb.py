@@ -0,0 +1,55 @@
+"""
+Test geofdw ewkb
+"""
+
+import unittest
+from plpygis import Geometry
+from geofdw.ewkb import MULTIPOINT, Writer, from_geojson, point, points_hex
+
+GEOMETRIES = [
+  {"type": "Point", "coordinates": [1.5, 2]},
+  {"type": "Point", "coordinates": [1.5, 2, 3]},
+  {"type": "LineString", "coordinates": [[0, 0], [1, 1], [2, 0]]},
+  {"type": "LineString", "coordinates": [[0, 0, 1], [1, 1, 2]]},
+  {"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 0]],
+                                      [[0.1, 0.1], [0.2, 0.1], [0.2, 0.2], [0.1, 0.1]]]},
+  {"type": "MultiPoint", "coordinates": [[0, 0], [1, 1]]},
+  {"type": "MultiLineString", "coordinates": [[[0, 0], [1, 1]], [[2, 2], [3, 3]]]},
+  {"type": "MultiPolygon", "coordinates": [[[[0, 0, 1], [1, 0, 1], [1, 1, 1], [0, 0, 1]]]]},
+  {"type": "GeometryCollection", "geometries": [
+    {"type": "Point", "coordinates": [1, 2]},
+    {"type": "LineString", "coordinates": [[0, 0], [1, 1]]}]},
+]
+
+class ewkb(unittest.TestCase):
+  def test_from_geojson(self):
+    """
+    from_geojson matching plpygis
+    """
+    for geometry in GEOMETRIES:
+      self.assertEqual(from_geojson(geometry),
+                       Geometry.from_geojson(geometry).wkb)
+      self.assertEqual(from_geojson(geometry, 4326).hex(),
+                       str(Geometry.from_geojson(geometry, srid=4326)))
+
+  def test_writer(self):
+    """
+    Writer reusing its buffer for geometries of any size
+    """
+    writer = Writer(4326, size=16)
+    line = [(float(i), float(i)) for i in range(1000)]
+    self.assertEqual(writer.linestring(line).hex(),
+                     str(Geometry.from_geojson({"type": "LineString", "coordinates": line}, srid=4326)))
+    self.assertEqual(writer.point(1, 2).hex(),
+                     str(Geometry.from_geojson({"type": "Point", "coordinates": [1, 2]}, srid=4326)))
+    self.assertEqual(writer.multi(MULTIPOINT, [[0, 0], [1, 1]]),
+                     from_geojson(GEOMETRIES[5], 4326))
+
+  def test_points_hex(self):
+    """
+    points_hex with and without Z or a position
+    """
+    points = points_hex([1.0, float("nan"), 2.0], [2.0, 0.0, 3.0], [None, None, 5.0], 4326)
+    self.assertEqual(points[0], point(1.0, 2.0, srid=4326).hex())
+    self.assertIsNone(points[1])
+    self.assertEqual(points[2], point(2.0, 3.0, 5.0, srid=4326).hex())
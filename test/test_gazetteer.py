@@ -0,0 +1,110 @@
+"""
+Test geofdw gazetteer
+"""
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from geofdw.gazetteer import Gazetteer, open_gazetteer, read_places, tokenize
+
+PLACES = [
+  ("Helsinki", 24.94, 60.17),
+  ("Espoo", 24.66, 60.21),
+  ("Tampere", 23.76, 61.50),
+  ("Jyväskylä", 25.75, 62.24),
+  ("New Helsinki Road", -0.1, 51.5),
+]
+
+class gazetteer(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.gazetteer = Gazetteer(PLACES)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_tokenize(self):
+    """
+    tokenize normalising case, accents and punctuation
+    """
+    self.assertListEqual(tokenize("Jyväskylä, FINLAND"), ["jyvaskyla", "finland"])
+
+  def test_geocode_exact(self):
+    """
+    Gazetteer.geocode ranking exact matches by length
+    """
+    locations = self.gazetteer.geocode("helsinki", False)
+    self.assertListEqual([l.address for l in locations], ["Helsinki", "New Helsinki Road"])
+    self.assertEqual(self.gazetteer.geocode("JYVASKYLA").latitude, 62.24)
+
+  def test_geocode_prefix(self):
+    """
+    Gazetteer.geocode matching prefixes
+    """
+    self.assertEqual(self.gazetteer.geocode("tamp").address, "Tampere")
+
+  def test_geocode_fuzzy(self):
+    """
+    Gazetteer.geocode matching misspelled tokens
+    """
+    self.assertEqual(self.gazetteer.geocode("helsinky road").address, "New Helsinki Road")
+    self.assertIsNone(self.gazetteer.geocode("oulu"))
+
+  def test_geocode_bounds(self):
+    """
+    Gazetteer.geocode restricting results to a bounding box
+    """
+    locations = self.gazetteer.geocode("helsinki", False, bounds=(50, -1, 52, 1))
+    self.assertListEqual([l.address for l in locations], ["New Helsinki Road"])
+
+  def test_reverse(self):
+    """
+    Gazetteer.reverse finding the nearest places
+    """
+    self.assertEqual(self.gazetteer.reverse((60.2, 24.7)).address, "Espoo")
+    locations = self.gazetteer.reverse((60.2, 24.9), False, limit=3)
+    self.assertListEqual([l.address for l in locations], ["Helsinki", "Espoo", "Tampere"])
+
+  def test_read_csv(self):
+    """
+    read_places reading a CSV file
+    """
+    path = os.path.join(self.directory, "places.csv")
+    with open(path, "w", encoding="utf-8") as f:
+      f.write("name,Lat,Lon\nHelsinki,60.17,24.94\nNowhere,,\n")
+    self.assertListEqual(list(read_places(path)), [("Helsinki", 24.94, 60.17)])
+
+  def test_open_gazetteer(self):
+    """
+    open_gazetteer saving and reusing the index
+    """
+    path = os.path.join(self.directory, "places.csv")
+    index = os.path.join(self.directory, "places.idx")
+    with open(path, "w", encoding="utf-8") as f:
+      f.write("name,latitude,longitude\nHelsinki,60.17,24.94\n")
+    gazetteer = open_gazetteer(path, index, limit=5)
+    self.assertEqual(gazetteer.limit, 5)
+    self.assertTrue(os.path.exists(index))
+    self.assertEqual(open_gazetteer(path, index).geocode("helsinki").longitude, 24.94)
+
+  def test_load(self):
+    """
+    Gazetteer.load reading only an index of the same gazetteer, and never unpickling
+    """
+    index = os.path.join(self.directory, "places.idx")
+    self.gazetteer.save(index, ["places.csv", 1])
+    gazetteer = Gazetteer.load(index, ["places.csv", 1])
+    for name in ["names", "x", "y", "lengths", "tree", "tokens", "postings", "trigrams"]:
+      self.assertEqual(getattr(gazetteer, name), getattr(self.gazetteer, name))
+    self.assertEqual(gazetteer.reverse((60.2, 24.7)).address, "Espoo")
+    self.assertIsNone(Gazetteer.load(index, ["places.csv", 2]))
+    with open(index, "rb") as f:
+      data = f.read()
+    with open(index, "wb") as f:
+      f.write(data[:-4])
+    self.assertIsNone(Gazetteer.load(index, ["places.csv", 1]))
+    with open(index, "wb") as f:
+      pickle.dump((1, None, self.gazetteer), f)
+    self.assertIsNone(Gazetteer.load(index))
@@ -0,0 +1,98 @@
+"""
+Test geofdw geocache
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from geofdw.geocache import GeocodeCache, Location, forward_key, reverse_key, to_locations
+
+HELSINKI = [Location("Helsinki, Finland", 60.17, 24.94, 0.0)]
+
+class geocache(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, "geocode.sqlite")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_forward_key(self):
+    """
+    forward_key normalising case and whitespace
+    """
+    self.assertEqual(forward_key("nominatim", "Helsinki,  Finland"),
+                     forward_key("nominatim", " helsinki, FINLAND "))
+    self.assertNotEqual(forward_key("nominatim", "Helsinki"),
+                        forward_key("arcgis", "Helsinki"))
+    self.assertNotEqual(forward_key("googlev3", "Helsinki"),
+                        forward_key("googlev3", "Helsinki", (24, 60, 25, 61)))
+
+  def test_reverse_key(self):
+    """
+    reverse_key snapping coordinates to a grid
+    """
+    self.assertEqual(reverse_key("nominatim", 24.9400001, 60.17, 0.0001),
+                     reverse_key("nominatim", 24.94, 60.1700004, 0.0001))
+    self.assertNotEqual(reverse_key("nominatim", 24.94, 60.17, 0.0001),
+                        reverse_key("nominatim", 24.9402, 60.17, 0.0001))
+
+  def test_to_locations(self):
+    """
+    to_locations converting geocoder results
+    """
+    self.assertListEqual(to_locations(None), [])
+    self.assertListEqual(to_locations(HELSINKI[0]), HELSINKI)
+    self.assertListEqual(to_locations(HELSINKI), HELSINKI)
+
+  def test_memory(self):
+    """
+    GeocodeCache.get returning results cached in memory
+    """
+    cache = GeocodeCache()
+    self.assertIsNone(cache.get("a"))
+    cache.set("a", HELSINKI)
+    self.assertListEqual(cache.get("a"), HELSINKI)
+    self.assertEqual((cache.memory_hits, cache.disk_hits, cache.misses), (1, 0, 1))
+
+  def test_lru(self):
+    """
+    GeocodeCache.set evicting the least recently used entry
+    """
+    cache = GeocodeCache(entries=2)
+    cache.set("a", HELSINKI)
+    cache.set("b", HELSINKI)
+    cache.get("a")
+    cache.set("c", HELSINKI)
+    self.assertIsNotNone(cache.get("a"))
+    self.assertIsNone(cache.get("b"))
+    self.assertIsNotNone(cache.get("c"))
+
+  def test_ttl(self):
+    """
+    GeocodeCache.get ignoring expired and negative results
+    """
+    cache = GeocodeCache(ttl=0, negative_ttl=60)
+    cache.set("a", HELSINKI)
+    cache.set("b", [])
+    self.assertIsNone(cache.get("a"))
+    self.assertListEqual(cache.get("b"), [])
+    cache = GeocodeCache(ttl=60, negative_ttl=0)
+    cache.set("b", [])
+    self.assertIsNone(cache.get("b"))
+
+  def test_disk(self):
+    """
+    GeocodeCache.get sharing results through the database
+    """
+    first = GeocodeCache(path=self.path)
+    first.set("a", HELSINKI)
+    first.set("b", [])
+    second = GeocodeCache(entries=0, path=self.path)
+    self.assertListEqual(second.get("a"), HELSINKI)
+    self.assertListEqual(second.get("b"), [])
+    self.assertIsNone(second.get("c"))
+    self.assertEqual(second.stats(), "2 hits (0 memory, 2 disk), 1 misses")
+    first.close()
+    second.close()
@@ -3,8 +3,12 @@ Test basic geofdw
 """
 
 import unittest
+from urllib.request import Request
+from requests.cookies import create_cookie
 
-from geofdw.base import GeoFDW
+from geofdw.base import GeoFDW, PoolStats, get_session
+from geofdw.exception import OptionValueError
+from multicorn import Qual
 
 class GeoFDWTestCase(unittest.TestCase):
   def test_init(self):
@@ -13,3 +17,53 @@ class GeoFDWTestCase(unittest.TestCase):
     """
     fdw = GeoFDW({}, ['geom'])
     self.assertListEqual(fdw.columns, ['geom'])
+
+  def test_get_session(self):
+    """
+    GeoFDW.get_session sharing sessions by host and settings
+    """
+    fdw = GeoFDW({}, ['geom'])
+    session = fdw.get_session('https://example.com/a.geojson')
+    self.assertIs(session, fdw.get_session('https://example.com/b.geojson'))
+    self.assertIsNot(session, fdw.get_session('https://example.org/a.geojson'))
+    self.assertIs(session, get_session('https://example.com/c.geojson'))
+    fdw = GeoFDW({'timeout': '5', 'compress': 'false'}, ['geom'])
+    other = fdw.get_session('https://example.com/a.geojson')
+    self.assertIsNot(session, other)
+    self.assertEqual(other.timeout, 5)
+    self.assertEqual(other.headers['Accept-Encoding'], 'identity')
+
+  def test_get_session_bad_option(self):
+    """
+    GeoFDW.get_session incorrect pool size
+    """
+    fdw = GeoFDW({'pool_size': '0'}, ['geom'])
+    self.assertRaises(OptionValueError, fdw.get_session, 'https://example.com')
+
+  def test_pool_stats(self):
+    """
+    PoolStats reporting reused connections
+    """
+    stats = PoolStats('example.com')
+    for i in range(4):
+      stats.requested()
+    stats.connected(0.01)
+    self.assertEqual(str(stats), 'example.com: 4 requests, 1 connections (75% reused), 10.0 ms average connect time')
+
+  def test_get_limit(self):
+    """
+    GeoFDW.get_limit ignoring a LIMIT unless every qual is enforced
+    """
+    fdw = GeoFDW({}, ['geom', 'name'])
+    self.assertFalse(fdw.can_limit(10, None))
+    self.assertEqual(fdw.get_limit([], 10, 5), (10, 5))
+    self.assertEqual(fdw.get_limit([Qual('name', '=', 'a')], 10, 5), (None, None))
+
+  def test_session_cookies(self):
+    """
+    PooledSession keeping no cookies between tables
+    """
+    session = get_session('https://cookies.example.com/')
+    cookie = create_cookie('session', 'secret', domain='cookies.example.com')
+    session.cookies.set_cookie_if_ok(cookie, Request('https://cookies.example.com/'))
+    self.assertEqual(len(session.cookies), 0)
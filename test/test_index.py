@@ -0,0 +1,117 @@
+"""
+Test geofdw index
+"""
+
+import os
+import random
+import tempfile
+import unittest
+from decimal import Decimal
+from geofdw.index import HashIndex, RTree, geojson_bounds, hash_key
+
+class index(unittest.TestCase):
+  def brute_force(self, boxes, query):
+    results = []
+    for i in range(len(boxes) // 4):
+      box = boxes[4 * i:4 * i + 4]
+      if box[0] != box[0]:
+        continue
+      if not (query[2] < box[0] or query[3] < box[1] or query[0] > box[2] or query[1] > box[3]):
+        results.append(i)
+    return results
+
+  def random_boxes(self, n):
+    rand = random.Random(n)
+    boxes = []
+    for i in range(n):
+      if i % 50 == 0:
+        boxes.extend([float('nan')] * 4)
+        continue
+      x = rand.uniform(-180, 180)
+      y = rand.uniform(-90, 90)
+      boxes.extend([x, y, x + rand.random(), y + rand.random()])
+    return boxes
+
+  def test_geojson_bounds(self):
+    """
+    geojson_bounds calculating the bounds of GeoJSON geometries
+    """
+    point = {'type': 'Point', 'coordinates': [1, 2]}
+    polygon = {'type': 'MultiPolygon', 'coordinates': [[[[0, 0], [3, -1], [2, 5], [0, 0]]], [[[-4, 1], [-3, 1], [-3, 2], [-4, 1]]]]}
+    collection = {'type': 'GeometryCollection', 'geometries': [point, polygon]}
+    self.assertEqual(geojson_bounds(point), (1, 2, 1, 2))
+    self.assertEqual(geojson_bounds(polygon), (-4, -1, 3, 5))
+    self.assertEqual(geojson_bounds(collection), (-4, -1, 3, 5))
+    self.assertIsNone(geojson_bounds(None))
+    self.assertIsNone(geojson_bounds({'type': 'LineString', 'coordinates': []}))
+
+  def test_hash_key(self):
+    """
+    hash_key only keying values whose equality can be decided here
+    """
+    self.assertEqual(hash_key('5'), hash_key('5'))
+    self.assertNotEqual(hash_key(5), hash_key('5'))
+    self.assertNotEqual(hash_key(True), hash_key(1))
+    self.assertNotEqual(hash_key('5.0'), hash_key('5'))
+    self.assertIsNone(hash_key(5.0))
+    self.assertIsNone(hash_key(Decimal('5.0')))
+    self.assertIsNone(hash_key({'a': 1}))
+
+  def test_hash_index(self):
+    """
+    HashIndex.lookup finding rows by value and keeping those it cannot compare
+    """
+    index = HashIndex(['FRA', 'DEU', None, 'FRA', 5, 5.0, {'a': 1}])
+    self.assertEqual(len(index), 3)
+    self.assertListEqual(list(index.lookup({hash_key('FRA')})), [0, 3, 4, 5, 6])
+    self.assertListEqual(list(index.lookup({hash_key(5)})), [0, 1, 3, 4, 5, 6])
+    self.assertListEqual(list(index.lookup({hash_key('ITA')})), [4, 5, 6])
+    self.assertListEqual(list(index.lookup({hash_key('FRA'), hash_key(6)})), [0, 3, 5, 6])
+    self.assertListEqual(list(index.nulls), [2])
+
+  def test_hash_index_decides(self):
+    """
+    HashIndex.decides only when every value has the type of the keys
+    """
+    index = HashIndex(['FRA', None, 'DEU'])
+    self.assertTrue(index.decides({hash_key('ITA')}))
+    self.assertFalse(index.decides({hash_key(5)}))
+    self.assertTrue(index.decides({hash_key('ITA'), hash_key(5)}))
+    self.assertFalse(HashIndex(['FRA', 5.0]).decides({hash_key('FRA')}))
+
+  def test_rtree_search(self):
+    """
+    RTree.search finding the same boxes as a linear scan
+    """
+    boxes = self.random_boxes(3000)
+    rtree = RTree.build(boxes)
+    rand = random.Random(0)
+    for i in range(100):
+      x = rand.uniform(-180, 180)
+      y = rand.uniform(-90, 90)
+      query = (x, y, x + rand.uniform(0, 40), y + rand.uniform(0, 40))
+      self.assertListEqual(rtree.search(*query), self.brute_force(boxes, query))
+
+  def test_rtree_small(self):
+    """
+    RTree.search on trees with zero or one items
+    """
+    self.assertListEqual(RTree.build([]).search(0, 0, 1, 1), [])
+    self.assertListEqual(RTree.build([0, 0, 1, 1]).search(0.5, 0.5, 2, 2), [0])
+    self.assertListEqual(RTree.build([0, 0, 1, 1]).search(2, 2, 3, 3), [])
+
+  def test_rtree_save_load(self):
+    """
+    RTree.save and RTree.load round trip
+    """
+    boxes = self.random_boxes(500)
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      RTree.build(boxes).save(path)
+      rtree = RTree.load(path)
+      query = (-50, -20, 50, 20)
+      self.assertListEqual(rtree.search(*query), self.brute_force(boxes, query))
+      rtree.close()
+    finally:
+      os.remove(path)
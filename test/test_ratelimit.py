@@ -0,0 +1,115 @@
+"""
+Test geofdw ratelimit
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from geofdw.ratelimit import Scheduler, SharedTokenBucket, TokenBucket, get_bucket
+
+class ratelimit(unittest.TestCase):
+  def test_unlimited(self):
+    """
+    TokenBucket.acquire without a rate
+    """
+    bucket = TokenBucket(None)
+    start = time.monotonic()
+    for i in range(1000):
+      bucket.acquire()
+    self.assertLess(time.monotonic() - start, 0.1)
+
+  def test_rate(self):
+    """
+    TokenBucket.acquire spacing requests
+    """
+    bucket = TokenBucket(20, burst=2)
+    start = time.monotonic()
+    for i in range(6):
+      bucket.acquire()
+    # two requests in the burst and four more at 20 per second
+    self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+  def test_pause(self):
+    """
+    TokenBucket.pause holding back requests
+    """
+    bucket = TokenBucket(None)
+    bucket.pause(0.1)
+    start = time.monotonic()
+    bucket.acquire()
+    self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+  def test_shared(self):
+    """
+    SharedTokenBucket.acquire sharing tokens through a file
+    """
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, "service.bucket")
+      first = SharedTokenBucket(path, 20)
+      second = SharedTokenBucket(path, 20)
+      start = time.monotonic()
+      for i in range(3):
+        first.acquire()
+        second.acquire()
+      # the second bucket waits for the tokens taken by the first
+      self.assertGreaterEqual(time.monotonic() - start, 0.24)
+    finally:
+      shutil.rmtree(directory)
+
+  def test_scheduler_retry(self):
+    """
+    Scheduler.call retrying failed requests
+    """
+    errors = [IOError("503"), IOError("503")]
+    def request():
+      if errors:
+        raise errors.pop()
+      return "ok"
+    scheduler = Scheduler(TokenBucket(None), retries=2, backoff=0.01,
+                          retry_after=lambda e: 0)
+    retried = []
+    self.assertEqual(scheduler.call(request, retried), "ok")
+    self.assertEqual(len(retried), 2)
+
+  def test_scheduler_give_up(self):
+    """
+    Scheduler.call raising errors that are not retried or keep recurring
+    """
+    def request():
+      raise IOError("503")
+    scheduler = Scheduler(TokenBucket(None), retries=2, backoff=0.01)
+    self.assertRaises(IOError, scheduler.call, request)
+    calls = []
+    def retry_after(error):
+      calls.append(error)
+      return 0
+    scheduler = Scheduler(TokenBucket(None), retries=2, backoff=0.01,
+                          retry_after=retry_after)
+    self.assertRaises(IOError, scheduler.call, request)
+    self.assertEqual(len(calls), 3)
+
+  def test_get_bucket(self):
+    """
+    get_bucket sharing buckets by service
+    """
+    self.assertIs(get_bucket("nominatim"), get_bucket("nominatim"))
+    self.assertEqual(get_bucket("nominatim").rate, 1.0)
+    self.assertIsNone(get_bucket("arcgis").rate)
+    self.assertEqual(get_bucket("arcgis", 5).rate, 5)
+
+  def test_get_bucket_shared(self):
+    """
+    get_bucket keeping the state of buckets with different limits apart
+    """
+    directory = tempfile.mkdtemp()
+    try:
+      paths = set(get_bucket("nominatim", rate, burst, directory).path
+                  for rate, burst in [(None, 1), (1, 1), (2, 1), (1, 2), (1.0, 1)])
+      # no rate is the default rate of the service, 1
+      self.assertEqual(len(paths), 3)
+      self.assertTrue(all(os.path.dirname(path) == directory for path in paths))
+    finally:
+      shutil.rmtree(directory)
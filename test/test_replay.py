@@ -0,0 +1,77 @@
+"""
+Test geofdw replay
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import requests
+from geofdw.replay import ReplayServer, request_key
+
+class replay(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.server = ReplayServer(directory=self.directory, aircraft=500).start()
+
+  def tearDown(self):
+    self.server.stop()
+    shutil.rmtree(self.directory)
+
+  def test_request_key(self):
+    """
+    request_key ignoring the order of parameters
+    """
+    self.assertEqual(request_key("/search", "q=a&format=json"),
+                     request_key("/search", "format=json&q=a"))
+    self.assertNotEqual(request_key("/search", "q=a"), request_key("/search", "q=b"))
+
+  def test_geojson(self):
+    """
+    ReplayServer synthetic GeoJSON
+    """
+    url = self.server.url + "/geojson?features=25&properties=4"
+    first = requests.get(url).json()
+    self.assertEqual(len(first["features"]), 25)
+    self.assertEqual(len(first["features"][0]["properties"]), 4)
+    self.assertEqual(requests.get(url).json(), first)
+
+  def test_states(self):
+    """
+    ReplayServer OpenSky state vectors filtered by bounds
+    """
+    url = self.server.url + "/api/states/all"
+    params = {"time": 1700000000}
+    everything = requests.get(url, params=params).json()["states"]
+    self.assertEqual(len(everything), 500)
+    params.update(lamin=0, lomin=0, lamax=60, lomax=90)
+    states = requests.get(url, params=params).json()["states"]
+    self.assertEqual(states, [s for s in everything if s[5] is not None and
+                              0 <= s[5] <= 90 and 0 <= s[6] <= 60])
+
+  def test_recorded(self):
+    """
+    ReplayServer replaying a recorded response
+    """
+    path = os.path.join(self.directory, request_key("/search", "q=Helsinki&format=json"))
+    with open(path, "wb") as f:
+      f.write(json.dumps({"status": 200, "content_type": "application/json"}).encode() + b"\n")
+      f.write(b'[{"lat": "60.17", "lon": "24.94", "display_name": "Helsinki"}]')
+    response = requests.get(self.server.url + "/search?format=json&q=Helsinki")
+    self.assertEqual(response.json()[0]["lat"], "60.17")
+    response = requests.get(self.server.url + "/search?format=json&q=Espoo")
+    self.assertEqual(response.json()[0]["display_name"], "Espoo")
+
+  def test_items(self):
+    """
+    ReplayServer pages of features with a next link
+    """
+    url = self.server.url + "/items?features=25&limit=10"
+    page = requests.get(url, params={"offset": 20}).json()
+    self.assertEqual(page["numberMatched"], 25)
+    self.assertEqual([f["properties"]["id"] for f in page["features"]], list(range(20, 25)))
+    self.assertListEqual(page["links"], [])
+    page = requests.get(url).json()
+    next_page = requests.get(self.server.url + page["links"][0]["href"]).json()
+    self.assertEqual(next_page["features"][0]["properties"]["id"], 10)
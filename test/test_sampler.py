@@ -0,0 +1,56 @@
+"""
+Test geofdw sampler
+"""
+
+import unittest
+
+try:
+  import numpy
+  from geofdw.sampler import contains, ewkb_header, triangulate
+except ImportError:
+  numpy = None
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class sampler(unittest.TestCase):
+  def test_triangulate_convex(self):
+    """
+    triangulate splitting a square into two triangles
+    """
+    triangles = triangulate([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)])
+    self.assertEqual(len(triangles), 2)
+
+  def test_triangulate_concave(self):
+    """
+    triangulate covering the area of a concave ring
+    """
+    ring = [(0, 0), (10, 0), (10, 10), (5, 3), (0, 10), (0, 0)]
+    triangles = triangulate(ring)
+    self.assertEqual(len(triangles), 3)
+    area = sum(abs((b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])) / 2
+               for a, b, c in triangles)
+    self.assertAlmostEqual(area, 65)
+
+  def test_triangulate_clockwise(self):
+    """
+    triangulate a clockwise ring with a collinear vertex
+    """
+    triangles = triangulate([(0, 0), (0, 1), (1, 1), (1, 0.5), (1, 0), (0, 0)])
+    area = sum(abs((b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])) / 2
+               for a, b, c in triangles)
+    self.assertAlmostEqual(area, 1)
+
+  def test_contains(self):
+    """
+    contains testing points against a ring
+    """
+    ring = numpy.array([(0, 0), (2, 0), (2, 2), (0, 2), (0, 0)], dtype=float)
+    x = numpy.array([1, 3, -1, 1.5])
+    y = numpy.array([1, 1, 1, 1.9])
+    self.assertListEqual(list(contains(ring, x, y)), [True, False, False, True])
+
+  def test_ewkb_header(self):
+    """
+    ewkb_header with and without a SRID
+    """
+    self.assertEqual(ewkb_header(1, None).hex(), '0101000000')
+    self.assertEqual(ewkb_header(1, 4326).hex(), '0101000020e6100000')
@@ -0,0 +1,70 @@
+"""
+Test geofdw snapshot
+"""
+
+import json
+import os
+import tempfile
+import unittest
+from geofdw.snapshot import Snapshot, write_snapshot
+
+class snapshot(unittest.TestCase):
+  def setUp(self):
+    fd, self.path = tempfile.mkstemp()
+    os.close(fd)
+
+  def tearDown(self):
+    os.remove(self.path)
+
+  def encode(self, geometry):
+    return json.dumps(geometry).encode('utf-8')
+
+  def test_roundtrip(self):
+    """
+    write_snapshot and Snapshot storing geometries and typed properties
+    """
+    features = []
+    for i in range(10):
+      properties = {
+        'int': i,
+        'float': i / 2.0 if i % 2 else i,
+        'text': 'feature %d' % i,
+        'bool': i % 2 == 0,
+        'mixed': i if i % 2 else 'even',
+        'nested': {'list': [i]}
+      }
+      if i > 5:
+        properties['late'] = i
+      geometry = {'type': 'Point', 'coordinates': [i, i]} if i % 3 else None
+      features.append({'type': 'Feature', 'geometry': geometry, 'properties': properties})
+    write_snapshot(self.path, features, self.encode)
+
+    snapshot = Snapshot(self.path)
+    self.assertEqual(len(snapshot), 10)
+    self.assertEqual(snapshot.column('int').type, 'int')
+    self.assertEqual(snapshot.column('float').type, 'float')
+    self.assertEqual(snapshot.column('mixed').type, 'json')
+    self.assertIsNone(snapshot.column('missing'))
+    for i, feature in enumerate(features):
+      wkb = snapshot.wkb(i)
+      self.assertEqual(wkb and json.loads(wkb.decode('utf-8')), feature['geometry'])
+      for name in ['int', 'float', 'text', 'bool', 'mixed', 'nested', 'late']:
+        self.assertEqual(snapshot.column(name)[i], feature['properties'].get(name))
+    snapshot.close()
+
+  def test_empty(self):
+    """
+    write_snapshot and Snapshot storing no features
+    """
+    write_snapshot(self.path, [], self.encode)
+    snapshot = Snapshot(self.path)
+    self.assertEqual(len(snapshot), 0)
+    snapshot.close()
+
+  def test_not_snapshot(self):
+    """
+    Snapshot opening a file that is not a snapshot
+    """
+    with open(self.path, 'wb') as f:
+      f.write(b'{"type": "FeatureCollection", "features": []}')
+    self.assertRaises(ValueError, Snapshot, self.path)
@@ -0,0 +1,141 @@
+"""
+Test geofdw statecache
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import random
+from array import array
+from geofdw.statecache import Grid, StateCache, StateColumns, get_bucket
+from plpygis import Point
+
+STATES = [
+  ["4b1806", "SWR100", "Switzerland", 0, 0, 8.5, 47.4, 1000.0, False, 200.0, 90.0, 0.0, None, 1050.0],
+  ["3c6444", "DLH4AB", "Germany", 0, 0, 13.4, 52.5, None, True, 0.0, 0.0, 0.0, None, None],
+  ["a0b1c2", "UAL1", "United States", 0, 0, None, None, None, False, None, None, None, None, None],
+]
+
+class statecache(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.fetches = 0
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def fetch(self):
+    self.fetches += 1
+    return {"time": 100, "states": STATES}
+
+  def test_get_bucket(self):
+    """
+    get_bucket numbering refresh windows
+    """
+    self.assertEqual(get_bucket(100, 10), 10)
+    self.assertEqual(get_bucket(109.9, 10), 10)
+    self.assertEqual(get_bucket(110, 10), 11)
+
+  def test_select(self):
+    """
+    StateColumns.select by icao24 and bounds
+    """
+    states = StateColumns(STATES)
+    self.assertEqual(list(states.select()), [0, 1, 2])
+    self.assertEqual(states.select(icao24="3C6444"), [1])
+    self.assertEqual(states.select(icao24=["a0b1c2", "4b1806"]), [0, 2])
+    self.assertEqual(states.select(bounds=(5, 45, 10, 50)), [0])
+    self.assertEqual(states.select(icao24="3c6444", bounds=(5, 45, 10, 50)), [])
+
+  def test_columns(self):
+    """
+    StateColumns decoding only the columns used
+    """
+    states = StateColumns(STATES)
+    self.assertEqual(states.column("callsign"), ["SWR100", "DLH4AB", "UAL1"])
+    self.assertEqual(states.column("category"), [None, None, None])
+    self.assertEqual(sorted(states.columns), ["callsign", "category"])
+
+  def test_geometries(self):
+    """
+    StateColumns encoding positions as EWKB
+    """
+    geometries = StateColumns(STATES).geometries(4326)
+    self.assertEqual(geometries[0], str(Point((8.5, 47.4, 1050.0), srid=4326)))
+    self.assertEqual(geometries[1], str(Point((13.4, 52.5), srid=4326)))
+    self.assertIsNone(geometries[2])
+
+  def test_geometries_indices(self):
+    """
+    StateColumns encoding only some of the positions
+    """
+    states = StateColumns(STATES)
+    geometries = states.geometries(4326, [2, 0])
+    self.assertEqual(geometries, [None, str(Point((8.5, 47.4, 1050.0), srid=4326))])
+    self.assertNotIn(("geometries", 4326), states.columns)
+    self.assertEqual(states.geometries(4326, [1]), [states.geometries(4326)[1]])
+
+  def test_grid_search(self):
+    """
+    Grid.search matching a linear scan
+    """
+    rng = random.Random(1)
+    x = array("d", [rng.uniform(-180, 180) for i in range(1000)])
+    y = array("d", [rng.uniform(-90, 90) for i in range(1000)])
+    grid = Grid(x, y, 10.0)
+    for box in [(-180, -90, 180, 90), (5, 5, 25.5, 17), (-3, -3, -2, -2)]:
+      expected = [i for i in range(1000)
+                  if box[0] <= x[i] <= box[2] and box[1] <= y[i] <= box[3]]
+      self.assertEqual(grid.search(*box), expected)
+
+  def test_grid_nearest(self):
+    """
+    Grid.nearest ordering every point by distance
+    """
+    rng = random.Random(2)
+    x = array("d", [rng.uniform(-20, 20) for i in range(500)] + [float("nan")])
+    y = array("d", [rng.uniform(40, 70) for i in range(500)] + [float("nan")])
+    nearest = list(Grid(x, y).nearest(24.9, 60.3))
+    self.assertEqual(sorted(i for d, i in nearest), list(range(500)))
+    distances = [d for d, i in nearest]
+    self.assertEqual(distances, sorted(distances))
+
+  def test_memory(self):
+    """
+    StateCache fetching once per bucket
+    """
+    cache = StateCache(10)
+    cache.get(10, False, self.fetch)
+    cache.get(10, False, self.fetch)
+    self.assertEqual(self.fetches, 1)
+    cache.get(10, True, self.fetch)
+    cache.get(11, False, self.fetch)
+    self.assertEqual(self.fetches, 3)
+
+  def test_shared(self):
+    """
+    StateCache sharing snapshots through a directory
+    """
+    first = StateCache(10, self.directory)
+    second = StateCache(10, self.directory)
+    self.assertEqual(first.get(10, False, self.fetch).states, STATES)
+    self.assertEqual(second.get(10, False, self.fetch).states, STATES)
+    self.assertEqual(self.fetches, 1)
+    self.assertEqual(second.disk_hits, 1)
+    other = StateCache(5, self.directory)
+    other.get(10, False, self.fetch)
+    self.assertEqual(self.fetches, 2)
+
+  def test_expire(self):
+    """
+    StateCache removing old snapshot files
+    """
+    cache = StateCache(10, self.directory)
+    cache.get(10, False, self.fetch)
+    for name in os.listdir(self.directory):
+      if name.endswith(".json"):
+        os.utime(os.path.join(self.directory, name), (0, 0))
+    cache.get(11, False, self.fetch)
+    names = [n for n in os.listdir(self.directory) if n.endswith(".json")]
+    self.assertEqual(names, ["states-10-0-11.json"])
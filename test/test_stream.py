@@ -0,0 +1,164 @@
+"""
+Test geofdw stream
+"""
+
+import gzip
+import json
+import unittest
+from geofdw.stream import CHUNK_SIZE, decompress, detect_format, iter_features, iter_sequence
+
+class stream(unittest.TestCase):
+  FEATURES = [
+    {
+      "type": "Feature",
+      "geometry": {"type": "Point", "coordinates": [i, -i]},
+      "properties": {"name": "feature \"%d\" }]" % i, "id": i}
+    } for i in range(20)
+  ]
+
+  def chunks(self, document, size):
+    data = json.dumps(document).encode("utf-8")
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+  def test_iter_features(self):
+    """
+    iter_features reading a FeatureCollection split into small chunks
+    """
+    document = {"type": "FeatureCollection", "features": self.FEATURES}
+    for size in [1, 3, 64, 65536]:
+      features = list(iter_features(self.chunks(document, size)))
+      self.assertListEqual(features, self.FEATURES)
+
+  def test_iter_features_skip_members(self):
+    """
+    iter_features skipping members that come before the features
+    """
+    document = {
+      "type": "FeatureCollection",
+      "bbox": [0, -19, 19, 0],
+      "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}},
+      "count": 20,
+      "valid": True,
+      "title": None,
+      "features": self.FEATURES
+    }
+    features = list(iter_features(self.chunks(document, 7)))
+    self.assertListEqual(features, self.FEATURES)
+
+  def test_iter_features_lazy(self):
+    """
+    iter_features yielding the first feature before the input is exhausted
+    """
+    document = {"type": "FeatureCollection", "features": self.FEATURES}
+    chunks = iter(self.chunks(document, 16))
+    feature = next(iter_features(chunks))
+    self.assertEqual(feature, self.FEATURES[0])
+    self.assertIsNotNone(next(chunks, None))
+
+  def test_iter_features_unicode(self):
+    """
+    iter_features reading multi-byte characters split across chunks
+    """
+    feature = {"type": "Feature", "geometry": None, "properties": {"name": "Zürich 東京"}}
+    document = {"type": "FeatureCollection", "features": [feature]}
+    data = json.dumps(document, ensure_ascii=False).encode("utf-8")
+    chunks = [data[i:i + 1] for i in range(len(data))]
+    self.assertListEqual(list(iter_features(chunks)), [feature])
+
+  def test_iter_features_not_geojson(self):
+    """
+    iter_features reading JSON without a features member
+    """
+    chunks = self.chunks({"type": "Feature"}, 4)
+    self.assertRaises(KeyError, list, iter_features(chunks))
+
+  def test_iter_features_not_json(self):
+    """
+    iter_features reading invalid or truncated JSON
+    """
+    self.assertRaises(ValueError, list, iter_features([b"<html></html>"]))
+    self.assertRaises(ValueError, list, iter_features([b'{"features": [{"type": "Feat']))
+
+  def test_iter_sequence(self):
+    """
+    iter_sequence reading newline-delimited GeoJSON and RFC 8142 text sequences
+    """
+    lines = [json.dumps(f).encode("utf-8") for f in self.FEATURES]
+    for data in [b"\n".join(lines) + b"\n", b"\n".join(lines),
+                 b"".join(b"\x1e" + line + b"\n" for line in lines),
+                 b"\r\n\r\n".join(lines)]:
+      for size in [1, 5, 65536]:
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        self.assertListEqual(list(iter_sequence(chunks)), self.FEATURES)
+
+  def test_iter_sequence_texts(self):
+    """
+    iter_sequence reading collections, bare geometries and truncated texts
+    """
+    collection = {"type": "FeatureCollection", "features": self.FEATURES[:2]}
+    geometry = {"type": "Point", "coordinates": [1, 2]}
+    data = b"\x1e" + json.dumps(collection).encode("utf-8") + b"\n" + \
+           b'\x1e{"type": "Feat\n' + \
+           b"\x1e" + json.dumps(geometry).encode("utf-8") + b"\n"
+    features = list(iter_sequence([data]))
+    self.assertListEqual(features[:2], self.FEATURES[:2])
+    self.assertEqual(features[2]["geometry"], geometry)
+    self.assertEqual(len(features), 3)
+    self.assertRaises(ValueError, list, iter_sequence([b'{"type": "Feat\n']))
+    self.assertRaises(KeyError, list, iter_sequence([b'{"name": "x"}\n']))
+
+  def test_iter_sequence_pretty(self):
+    """
+    iter_sequence reading RFC 8142 texts that span several lines
+    """
+    data = b"".join(b"\x1e" + json.dumps(f, indent=2).encode("utf-8") + b"\n"
+                    for f in self.FEATURES)
+    for size in [1, 5, 65536]:
+      chunks = [data[i:i + size] for i in range(0, len(data), size)]
+      self.assertListEqual(list(iter_sequence(chunks)), self.FEATURES)
+    truncated = data + b'\x1e{\n  "type": "Feat'
+    self.assertListEqual(list(iter_sequence([b"\n", truncated])), self.FEATURES)
+
+  def test_iter_sequence_lazy(self):
+    """
+    iter_sequence yielding the first feature before the input is exhausted
+    """
+    data = b"\n".join(json.dumps(f).encode("utf-8") for f in self.FEATURES)
+    chunks = iter([data[i:i + 100] for i in range(0, len(data), 100)])
+    self.assertEqual(next(iter_sequence(chunks)), self.FEATURES[0])
+    self.assertIsNotNone(next(chunks, None))
+
+  def test_decompress(self):
+    """
+    decompress inflating gzip chunks and passing plain chunks through
+    """
+    data = b"\n".join(json.dumps(f).encode("utf-8") for f in self.FEATURES) * 500
+    compressed = gzip.compress(data)
+    chunks = [compressed[i:i + 1000] for i in range(0, len(compressed), 1000)]
+    inflated = list(decompress(chunks))
+    self.assertEqual(b"".join(inflated), data)
+    self.assertTrue(all(len(chunk) <= CHUNK_SIZE for chunk in inflated))
+    self.assertEqual(b"".join(decompress([gzip.compress(b"a"), gzip.compress(b"b")])), b"ab")
+    self.assertListEqual(list(decompress([b"", b"{}", b"[]"])), [b"{}", b"[]"])
+    self.assertRaises(ValueError, list, decompress([compressed[:100]]))
+
+  def test_detect_format(self):
+    """
+    detect_format from the media type or the extension
+    """
+    self.assertEqual(detect_format("http://x/a.json", "application/geo+json-seq"), "geojsonseq")
+    self.assertEqual(detect_format("http://x/a", "application/x-ndjson; charset=utf-8"), "geojsonseq")
+    self.assertEqual(detect_format("http://x/a.geojsonl.gz?v=1", "application/gzip"), "geojsonseq")
+    self.assertEqual(detect_format("http://x/a.geojson", "application/geo+json"), "geojson")
+    self.assertEqual(detect_format("http://x/a.geojson.gz"), "geojson")
+
+  def test_iter_features_member(self):
+    """
+    iter_features reading another array member, or a null one
+    """
+    document = {"time": 1, "states": [["abc", 1], ["def", 2]]}
+    self.assertListEqual(list(iter_features(self.chunks(document, 5), "states")),
+                         document["states"])
+    document = {"time": 1, "states": None}
+    self.assertListEqual(list(iter_features(self.chunks(document, 5), "states")), [])
+    self.assertRaises(KeyError, list, iter_features(self.chunks({"time": 1}, 5), "states"))
@@ -2,6 +2,9 @@
 Test geofdw utils
 """
 
+import os
+import shutil
+import tempfile
 import unittest
 from geofdw.utils import *
 
@@ -26,3 +29,59 @@ class utils(unittest.TestCase):
     """
     srid = crs_to_srid('EPSG:4326')
     self.assertEquals(srid, 4326)
+
+  def test_to_bool(self):
+    """
+    to_bool converting option strings to booleans
+    """
+    self.assertTrue(to_bool('true'))
+    self.assertTrue(to_bool('T'))
+    self.assertFalse(to_bool('false'))
+    self.assertFalse(to_bool('0'))
+    self.assertRaises(ValueError, to_bool, 'maybe')
+
+  def test_local_path(self):
+    """
+    local_path recognising file URLs and plain paths
+    """
+    self.assertEqual(local_path('file:///data/a%20b.geojson'), '/data/a b.geojson')
+    self.assertEqual(local_path('/data/a.geojson'), '/data/a.geojson')
+    self.assertEqual(local_path('data/a.geojson'), 'data/a.geojson')
+    self.assertIsNone(local_path('https://example.com/a.geojson'))
+
+  def test_allowed_path(self):
+    """
+    allowed_path accepting only files inside the given directories
+    """
+    directory = tempfile.mkdtemp()
+    try:
+      data = os.path.join(directory, 'data')
+      os.mkdir(data)
+      os.symlink('/etc/passwd', os.path.join(data, 'link'))
+      path = os.path.join(data, 'a.geojson')
+      self.assertEqual(allowed_path(path, [data]), os.path.realpath(path))
+      self.assertEqual(allowed_path(path, ['relative', data + '/']), os.path.realpath(path))
+      self.assertIsNone(allowed_path(path, []))
+      self.assertIsNone(allowed_path(os.path.join(data, '..', 'b.geojson'), [data]))
+      self.assertIsNone(allowed_path(os.path.join(data, 'link'), [data]))
+      self.assertIsNone(allowed_path(data + '2/a.geojson', [data]))
+      self.assertIsNone(allowed_path('data/a.geojson', [data]))
+    finally:
+      shutil.rmtree(directory)
+
+  def test_map_unordered(self):
+    """
+    map_unordered taking items only as the results are consumed
+    """
+    taken = []
+    def items():
+      for i in range(100):
+        taken.append(i)
+        yield i
+    results = map_unordered(lambda i: i * i, items(), 4)
+    item, result = next(results)
+    self.assertEqual(result, item * item)
+    results.close()
+    self.assertEqual(len(taken), 4)
+    results = dict(map_unordered(lambda i: i * i, range(20), 4))
+    self.assertEqual(results, dict((i, i * i) for i in range(20)))